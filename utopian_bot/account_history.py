@@ -0,0 +1,127 @@
+"""
+Reads an account's history backwards, page by page. Where the node supports
+it, only the wanted operation types are requested through the history API's
+operation filter bitmask, so e.g. a trail's transfers, comments and
+custom_json operations are never downloaded. The size of each page adapts to
+how much history is still needed, and operations are returned as the raw
+dictionaries sent by the node so callers can filter them cheaply.
+"""
+
+from datetime import datetime
+
+from beemapi.exceptions import RPCError
+
+from connections import thread_steem
+import metrics
+
+# Bit of each operation type in the operation filter (its ID in the protocol)
+OPERATION_IDS = {
+    "vote": 0,
+    "comment": 1,
+    "transfer": 2,
+    "custom_json": 18,
+    "comment_options": 19,
+    "delegate_vesting_shares": 40,
+}
+# Page sizes; nodes don't return more than 1000 operations at once
+FIRST_BATCH = 100
+MIN_BATCH = 10
+MAX_BATCH = 1000
+
+# Whether the node at each URL supports the operation filter
+_FILTER_SUPPORT = {}
+
+
+def operation_filter(operations):
+    """Returns the low and high 64 bits of the operation filter matching the
+    given operation types.
+    """
+    low = high = 0
+    for operation in operations:
+        bit = OPERATION_IDS[operation]
+        if bit < 64:
+            low |= 1 << bit
+        else:
+            high |= 1 << (bit - 64)
+    return low, high
+
+
+def parse_entry(entry):
+    """Returns the index, timestamp, operation type and value of an entry of
+    the account's history.
+    """
+    index, item = entry
+    operation = item["op"]
+    if isinstance(operation, dict):
+        operation_type = operation["type"].replace("_operation", "")
+        value = operation["value"]
+    else:
+        operation_type, value = operation
+    timestamp = datetime.strptime(item["timestamp"], "%Y-%m-%dT%H:%M:%S")
+    return index, timestamp, operation_type, value
+
+
+def fetch_page(steem, account, start, limit, operations):
+    """Returns a page of the account's history and whether the node filtered
+    it by operation type. If the node rejects the operation filter it's
+    remembered and the unfiltered history is requested instead.
+    """
+    url = steem.rpc.url
+    if _FILTER_SUPPORT.get(url, True):
+        low, high = operation_filter(operations)
+        try:
+            page = steem.rpc.get_account_history(account, start, limit, low,
+                                                 high, api="condenser")
+            _FILTER_SUPPORT[url] = True
+            return page, True
+        except RPCError:
+            _FILTER_SUPPORT[url] = False
+
+    return steem.rpc.get_account_history(account, start, limit,
+                                         api="condenser"), False
+
+
+def next_batch(number, newest, oldest, stop):
+    """Returns the size of the next page, estimated from how much time the
+    last page covered and how far back the history still has to be read.
+    """
+    covered = (newest - oldest).total_seconds()
+    if covered <= 0:
+        return MAX_BATCH
+    remaining = (oldest - stop).total_seconds()
+    needed = int(remaining / (covered / number) * 1.1) + 1
+    return min(max(needed, MIN_BATCH), MAX_BATCH)
+
+
+def history_reverse(account, stop, operations=("vote",), steem=None):
+    """Yields the account's operations of the given types that happened after
+    `stop` (in UTC), newest first. Every operation is the raw dictionary sent
+    by the node, with its `timestamp` added.
+    """
+    steem = steem or thread_steem()
+    start = -1
+    limit = FIRST_BATCH
+
+    while True:
+        page, filtered = fetch_page(steem, account, start, limit, operations)
+        if not page:
+            return
+        metrics.inc("utopian_history_operations_total", len(page),
+                    filtered=str(filtered).lower())
+
+        entries = sorted((parse_entry(entry) for entry in page),
+                         key=lambda x: x[0], reverse=True)
+        for _, timestamp, operation_type, value in entries:
+            if timestamp < stop:
+                return
+            if operation_type in operations:
+                yield dict(value, timestamp=timestamp)
+
+        start = entries[-1][0] - 1
+        # A page can't hold more operations than there are left before
+        # `start`, so it would be empty at 0, which only leaves the account's
+        # creation anyway
+        if start < 1:
+            return
+        limit = min(next_batch(len(entries), entries[0][1], entries[-1][1],
+                               stop), start)
@@ -0,0 +1,345 @@
+"""
+Incremental version of the contribution allocation of `planner.py`. The
+planner computes the voting power all contributions would use, each
+category's usage, the categories' shares and the batch from scratch, sorting
+every contribution again. When the contributions are planned again and again
+(e.g. when simulating consecutive runs, or voting as reviews come in), most of
+them haven't changed, so the `Allocator` keeps them sorted and keeps the
+running usage of each category instead. The contributions are kept in a
+treap (a binary search tree balanced by random priorities), where every node
+also holds the product of the fraction of voting power each vote in its
+subtree leaves. Adding or removing a contribution then takes O(log n) steps,
+and so does updating the voting power all contributions would use, which is
+read off the root. The shares are derived from that and the running usage of
+the (few) categories. Only packing the batch goes through all contributions,
+straight from the tree in sorted order.
+
+The allocator is a standalone component: the bots and the simulator still
+plan every run from scratch with `planner.py`.
+
+A category's share is often exactly what its contributions use, so the
+running usage must be the same float as the planner's. The planner sums the
+usage exactly (`math.fsum`), and the allocator keeps the exact sum as a
+fraction, which is rounded the same way.
+
+The allocation is checked against the full recomputation by applying random
+insertions, removals and updates, with
+
+    $ python utopian_bot/allocator.py --steps 20000 --check-every 50
+"""
+
+import argparse
+import math
+import random
+import time
+from fractions import Fraction
+
+from constants import CATEGORY_WEIGHTING, VP_TOTAL
+from planner import (batch_category, contribution_shares, get_batch,
+                     init_contributions, pack_batch)
+
+# Tolerance of the comparison of the shares with the full recomputation, as
+# running sums are rounded differently
+TOLERANCE = 1e-9
+
+
+class Node():
+    """Node of the treap holding a contribution's sort key and the fraction
+    of voting power its vote leaves, with the product of those fractions in
+    its subtree.
+    """
+    __slots__ = ("key", "factor", "priority", "left", "right", "product")
+
+    def __init__(self, key, factor, priority):
+        self.key = key
+        self.factor = factor
+        self.priority = priority
+        self.left = None
+        self.right = None
+        self.product = factor
+
+    def update(self):
+        self.product = self.factor
+        if self.left:
+            self.product *= self.left.product
+        if self.right:
+            self.product *= self.right.product
+
+
+def split(node, key):
+    """Splits the treap into the nodes with a smaller key and the rest."""
+    if node is None:
+        return None, None
+    if node.key < key:
+        node.right, right = split(node.right, key)
+        node.update()
+        return node, right
+    left, node.left = split(node.left, key)
+    node.update()
+    return left, node
+
+
+def merge(left, right):
+    """Merges two treaps, all keys of the first being smaller."""
+    if left is None or right is None:
+        return left or right
+    if left.priority > right.priority:
+        left.right = merge(left.right, right)
+        left.update()
+        return left
+    right.left = merge(left, right.left)
+    right.update()
+    return right
+
+
+def remove(node, key):
+    """Removes the node with the given key from the treap."""
+    if node.key == key:
+        return merge(node.left, node.right)
+    if key < node.key:
+        node.left = remove(node.left, key)
+    else:
+        node.right = remove(node.right, key)
+    node.update()
+    return node
+
+
+def in_order(node):
+    """Yields the keys of the treap in sorted order."""
+    stack = []
+    while stack or node:
+        while node:
+            stack.append(node)
+            node = node.left
+        node = stack.pop()
+        yield node.key
+        node = node.right
+
+
+class Allocator():
+    """Contributions of the batch kept sorted by score (high -> low) and
+    creation date (old -> young), like `sort_batch_contributions` does, with
+    the exact voting power usage of each category.
+    """
+    def __init__(self, comment_usage=0.0, vp_total=VP_TOTAL,
+                 category_weighting=CATEGORY_WEIGHTING, seed=None):
+        self.comment_usage = comment_usage
+        self.voting_power = 100.0 - comment_usage
+        self.vp_total = vp_total
+        self.category_weighting = category_weighting
+        self.contributions = {}
+        self.root = None
+        self.random = random.Random(seed)
+        self.sequence = 0
+        self.usage = {}
+        self.counts = {}
+        self.shares = None
+
+    def __len__(self):
+        return len(self.contributions)
+
+    def add(self, contribution):
+        """Adds the contribution, replacing the one with the same URL (e.g.
+        when it was reviewed again).
+        """
+        url = contribution["url"]
+        if url in self.contributions:
+            self.remove(url)
+
+        # Ties are kept in the order the contributions were added, like the
+        # planner's stable sort does
+        key = (-contribution["score"], contribution["created"], self.sequence,
+               url)
+        self.sequence += 1
+        voting_weight = contribution["voting_weight"]
+        node = Node(key, 1.0 - voting_weight / 100.0 * 0.02,
+                    self.random.random())
+        left, right = split(self.root, key)
+        self.root = merge(merge(left, node), right)
+        self.contributions[url] = (key, contribution)
+
+        category = batch_category(contribution["category"])
+        self.usage[category] = self.usage.get(category, 0) + Fraction(
+            voting_weight / 100.0 * 0.02 * self.voting_power)
+        self.counts[category] = self.counts.get(category, 0) + 1
+        self.shares = None
+
+    def remove(self, url):
+        """Removes the contribution with the given URL (e.g. once it has been
+        voted on, or when it was unvoted), if there is one.
+        """
+        if url not in self.contributions:
+            return
+        key, contribution = self.contributions.pop(url)
+        self.root = remove(self.root, key)
+
+        category = batch_category(contribution["category"])
+        voting_weight = contribution["voting_weight"]
+        self.counts[category] -= 1
+        if self.counts[category]:
+            self.usage[category] -= Fraction(
+                voting_weight / 100.0 * 0.02 * self.voting_power)
+        else:
+            del self.counts[category]
+            del self.usage[category]
+        self.shares = None
+
+    def sync(self, contributions):
+        """Applies the difference between the kept contributions and the
+        given ones, e.g. the latest batch.
+        """
+        latest = {contribution["url"]: contribution
+                  for contribution in contributions}
+        for url in [url for url in self.contributions if url not in latest]:
+            self.remove(url)
+        for url, contribution in latest.items():
+            if url not in self.contributions or \
+                    self.contributions[url][1] != contribution:
+                self.add(contribution)
+
+    def sorted_contributions(self):
+        """Returns the contributions in the order they are packed in."""
+        return [self.contributions[key[3]][1] for key in in_order(self.root)]
+
+    def category_usage(self):
+        """Returns the voting power upvoting all contributions in each
+        category would use, like `get_category_usage`.
+        """
+        return {category: float(usage)
+                for category, usage in self.usage.items()}
+
+    def contribution_usage(self):
+        """Returns the voting power upvoting all contributions would use, like
+        `contribution_voting_power`: every vote leaves a fraction of the
+        voting power, and the root holds the product of all of them.
+        """
+        if self.root is None:
+            return 0.0
+        return self.voting_power - self.voting_power * self.root.product
+
+    def category_share(self):
+        """Returns the share of the voting power of each category, like
+        `init_contributions`. The shares are recomputed at most once per
+        change.
+        """
+        if self.shares is None:
+            self.shares = contribution_shares(
+                self.contribution_usage(), self.category_usage(),
+                self.comment_usage, self.vp_total, self.category_weighting)
+        return dict(self.shares)
+
+    def batch(self, voting_power):
+        """Returns the voting power left and the batch, like `get_batch`."""
+        return pack_batch(self.sorted_contributions(), self.category_share(),
+                          voting_power)
+
+
+def random_contribution(rng, url):
+    """Returns a contribution with random fields. Scores and creation dates
+    are drawn from small sets, so there are many ties.
+    """
+    category = rng.choice(list(CATEGORY_WEIGHTING))
+    if category == "task-request":
+        category = rng.choice(["task-development", "task-analysis",
+                               "task-translations"])
+    return {
+        "url": url,
+        "category": category,
+        "score": float(rng.randrange(0, 100, 5)),
+        "created": f"2019-01-{rng.randint(1, 7):02d}T12:00:00",
+        "voting_weight": round(rng.uniform(1.0, 100.0), 2),
+        "staff_picked": False,
+    }
+
+
+def full_allocation(contributions, comment_usage, voting_power):
+    """Returns the shares and batch computed from scratch by the planner."""
+    category_share = init_contributions(contributions, comment_usage)
+    shares = dict(category_share)
+    voting_power, batch = get_batch(contributions, category_share,
+                                    voting_power)
+    return shares, voting_power, batch
+
+
+def equal_shares(incremental, full):
+    return incremental.keys() == full.keys() and all(
+        math.isclose(incremental[category], full[category],
+                     rel_tol=TOLERANCE, abs_tol=TOLERANCE)
+        for category in full)
+
+
+def check(steps, check_every=1, seed=0, comment_usage=3.0, start=200):
+    """Applies random insertions, removals and updates to an allocator and
+    compares its shares and batch with the full recomputation every
+    `check_every` steps. Returns the number of mismatches and the time spent
+    by each.
+    """
+    rng = random.Random(seed)
+    allocator = Allocator(comment_usage, seed=seed)
+    voting_power = 100.0 - comment_usage
+    mismatches = 0
+    timings = {"incremental": 0.0, "full": 0.0}
+
+    for url in range(start):
+        allocator.add(random_contribution(rng, f"post-{url}"))
+    urls = start
+
+    for step in range(1, steps + 1):
+        operation = rng.random()
+        if operation < 0.5 or not allocator:
+            contribution = random_contribution(rng, f"post-{urls}")
+            urls += 1
+        else:
+            url = rng.choice(list(allocator.contributions))
+            contribution = None if operation < 0.8 else \
+                random_contribution(rng, url)
+
+        started = time.perf_counter()
+        if contribution:
+            allocator.add(contribution)
+        else:
+            allocator.remove(url)
+        timings["incremental"] += time.perf_counter() - started
+
+        if step % check_every:
+            continue
+
+        started = time.perf_counter()
+        shares = allocator.category_share()
+        left, batch = allocator.batch(voting_power)
+        timings["incremental"] += time.perf_counter() - started
+
+        # The planner keeps ties in the order it's given, which is the order
+        # the contributions were added in
+        contributions = [contribution for _, contribution
+                         in allocator.contributions.values()]
+        started = time.perf_counter()
+        full_shares, full_left, full_batch = full_allocation(
+            contributions, comment_usage, voting_power)
+        timings["full"] += time.perf_counter() - started
+
+        if not equal_shares(shares, full_shares) or \
+                not math.isclose(left, full_left, rel_tol=TOLERANCE) or \
+                [c["url"] for c in batch] != [c["url"] for c in full_batch]:
+            mismatches += 1
+            print(f"Mismatch at step {step} ({len(allocator)} contributions)")
+
+    return mismatches, timings
+
+
+def main(steps, check_every, seed):
+    """Checks the incremental allocation against the full recomputation."""
+    mismatches, timings = check(steps, check_every, seed)
+    print(f"{steps} changes, checked every {check_every}: {mismatches} "
+          f"mismatches, incremental {timings['incremental']:.2f}s, full "
+          f"{timings['full']:.2f}s")
+    return mismatches
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--steps", type=int, default=10000)
+    parser.add_argument("--check-every", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    raise SystemExit(1 if main(args.steps, args.check_every, args.seed)
+                     else 0)
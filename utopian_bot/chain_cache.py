@@ -0,0 +1,142 @@
+"""
+Short-lived cache of the chain globals (dynamic global properties, reward
+fund, median price feed and the other properties beem keeps) and of account
+snapshots, shared by every thread of a bot process. beem stores the globals
+per `Steem` instance, so each worker thread would otherwise fetch all of them
+again the first time it converts vests or rshares, and every `Account(...)`
+fetches the account again. An account's snapshot is dropped as soon as the bot
+broadcasts a vote from it, so its voting power is never stale.
+"""
+
+import threading
+import time
+from datetime import datetime
+
+from beem.account import Account
+
+from connections import thread_steem
+import metrics
+
+# Seconds the globals and account snapshots are kept for
+GLOBALS_TTL = 300
+ACCOUNT_TTL = 60
+# Globals stored by beem's `Steem.refresh_data`
+GLOBAL_KEYS = ("dynamic_global_properties", "feed_history", "get_feed_history",
+               "hardfork_properties", "network", "witness_schedule", "config",
+               "reward_funds")
+
+
+class TTLCache():
+    """Thread-safe cache whose entries expire after `ttl` seconds. Only one
+    thread fetches a missing entry, the others wait for its result.
+    """
+    def __init__(self, name, ttl, clock=time.monotonic):
+        self.name = name
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.fetching = {}
+
+    def lookup(self, key):
+        entry = self.entries.get(key)
+        if entry and entry[0] > self.clock():
+            return entry
+        return None
+
+    def get(self, key, fetch):
+        """Returns the cached value of the key, calling `fetch` to get it if
+        it's missing or expired.
+        """
+        with self.lock:
+            entry = self.lookup(key)
+            key_lock = self.fetching.setdefault(key, threading.Lock())
+        if entry:
+            metrics.inc("utopian_cache_requests_total", cache=self.name,
+                        result="hit")
+            return entry[1]
+
+        with key_lock:
+            with self.lock:
+                entry = self.lookup(key)
+            if entry:
+                metrics.inc("utopian_cache_requests_total", cache=self.name,
+                            result="hit")
+                return entry[1]
+
+            metrics.inc("utopian_cache_requests_total", cache=self.name,
+                        result="miss")
+            value = fetch()
+            with self.lock:
+                self.entries[key] = (self.clock() + self.ttl, value)
+            return value
+
+    def invalidate(self, key=None):
+        """Drops the entry of the key, or all entries."""
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+
+GLOBALS = TTLCache("globals", GLOBALS_TTL)
+ACCOUNTS = TTLCache("accounts", ACCOUNT_TTL)
+
+
+def chain_globals(steem=None):
+    """Returns the chain globals, fetched at most once every `GLOBALS_TTL`
+    seconds.
+    """
+    steem = steem or thread_steem()
+
+    def fetch():
+        steem.refresh_data(force_refresh=True)
+        return {key: steem.data.get(key) for key in GLOBAL_KEYS}
+
+    return GLOBALS.get(steem.rpc.url, fetch)
+
+
+def share_globals(steem=None):
+    """Makes the Steem instance use the cached globals instead of fetching
+    its own.
+    """
+    steem = steem or thread_steem()
+    steem.data.update(chain_globals(steem))
+    steem.data["last_refresh"] = datetime.utcnow()
+    steem.data["last_node"] = steem.rpc.url
+    steem.data_refresh_time_seconds = GLOBALS_TTL
+    return steem
+
+
+def account(name, steem=None):
+    """Returns a snapshot of the account that is at most `ACCOUNT_TTL`
+    seconds old.
+    """
+    steem = steem or thread_steem()
+    return ACCOUNTS.get(name, lambda: Account(name, steem_instance=steem))
+
+
+def voting_power(name, steem=None):
+    """Returns the account's current voting power."""
+    return account(name, steem).get_voting_power()
+
+
+def voting_value(name, steem=None):
+    """Returns the value of the account's full vote in SBD at its current
+    voting power, computed with the cached globals.
+    """
+    snapshot = account(name, steem)
+    share_globals(snapshot.steem)
+    return snapshot.get_voting_value_SBD()
+
+
+def invalidate(name):
+    """Drops the snapshot of the account, e.g. after it broadcast a vote."""
+    ACCOUNTS.invalidate(name)
+
+
+def clear():
+    """Drops everything, e.g. in a freshly forked worker."""
+    GLOBALS.invalidate()
+    ACCOUNTS.invalidate()
@@ -0,0 +1,332 @@
+"""
+Decides whether trail contributions fit our Watson labels. Posts are reduced
+to plain text and scored by a small TF-IDF model trained on the posts Watson
+classified before. Only the posts the model isn't confident about are sent to
+Watson, shortened and from a pool of rate-limited threads, and Watson's
+answers are stored so the model can be retrained on them. A post Watson
+already classified isn't sent again unless its text changed.
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from watson_developer_cloud.natural_language_understanding_v1 import (CategoriesResult,
+                                                                      Features)
+
+from constants import (DIR_PATH, LOGGER, WATSON_LABELS, WATSON_MAX_CHARS,
+                       WATSON_RATE, WATSON_SCORE, WATSON_SERVICE,
+                       WATSON_WORKERS)
+from database.database_handler import DatabaseHandler
+from post_cache import post_body
+import metrics
+
+MODEL_PATH = f"{DIR_PATH}/classifier.json"
+# Number of terms kept in each class's centroid
+MAX_TERMS = 5000
+# Posts classified by Watson needed (of each class) before the model is used
+MIN_EXAMPLES = 25
+# Share of the held-out posts in the confident ranges that must have been
+# classified the same way by Watson
+TARGET_PRECISION = 0.98
+# Share of the posts of each class held out of training to fit the
+# thresholds on, so they are chosen on posts the model hasn't seen
+HOLDOUT = 0.2
+
+MARKUP = [
+    (re.compile(r"```.*?```", re.S), " "),
+    (re.compile(r"`[^`]*`"), " "),
+    (re.compile(r"<(script|style)\b.*?</\1>", re.S | re.I), " "),
+    (re.compile(r"<[^>]+>"), " "),
+    (re.compile(r"!\[[^\]]*\]\([^)]*\)"), " "),
+    (re.compile(r"\[([^\]]*)\]\([^)]*\)"), r"\1"),
+    (re.compile(r"https?://\S+"), " "),
+    (re.compile(r"&[a-z]+;|&#\d+;"), " "),
+    (re.compile(r"^\s{0,3}(#{1,6}|>|[-*+]|\d+\.)\s+", re.M), ""),
+    (re.compile(r"[*_~|]+"), " "),
+    (re.compile(r"\s+"), " "),
+]
+TOKEN = re.compile(r"[a-z][a-z0-9']{2,}")
+
+_MODEL = {}
+
+
+def plain_text(body):
+    """Returns the text of a post without its Markdown and HTML."""
+    for pattern, replacement in MARKUP:
+        body = pattern.sub(replacement, body)
+    return body.strip()
+
+
+def shorten(text, max_chars=WATSON_MAX_CHARS):
+    """Returns at most `max_chars` characters of the text, cut at a word."""
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars].rsplit(" ", 1)[0]
+
+
+def tokens(text):
+    return TOKEN.findall(text.lower())
+
+
+def vectorise(text, idf):
+    """Returns the normalised TF-IDF vector of the text."""
+    counts = Counter(token for token in tokens(text) if token in idf)
+    vector = {token: (1 + math.log(count)) * idf[token]
+              for token, count in counts.items()}
+    norm = math.sqrt(sum(value * value for value in vector.values()))
+    if not norm:
+        return {}
+    return {token: value / norm for token, value in vector.items()}
+
+
+def centroid(vectors):
+    """Returns the normalised mean of the vectors, keeping the heaviest
+    terms only.
+    """
+    total = Counter()
+    for vector in vectors:
+        total.update(vector)
+    terms = dict(total.most_common(MAX_TERMS))
+    norm = math.sqrt(sum(value * value for value in terms.values()))
+    return {token: value / norm for token, value in terms.items()}
+
+
+def similarity(vector, other):
+    if len(vector) > len(other):
+        vector, other = other, vector
+    return sum(value * other.get(token, 0.0)
+               for token, value in vector.items())
+
+
+def score(model, text):
+    """Returns how much closer the text is to the relevant posts than to the
+    irrelevant ones, between -1 and 1.
+    """
+    vector = vectorise(text, model["idf"])
+    return (similarity(vector, model["relevant"]) -
+            similarity(vector, model["irrelevant"]))
+
+
+def thresholds(scores):
+    """Returns the scores above which posts are accepted and below which
+    they are rejected without asking Watson. Both are chosen so that at least
+    `TARGET_PRECISION` of the held-out posts in either range were classified
+    the same way by Watson.
+    """
+    ranked = sorted(scores, reverse=True)
+    accept = math.inf
+    relevant = 0
+    for index, (value, label) in enumerate(ranked, start=1):
+        relevant += label
+        if relevant / index >= TARGET_PRECISION and label:
+            accept = value
+
+    reject = -math.inf
+    irrelevant = 0
+    for index, (value, label) in enumerate(reversed(ranked), start=1):
+        irrelevant += not label
+        if irrelevant / index >= TARGET_PRECISION and not label:
+            reject = value
+
+    return accept, reject
+
+
+def split(examples, holdout=HOLDOUT, seed=0):
+    """Returns the examples to train on and the ones held out, taking the
+    same share of either class at random (but always the same for the same
+    examples).
+    """
+    training, held_out = [], []
+    for label in (True, False):
+        subset = [example for example in examples if example[1] == label]
+        random.Random(seed).shuffle(subset)
+        count = max(1, int(round(len(subset) * holdout)))
+        held_out.extend(subset[:count])
+        training.extend(subset[count:])
+    return training, held_out
+
+
+def train(examples):
+    """Returns a model trained on (text, relevant) pairs, with its thresholds
+    fit on a held-out share of them, or None if there aren't enough of either
+    class yet.
+    """
+    labels = Counter(relevant for _, relevant in examples)
+    if labels[True] < MIN_EXAMPLES or labels[False] < MIN_EXAMPLES:
+        return None
+    training, held_out = split(examples)
+
+    documents = Counter()
+    for text, _ in training:
+        documents.update(set(tokens(text)))
+    idf = {token: math.log(len(training) / count) + 1.0
+           for token, count in documents.items() if count > 1}
+
+    vectors = [(vectorise(text, idf), relevant)
+               for text, relevant in training]
+    model = {
+        "idf": idf,
+        "relevant": centroid(v for v, relevant in vectors if relevant),
+        "irrelevant": centroid(v for v, relevant in vectors if not relevant),
+    }
+    scores = [(score(model, text), relevant) for text, relevant in held_out]
+    model["accept"], model["reject"] = thresholds(scores)
+    model["idf"] = {token: idf[token] for token in
+                    set(model["relevant"]) | set(model["irrelevant"])}
+    return model
+
+
+def load_model(path=MODEL_PATH):
+    """Returns the trained model, or None if there is none."""
+    if path not in _MODEL:
+        try:
+            with open(path) as fd:
+                _MODEL[path] = json.load(fd)
+        except (OSError, ValueError):
+            _MODEL[path] = None
+    return _MODEL[path]
+
+
+def local_decision(model, text):
+    """Returns True or False if the model is confident the text does or
+    doesn't fit our labels, otherwise None.
+    """
+    if not model:
+        return None
+    value = score(model, text)
+    if value >= model["accept"]:
+        return True
+    if value <= model["reject"]:
+        return False
+    return None
+
+
+class RateLimiter():
+    """Spaces calls made from any number of threads at least 1 / rate
+    seconds apart.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_call = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+LIMITER = RateLimiter(WATSON_RATE)
+
+
+def watson_decision(post, text):
+    """Returns True if Watson's analysis determines the text fits our labels,
+    False otherwise, and stores its answer for training.
+    """
+    LIMITER.wait()
+    with metrics.watson_call():
+        response = WATSON_SERVICE.analyze(
+            text=text,
+            features=Features(categories=CategoriesResult())).get_result()
+
+    best = max([category["score"] for category in response["categories"]
+                if category["label"] in WATSON_LABELS], default=0.0)
+    relevant = best >= WATSON_SCORE
+
+    DatabaseHandler.get_instance().add_label(post["authorperm"], text, best,
+                                             relevant)
+    return relevant
+
+
+def safe_watson_decision(item):
+    post, text = item
+    try:
+        return watson_decision(post, text)
+    except Exception as error:
+        LOGGER.error(f"Watson couldn't classify {post['authorperm']}: "
+                     f"{error}")
+        return False
+
+
+def classify(posts, model_path=MODEL_PATH):
+    """Returns whether each of the given posts fits our labels, keyed by
+    authorperm. Posts Watson classified before keep its answer unless they
+    were edited since, confident cases are decided locally and the rest by
+    Watson.
+    """
+    model = load_model(model_path)
+    database = DatabaseHandler.get_instance()
+    decisions = {}
+    ambiguous = []
+
+    for post in posts:
+        try:
+            body = post_body(post)
+        except Exception as error:
+            LOGGER.error(f"Couldn't fetch the body of {post['authorperm']}: "
+                         f"{error}")
+            body = post["body"]
+        text = shorten(plain_text(body))
+        label = database.get_label(post["authorperm"])
+        if label and label[0] == text:
+            decisions[post["authorperm"]] = label[1]
+            metrics.inc("utopian_classifier_decisions_total",
+                        decision="stored")
+            continue
+
+        decision = local_decision(model, text)
+        if decision is None:
+            ambiguous.append((post, text))
+        else:
+            decisions[post["authorperm"]] = decision
+            metrics.inc("utopian_classifier_decisions_total",
+                        decision="accept" if decision else "reject")
+
+    if len(ambiguous) == 1:
+        results = [safe_watson_decision(ambiguous[0])]
+    elif ambiguous:
+        with ThreadPoolExecutor(max_workers=WATSON_WORKERS) as executor:
+            results = list(executor.map(safe_watson_decision, ambiguous))
+    else:
+        results = []
+
+    for (post, _), decision in zip(ambiguous, results):
+        decisions[post["authorperm"]] = decision
+        metrics.inc("utopian_classifier_decisions_total", decision="watson")
+
+    return decisions
+
+
+def main(model_path=MODEL_PATH):
+    """Trains the local classifier on every post Watson classified."""
+    examples = DatabaseHandler.get_instance().get_labels()
+    model = train(examples)
+    if not model:
+        print(f"Not enough posts classified by Watson yet ({len(examples)})")
+        return
+
+    temporary = f"{model_path}.tmp"
+    with open(temporary, "w") as fd:
+        json.dump(model, fd, separators=(",", ":"))
+    os.replace(temporary, model_path)
+    print(f"Trained on {len(examples)} posts (thresholds fit on "
+          f"{len(split(examples)[1])} held out): accepting above "
+          f"{model['accept']:.3f}, rejecting below {model['reject']:.3f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--model", default=MODEL_PATH,
+                        help="path the model is written to")
+    args = parser.parse_args()
+    main(args.model)
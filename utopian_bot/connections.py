@@ -0,0 +1,55 @@
+"""
+Connections to the Steem node. `steem_client` builds the process's main
+`Steem` instance, connected to the node (and with the keys) given in the
+environment, e.g. to run against the simulated node of the load test or to
+give each work queue worker its own node.
+
+beem's RPC client holds a single connection that must not be shared between
+threads, so every worker thread gets its own `Steem` instance connected to
+the same node as the main one.
+"""
+
+import os
+import threading
+
+from beem import Steem
+from beem.instance import set_shared_steem_instance, shared_steem_instance
+
+STEEM_NODE = os.environ.get("STEEM_NODE")
+STEEM_KEYS = [key for key in os.environ.get("STEEM_KEYS", "").split(",")
+              if key]
+
+_LOCAL = threading.local()
+
+
+def steem_client(node=STEEM_NODE, keys=STEEM_KEYS):
+    """Returns a `Steem` instance connected to the given node, or to beem's
+    default nodes, and makes it the shared instance. Without keys beem uses
+    the ones in its wallet.
+    """
+    if node:
+        steem = Steem(node=node, **({"keys": keys} if keys else {}))
+    else:
+        steem = Steem()
+    set_shared_steem_instance(steem)
+    return steem
+
+
+def thread_steem():
+    """Returns the Steem instance that the current thread should use."""
+    if threading.current_thread() is threading.main_thread():
+        return shared_steem_instance()
+
+    if not hasattr(_LOCAL, "steem"):
+        _LOCAL.steem = Steem(node=shared_steem_instance().rpc.url)
+    return _LOCAL.steem
+
+
+def reconnect(node, keys=()):
+    """Connects the shared `Steem` instance, which modules imported before
+    may hold on to, to the given node instead, adding the given keys.
+    """
+    steem = shared_steem_instance()
+    steem.connect(node=node)
+    if keys:
+        steem.wallet.setKeys(keys)
@@ -1,26 +1,20 @@
-import logging
 import os
 from datetime import date, datetime, timedelta
 
 import gspread
-from beem import Steem
 from oauth2client.service_account import ServiceAccountCredentials
 from watson_developer_cloud import NaturalLanguageUnderstandingV1
 
+from connections import steem_client
+from logger import get_logger
+
 TESTING = True
 
 DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 LOGGING = True
-LOGGER = logging.getLogger("utopian-io")
-LOGGER.setLevel(logging.INFO)
-FILE_HANDLER = logging.FileHandler(f"{DIR_PATH}/bot.log")
-FILE_HANDLER.setLevel(logging.DEBUG)
-FORMATTER = logging.Formatter(
-    "%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-FILE_HANDLER.setFormatter(FORMATTER)
-LOGGER.addHandler(FILE_HANDLER)
+LOGGER = get_logger("utopian-io")
 
-STEEM = Steem()
+STEEM = steem_client()
 if TESTING:
     ACCOUNT = "utopian.signup"
 else:
@@ -108,15 +102,40 @@ COMMENT_UNVOTE = (
 COMMENT_REVIEW = (
     "Thank you for your review, @{}! Keep up the good work!")
 
-CONTRIBUTION_BATCH = "https://utopian.rocks/api/batch/contributions"
-COMMENT_BATCH = "https://utopian.rocks/api/batch/comments"
+CONTRIBUTION_BATCH = os.environ.get(
+    "CONTRIBUTION_BATCH", "https://utopian.rocks/api/batch/contributions")
+COMMENT_BATCH = os.environ.get(
+    "COMMENT_BATCH", "https://utopian.rocks/api/batch/comments")
 VP_TOTAL = 18.0
 VP_COMMENTS = 3.2
 
+# Directory the inputs of every batch run are archived in
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", f"{DIR_PATH}/archive")
+# Seconds between two votes of the same account
+VOTE_INTERVAL = float(os.environ.get("VOTE_INTERVAL", 3))
+# Votes have to land within this long after a post was created
+VOTE_CUTOFF = timedelta(days=6, hours=12)
+
+# Accounts that vote in a batch run. Comments, contributions and trail posts
+# are split between them according to their budgets and category weighting,
+# and each account votes in its own worker process. The voting value used for
+# comment weights is taken from `value_account` (defaults to the account).
+VOTING_ACCOUNTS = {
+    ACCOUNT: {
+        "vp_total": VP_TOTAL,
+        "vp_comments": VP_COMMENTS,
+        "category_weighting": CATEGORY_WEIGHTING,
+        "trail": True,
+        "value_account": "utopian-io",
+    },
+}
+
 WATSON_SERVICE = NaturalLanguageUnderstandingV1(
     version="2018-03-16",
     username=os.environ["WATSON_USERNAME"],
-    password=os.environ["WATSON_PASSWORD"]
+    password=os.environ["WATSON_PASSWORD"],
+    **({"url": os.environ["WATSON_URL"]} if "WATSON_URL" in os.environ
+       else {})
 )
 WATSON_LABELS = [
     "/science/biology/biotechnology",
@@ -286,3 +305,12 @@ TRAIL_ACCOUNTS = {
     }
 }
 WATSON_SCORE = 0.68
+# Watson is called concurrently by this many threads, at most WATSON_RATE
+# times a second, with at most WATSON_MAX_CHARS characters of each post
+WATSON_WORKERS = 4
+WATSON_RATE = 5.0
+WATSON_MAX_CHARS = 3000
+# Voting power below which no more trail contributions are upvoted
+TRAIL_VP_FLOOR = 80.0
+# Number of threads used to scan the trails and fetch their posts
+TRAIL_WORKERS = 8
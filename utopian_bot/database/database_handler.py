@@ -1,10 +1,27 @@
 """
 Class for handling the sqlite3 database which stores contributions upvoted
-while following the trail.
+while following the trail, the immutable metadata of posts and the history of
+batch runs.
+
+Every thread (of every process) gets its own connections, so worker threads
+and forked worker processes never share one. The database is in WAL mode, so
+readers never block the writer or each other: reads go through a read-only
+connection, and every write is a short `BEGIN IMMEDIATE` transaction, which
+waits up to `BUSY_TIMEOUT` seconds for the write lock instead of failing.
 """
 
+import json
 import os
 import sqlite3
+import threading
+import zlib
+from contextlib import contextmanager
+from urllib.parse import quote
+
+# Columns of the `votes` table the history can be rolled up by
+ROLLUP_COLUMNS = ("account", "type", "category", "trail", "moderator")
+# Seconds a connection waits for a lock held by another connection
+BUSY_TIMEOUT = 30
 
 
 class DatabaseHandler():
@@ -12,7 +29,8 @@ class DatabaseHandler():
         dir_path = os.path.dirname(os.path.abspath(__file__))
 
         def __init__(self):
-            database_path = os.path.join(self.dir_path, "utopian-io.db")
+            database_path = os.environ.get(
+                "DATABASE_PATH", os.path.join(self.dir_path, "utopian-io.db"))
 
             if not os.path.exists(database_path):
                 try:
@@ -20,9 +38,12 @@ class DatabaseHandler():
                 except Exception:
                     pass
 
-            self.connection = sqlite3.connect(database_path)
-            self.connection.text_factory = lambda x: str(x, "utf-8", "ignore")
-            self.cursor = self.connection.cursor()
+            self.database_path = database_path
+            self.local = threading.local()
+            self.connection().execute("PRAGMA journal_mode=WAL")
+            self.create_post_table()
+            self.create_history_tables()
+            self.create_label_table()
 
         @staticmethod
         def create_database(database_path: str) -> None:
@@ -43,6 +64,306 @@ class DatabaseHandler():
             connection.commit()
             connection.close()
 
+        def connect(self, read_only: bool) -> sqlite3.Connection:
+            """Opens a new connection to the database, which is read-only if
+            `read_only` is True. Transactions are started explicitly.
+            """
+            if read_only:
+                connection = sqlite3.connect(
+                    f"file:{quote(self.database_path)}?mode=ro",
+                    timeout=BUSY_TIMEOUT, uri=True, isolation_level=None)
+                connection.execute("PRAGMA query_only=ON")
+                # The file is only opened by the first query
+                connection.execute("SELECT 1 FROM sqlite_master LIMIT 1")
+            else:
+                connection = sqlite3.connect(
+                    self.database_path, timeout=BUSY_TIMEOUT,
+                    isolation_level=None)
+                connection.execute("PRAGMA synchronous=NORMAL")
+            connection.text_factory = lambda x: str(x, "utf-8", "ignore")
+            return connection
+
+        def connections(self) -> dict:
+            """Returns the connections of the current thread. Connections
+            inherited from the parent of a forked process are never used.
+            """
+            if getattr(self.local, "pid", None) != os.getpid():
+                self.local.pid = os.getpid()
+                self.local.connections = {}
+            return self.local.connections
+
+        def connection(self, read_only: bool = False) -> sqlite3.Connection:
+            """Returns the current thread's connection to the database. The
+            read-only connection falls back to the normal one if the database
+            can't be opened read-only.
+            """
+            connections = self.connections()
+            if read_only not in connections:
+                try:
+                    connections[read_only] = self.connect(read_only)
+                except sqlite3.OperationalError:
+                    if not read_only:
+                        raise
+                    connections[read_only] = self.connection()
+            return connections[read_only]
+
+        def read(self, query: str, parameters=()) -> sqlite3.Cursor:
+            """Runs the query on the current thread's read-only connection
+            and returns the cursor.
+            """
+            return self.connection(read_only=True).execute(query, parameters)
+
+        @contextmanager
+        def transaction(self):
+            """Runs the block in a write transaction on the current thread's
+            connection and yields a cursor. The write lock is taken right
+            away, so the transaction can't fail halfway through because
+            another connection started writing.
+            """
+            connection = self.connection()
+            cursor = connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                yield cursor
+                connection.execute("COMMIT")
+            except BaseException:
+                if connection.in_transaction:
+                    connection.execute("ROLLBACK")
+                raise
+
+        def create_post_table(self) -> None:
+            """Create the `posts` table used to cache the metadata of posts
+            that never changes, and their body with the time it was fetched.
+            """
+            with self.transaction() as cursor:
+                cursor.execute("CREATE TABLE IF NOT EXISTS 'posts'"
+                               "('authorperm' TEXT NOT NULL,"
+                               "'id' INTEGER,"
+                               "'author' TEXT,"
+                               "'permlink' TEXT,"
+                               "'category' TEXT,"
+                               "'created' TEXT,"
+                               "'is_comment' INTEGER,"
+                               "'allow_curation_rewards' INTEGER,"
+                               "'beneficiaries' TEXT,"
+                               "'body' TEXT,"
+                               "'body_fetched' REAL,"
+                               "PRIMARY KEY('authorperm'));")
+                columns = [row[1] for row in cursor.execute(
+                    "PRAGMA table_info('posts');")]
+                # Posts cached before the body's fetch time was stored are
+                # fetched again the first time their body is needed
+                if "body_fetched" not in columns:
+                    cursor.execute("ALTER TABLE 'posts' "
+                                   "ADD COLUMN 'body_fetched' REAL;")
+
+        def create_history_tables(self) -> None:
+            """Create the `runs` and `votes` tables storing the history of
+            batch runs. Every vote is stored with the Monday of its week, and
+            the covering indexes on the rollup columns mean weekly partitions
+            can be summed without touching the table itself.
+            """
+            with self.transaction() as cursor:
+                cursor.execute("CREATE TABLE IF NOT EXISTS 'runs'"
+                               "('runID' INTEGER NOT NULL,"
+                               "'started' TEXT,"
+                               "'week' TEXT,"
+                               "'inputs' BLOB,"
+                               "'plans' BLOB,"
+                               "PRIMARY KEY('runID'));")
+                cursor.execute("CREATE TABLE IF NOT EXISTS 'votes'"
+                               "('runID' INTEGER NOT NULL,"
+                               "'week' TEXT,"
+                               "'account' TEXT,"
+                               "'type' TEXT,"
+                               "'category' TEXT,"
+                               "'trail' TEXT,"
+                               "'moderator' TEXT,"
+                               "'url' TEXT,"
+                               "'voting_weight' REAL,"
+                               "'usage' REAL,"
+                               "'status' TEXT);")
+                for column in ROLLUP_COLUMNS:
+                    cursor.execute(
+                        f"CREATE INDEX IF NOT EXISTS 'votes_{column}' ON "
+                        f"votes(status, week, {column}, usage);")
+
+        def add_run(self, started: str, week: str, inputs: dict,
+                    plans: dict, votes: list) -> int:
+            """Add a batch run and the votes it cast to the history and
+            returns the run's ID.
+
+            :param str started: The time the run started.
+            :param str week: The Monday of the week the run started in.
+            :param dict inputs: Everything the run's plans were built from.
+            :param dict plans: The plans of all voting accounts.
+            :param list votes: The planned actions with their outcome, as
+                dicts with the columns of the `votes` table.
+            """
+            # Compressed before the transaction, so the write lock is only
+            # held for the inserts
+            inputs = zlib.compress(json.dumps(inputs).encode())
+            plans = zlib.compress(json.dumps(plans).encode())
+            rows = [(week, vote["account"], vote["type"], vote["category"],
+                     vote["trail"], vote["moderator"], vote["url"],
+                     vote["voting_weight"], vote["usage"], vote["status"])
+                    for vote in votes]
+
+            with self.transaction() as cursor:
+                cursor.execute(
+                    "INSERT INTO runs (started, week, inputs, plans) VALUES "
+                    "(?, ?, ?, ?);", (started, week, inputs, plans))
+                run_id = cursor.lastrowid
+                cursor.executemany(
+                    "INSERT INTO votes VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+                    [(run_id, *row) for row in rows])
+            return run_id
+
+        def get_run(self, run_id: int) -> dict:
+            """Returns the inputs and plans of the run with the given ID, or
+            None if there is no such run.
+
+            :param int run_id: The run's ID.
+            """
+            result = self.read("SELECT started, inputs, plans FROM runs "
+                               "WHERE runID=?;", [int(run_id)]).fetchone()
+
+            if not result:
+                return None
+
+            return {
+                "started": result[0],
+                "inputs": json.loads(zlib.decompress(result[1])),
+                "plans": json.loads(zlib.decompress(result[2])),
+            }
+
+        def rollup(self, column: str, start_week: str,
+                   end_week: str) -> list:
+            """Returns the number of votes cast and the voting power spent
+            per value of the given column in the weeks between the start
+            (inclusive) and the end (exclusive).
+
+            :param str column: One of `ROLLUP_COLUMNS`.
+            :param str start_week: The Monday of the first week.
+            :param str end_week: The Monday of the week after the last week.
+            """
+            if column not in ROLLUP_COLUMNS:
+                raise ValueError(f"Can't roll up votes by {column}")
+
+            return self.read(
+                f"SELECT {column}, count(*), total(usage) FROM votes "
+                f"INDEXED BY votes_{column} WHERE status='voted' AND "
+                f"week >= ? AND week < ? AND {column} IS NOT NULL "
+                f"GROUP BY {column} "
+                f"ORDER BY total(usage) DESC;",
+                [str(start_week), str(end_week)]).fetchall()
+
+        def create_label_table(self) -> None:
+            """Create the `labels` table storing the plain text of posts
+            classified by Watson, which the local classifier is trained on.
+            """
+            with self.transaction() as cursor:
+                cursor.execute("CREATE TABLE IF NOT EXISTS 'labels'"
+                               "('authorperm' TEXT NOT NULL,"
+                               "'text' TEXT,"
+                               "'score' REAL,"
+                               "'relevant' INTEGER,"
+                               "PRIMARY KEY('authorperm'));")
+
+        def add_label(self, authorperm: str, text: str, score: float,
+                      relevant: bool) -> None:
+            """Add a post classified by Watson to the `labels` table.
+
+            :param str authorperm: The post's authorperm.
+            :param str text: The plain text that was classified.
+            :param float score: Watson's highest score for one of our labels.
+            :param bool relevant: Whether the post fits our labels.
+            """
+            with self.transaction() as cursor:
+                cursor.execute(
+                    "INSERT OR REPLACE INTO labels VALUES (?, ?, ?, ?);",
+                    (str(authorperm), text, float(score), int(relevant)))
+
+        def get_label(self, authorperm: str) -> tuple:
+            """Returns the text and label of the post with the given
+            authorperm if it was classified by Watson, otherwise None.
+
+            :param str authorperm: The post's authorperm.
+            """
+            result = self.read(
+                "SELECT text, relevant FROM labels WHERE authorperm=?;",
+                [str(authorperm)]).fetchone()
+            if not result:
+                return None
+            return result[0], bool(result[1])
+
+        def get_labels(self) -> list:
+            """Returns the text and label of every post classified by Watson.
+            """
+            return [(text, bool(relevant)) for text, relevant in self.read(
+                "SELECT text, relevant FROM labels;").fetchall()]
+
+        def get_post(self, authorperm: str) -> dict:
+            """Returns the cached metadata of the post with the given
+            authorperm, or None if it isn't cached.
+
+            :param str authorperm: The post's authorperm.
+            """
+            result = self.read(
+                "SELECT id, author, permlink, category, created, "
+                "is_comment, allow_curation_rewards, beneficiaries, body, "
+                "body_fetched FROM posts WHERE authorperm=?;", [str(authorperm)]).fetchone()
+
+            if not result:
+                return None
+
+            return {
+                "authorperm": authorperm,
+                "id": result[0],
+                "author": result[1],
+                "permlink": result[2],
+                "category": result[3],
+                "created": result[4],
+                "is_comment": bool(result[5]),
+                "allow_curation_rewards": bool(result[6]),
+                "beneficiaries": json.loads(result[7]),
+                "body": result[8],
+                "body_fetched": result[9] or 0.0,
+            }
+
+        def add_post(self, post: dict) -> None:
+            """Add the metadata of a post to the `posts` table.
+
+            :param dict post: The post's metadata, as returned by `get_post`.
+            """
+            with self.transaction() as cursor:
+                cursor.execute(
+                    "INSERT OR REPLACE INTO posts (authorperm, id, author, "
+                    "permlink, category, created, is_comment, "
+                    "allow_curation_rewards, beneficiaries, body, "
+                    "body_fetched) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+                    (post["authorperm"], post["id"], post["author"],
+                     post["permlink"], post["category"], post["created"],
+                     int(post["is_comment"]),
+                     int(post["allow_curation_rewards"]),
+                     json.dumps(post["beneficiaries"]), post["body"],
+                     post.get("body_fetched")))
+
+        def update_post_body(self, authorperm: str, body: str,
+                             fetched: float) -> None:
+            """Replace the cached body of a post, which changes when the post
+            is edited.
+
+            :param str authorperm: The post's authorperm.
+            :param str body: The post's current body.
+            :param float fetched: The time the body was fetched.
+            """
+            with self.transaction() as cursor:
+                cursor.execute(
+                    "UPDATE posts SET body=?, body_fetched=? "
+                    "WHERE authorperm=?;", (body, fetched, str(authorperm)))
+
         def number_upvoted(self, trail: str, upvote_date: str) -> int:
             """Returns the number of contributions upvoted following the given
             trail after a given date.
@@ -51,11 +372,9 @@ class DatabaseHandler():
             :param str upvote_date: The time the contribution was upvoted by
                 utopian-io.
             """
-            self.cursor.execute("SELECT count(*) FROM contributions WHERE "
-                                "trail=? AND upvote_date > ?;",
-                                [str(trail), str(upvote_date)])
-
-            result = self.cursor.fetchone()
+            result = self.read("SELECT count(*) FROM contributions WHERE "
+                               "trail=? AND upvote_date > ?;",
+                               [str(trail), str(upvote_date)]).fetchone()
             return result[0]
 
         def add_contribution(self, contribution_id: int, trail: str,
@@ -69,10 +388,11 @@ class DatabaseHandler():
                 utopian-io.
             """
             try:
-                self.cursor.execute(
-                    "INSERT INTO contributions VALUES (?, ?, ?, ?);",
-                    (str(contribution_id), trail, authorperm, upvote_date))
-                self.connection.commit()
+                with self.transaction() as cursor:
+                    cursor.execute(
+                        "INSERT INTO contributions VALUES (?, ?, ?, ?);",
+                        (str(contribution_id), trail, authorperm,
+                         upvote_date))
             except sqlite3.IntegrityError:
                 pass
 
@@ -82,27 +402,31 @@ class DatabaseHandler():
 
             :param str authorperm: The contribution's authorperm.
             """
-            self.cursor.execute("SELECT rowid, * FROM contributions WHERE "
-                                "authorperm=?;", [str(authorperm)])
-
-            result = self.cursor.fetchall()
-            if len(result) > 0:
-                return True
-            else:
-                return False
+            result = self.read("SELECT 1 FROM contributions WHERE "
+                               "authorperm=? LIMIT 1;",
+                               [str(authorperm)]).fetchone()
+            return result is not None
 
         def close_connection(self) -> None:
-            self.connection.close()
+            """Closes the current thread's connections."""
+            for connection in set(self.connections().values()):
+                connection.close()
+            self.connections().clear()
 
     instance = None
+    # Held while the instance is created, so threads asking for it at the
+    # same time don't each create (and set up the tables of) their own
+    lock = threading.Lock()
 
     def __init__(self):
-        if not DatabaseHandler.instance:
-            DatabaseHandler.instance = DatabaseHandler.__DatabaseHandler()
+        DatabaseHandler.get_instance()
 
     @staticmethod
     def get_instance() -> __DatabaseHandler:
         if not DatabaseHandler.instance:
-            DatabaseHandler.instance = DatabaseHandler.__DatabaseHandler()
+            with DatabaseHandler.lock:
+                if not DatabaseHandler.instance:
+                    DatabaseHandler.instance = \
+                        DatabaseHandler.__DatabaseHandler()
 
         return DatabaseHandler.instance
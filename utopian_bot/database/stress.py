@@ -0,0 +1,175 @@
+"""
+Concurrency stress check of `DatabaseHandler`. Writer and reader threads in
+several forked processes hammer a fresh database at the same time: writers
+cache posts, record trail contributions and labels and add batch runs, while
+readers look all of them up. At the end every write must be readable, and no
+operation may have failed (e.g. with "database is locked").
+
+    $ python utopian_bot/database/stress.py --processes 4 --writers 4 \\
+        --readers 8 --operations 500
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+
+def handler():
+    from database_handler import DatabaseHandler
+    return DatabaseHandler.get_instance()
+
+
+def post(authorperm):
+    return {
+        "authorperm": authorperm,
+        "id": random.randint(1, 10 ** 9),
+        "author": authorperm.split("/")[0][1:],
+        "permlink": authorperm.split("/")[1],
+        "category": "utopian-io",
+        "created": "2019-01-01T00:00:00",
+        "is_comment": False,
+        "allow_curation_rewards": True,
+        "beneficiaries": [{"account": "utopian.pay", "weight": 500}],
+        "body": "lorem ipsum " * 50,
+    }
+
+
+def writer(name, number, operations, results):
+    """Writes `operations` rows, cycling through the kinds of writes, and
+    records what it wrote.
+    """
+    database = handler()
+    written = []
+    for index in range(operations):
+        authorperm = f"@{name}/post-{index}"
+        kind = index % 4
+        run_id = None
+        try:
+            if kind == 0:
+                database.add_post(post(authorperm))
+            elif kind == 1:
+                database.add_contribution(
+                    number * 10 ** 6 + index, "stress", authorperm,
+                    "2019-01-01 00:00:00")
+            elif kind == 2:
+                database.add_label(authorperm, f"text of {authorperm}", 0.5,
+                                   True)
+            else:
+                run_id = database.add_run(
+                    "2019-01-01 00:00:00", "2018-12-31", {"name": name},
+                    {"index": index},
+                    [{"account": name, "type": "trail", "category": "stress",
+                      "trail": "stress", "moderator": None, "url": authorperm,
+                      "voting_weight": 1.0, "usage": 0.02,
+                      "status": "voted"}])
+            written.append((kind, authorperm, run_id))
+        except Exception as error:
+            results["errors"].append(f"write {authorperm}: {error}")
+    results["written"].extend(written)
+
+
+def reader(name, operations, results, stop):
+    """Reads random rows until the writers stopped, or at least
+    `operations` times.
+    """
+    database = handler()
+    reads = 0
+    while reads < operations or not stop.is_set():
+        index = random.randrange(operations)
+        authorperm = f"@{name}/post-{index}"
+        try:
+            database.get_post(authorperm)
+            database.contribution_exists(authorperm)
+            database.number_upvoted("stress", "2018-01-01 00:00:00")
+            database.rollup("account", "2018-01-01", "2020-01-01")
+            reads += 4
+        except Exception as error:
+            results["errors"].append(f"read {authorperm}: {error}")
+        if reads >= 100 * operations:
+            break
+    results["reads"].append(reads)
+
+
+def verify(written, results):
+    """Checks that every write of this process can be read back."""
+    database = handler()
+    labels = {text for text, _ in database.get_labels()}
+    for kind, authorperm, run_id in written:
+        if kind == 0 and not database.get_post(authorperm):
+            results["errors"].append(f"missing post {authorperm}")
+        elif kind == 1 and not database.contribution_exists(authorperm):
+            results["errors"].append(f"missing contribution {authorperm}")
+        elif kind == 2 and f"text of {authorperm}" not in labels:
+            results["errors"].append(f"missing label {authorperm}")
+        elif kind == 3 and not database.get_run(run_id):
+            results["errors"].append(f"missing run {run_id}")
+
+
+def process(arguments):
+    """Runs the writer and reader threads of one process and returns the
+    number of writes and reads and the errors.
+    """
+    index, writers, readers, operations = arguments
+    random.seed(index)
+    results = {"written": [], "reads": [], "errors": []}
+    stop = threading.Event()
+    names = [f"p{index}w{number}" for number in range(writers)]
+
+    write_threads = [threading.Thread(target=writer, args=(
+        name, index * 100 + number, operations, results))
+        for number, name in enumerate(names)]
+    read_threads = [threading.Thread(target=reader, args=(
+        names[number % len(names)], operations, results, stop))
+        for number in range(readers)]
+    for thread in write_threads + read_threads:
+        thread.start()
+    for thread in write_threads:
+        thread.join()
+    stop.set()
+    for thread in read_threads:
+        thread.join()
+
+    verify(results["written"], results)
+    return (len(results["written"]), sum(results["reads"]),
+            results["errors"])
+
+
+def main(processes, writers, readers, operations):
+    """Stress tests the database with concurrent writers and readers."""
+    directory = tempfile.mkdtemp(prefix="utopian-stress-")
+    os.environ["DATABASE_PATH"] = os.path.join(directory, "utopian-io.db")
+    # The database is created before forking, like the bots do
+    handler()
+
+    start = time.perf_counter()
+    context = multiprocessing.get_context("fork")
+    with context.Pool(processes) as pool:
+        outcomes = pool.map(process, [(index, writers, readers, operations)
+                                      for index in range(processes)])
+    elapsed = time.perf_counter() - start
+
+    writes = sum(outcome[0] for outcome in outcomes)
+    reads = sum(outcome[1] for outcome in outcomes)
+    errors = [error for outcome in outcomes for error in outcome[2]]
+    print(f"{writes} writes ({writes / elapsed:.0f}/s) and {reads} reads "
+          f"({reads / elapsed:.0f}/s) by {processes} processes with "
+          f"{writers} writers and {readers} readers each in {elapsed:.1f}s, "
+          f"{len(errors)} errors")
+    for error in errors[:20]:
+        print(f"    {error}")
+    return 1 if errors else 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--operations", type=int, default=500)
+    args = parser.parse_args()
+    sys.exit(main(args.processes, args.writers, args.readers,
+                  args.operations))
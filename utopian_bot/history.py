@@ -0,0 +1,103 @@
+"""
+History of batch runs. Every run's inputs, plans and the outcome of each
+planned vote are appended to the database, so questions like how much voting
+power a category or trail received last month can be answered with a single
+indexed query instead of grepping the log.
+"""
+
+import argparse
+from datetime import date, datetime, timedelta
+
+from prettytable import PrettyTable
+
+from database.database_handler import ROLLUP_COLUMNS, DatabaseHandler
+
+
+def week_of(day):
+    """Returns the Monday of the week the given date is in as a string."""
+    return (day - timedelta(days=day.weekday())).strftime("%Y-%m-%d")
+
+
+def action_votes(name, plan, outcomes):
+    """Returns the rows of the `votes` table for the actions in the account's
+    plan. Actions that weren't executed (e.g. because the voting power
+    dropped below the trail floor) are stored as not executed.
+    """
+    statuses = {outcome["action"]: outcome for outcome in outcomes}
+    votes = []
+    for index, action in enumerate(plan["actions"]):
+        outcome = statuses.get(index, {"status": "not_executed", "usage": 0.0})
+        votes.append({
+            "account": action.get("account", name),
+            "type": action["type"],
+            "category": action.get("category"),
+            "trail": action.get("trail_name"),
+            "moderator": action.get("moderator"),
+            "url": action.get("url", action.get("authorperm")),
+            "voting_weight": action["voting_weight"],
+            "usage": outcome["usage"],
+            "status": outcome["status"],
+        })
+    return votes
+
+
+def record_run(inputs, plans, outcomes, started=None):
+    """Appends the run with the given inputs, plans and outcomes per account
+    to the history and returns its ID.
+    """
+    started = started or datetime.now()
+    if "accounts" not in plans:
+        plans = {"accounts": {next(iter(outcomes)): plans}}
+
+    votes = []
+    for name, plan in plans["accounts"].items():
+        votes.extend(action_votes(name, plan, outcomes.get(name, [])))
+
+    database = DatabaseHandler.get_instance()
+    return database.add_run(started.strftime("%Y-%m-%d %H:%M:%S"),
+                            week_of(started), inputs, plans, votes)
+
+
+def rollup(column, start, end):
+    """Returns the number of votes and voting power spent per value of the
+    column between the given dates.
+    """
+    database = DatabaseHandler.get_instance()
+    return database.rollup(column, week_of(start),
+                           week_of(end + timedelta(days=7)))
+
+
+def rollup_table(column, rows):
+    """Returns a table of the given rollup."""
+    table = PrettyTable()
+    table.title = f"VOTES PER {column.upper()}"
+    table.field_names = [column.capitalize(), "Votes", "VP spent"]
+
+    for value, votes, usage in rows:
+        table.add_row([value, votes, f"{usage:.2f}%"])
+
+    table.align[column.capitalize()] = "l"
+    table.align["Votes"] = "r"
+    table.align["VP spent"] = "r"
+    return table
+
+
+def main(column, start, end):
+    """Prints the votes cast and voting power spent per category, trail,
+    moderator, account or vote type between two dates (inclusive, rounded to
+    whole weeks).
+    """
+    print(rollup_table(column, rollup(column, start, end)))
+
+if __name__ == '__main__':
+    today = date.today()
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("column", choices=ROLLUP_COLUMNS)
+    parser.add_argument("--start", type=date.fromisoformat,
+                        default=today - timedelta(days=28),
+                        help="first day (YYYY-MM-DD), four weeks ago by "
+                             "default")
+    parser.add_argument("--end", type=date.fromisoformat, default=today,
+                        help="last day (YYYY-MM-DD), today by default")
+    args = parser.parse_args()
+    main(args.column, args.start, args.end)
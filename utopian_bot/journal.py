@@ -0,0 +1,92 @@
+"""
+Checkpoint journal of the batch run in progress. The run's inputs and plans
+are written before any vote is cast, and the outcome of every executed action
+is appended (and flushed to disk) as soon as it's known, so a run that
+crashed or was killed can be resumed at the first action that wasn't
+finished, without fetching or planning anything again.
+"""
+
+import json
+import os
+import shutil
+from datetime import datetime
+
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+JOURNAL_DIR = os.environ.get("JOURNAL_DIR", f"{DIR_PATH}/journal")
+RUN_FILE = "run.json"
+
+
+def exists(directory=JOURNAL_DIR):
+    """Returns True if there is an unfinished run to resume."""
+    return os.path.isfile(os.path.join(directory, RUN_FILE))
+
+
+def start(inputs, plans, started=None, directory=JOURNAL_DIR):
+    """Records the start of a run with the given inputs and plans, replacing
+    the journal of any earlier run.
+    """
+    started = started or datetime.now()
+    finish(directory)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, RUN_FILE)
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as fd:
+        json.dump({
+            "started": started.strftime("%Y-%m-%d %H:%M:%S"),
+            "inputs": inputs,
+            "plans": plans,
+        }, fd, separators=(",", ":"))
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.replace(temporary, path)
+
+
+def load(directory=JOURNAL_DIR):
+    """Returns the started time, inputs and plans of the unfinished run."""
+    with open(os.path.join(directory, RUN_FILE)) as fd:
+        run = json.load(fd)
+    run["started"] = datetime.strptime(run["started"], "%Y-%m-%d %H:%M:%S")
+    return run
+
+
+def outcomes(account, directory=JOURNAL_DIR):
+    """Returns the outcomes of the actions the account already executed. A
+    line that was only partly written when the run was killed is removed.
+    """
+    path = os.path.join(directory, f"{account}.jsonl")
+    if not os.path.isfile(path):
+        return []
+
+    recorded = []
+    valid = 0
+    with open(path) as fd:
+        for line in fd:
+            if not line.endswith("\n"):
+                break
+            try:
+                recorded.append(json.loads(line))
+            except ValueError:
+                break
+            valid += len(line.encode())
+
+    if valid < os.path.getsize(path):
+        os.truncate(path, valid)
+    return recorded
+
+
+def record(account, outcome, directory=JOURNAL_DIR):
+    """Appends the outcome of an action executed by the account. Every
+    account is executed by a single process, so they each get their own file.
+    """
+    if not exists(directory):
+        return
+    path = os.path.join(directory, f"{account}.jsonl")
+    with open(path, "a") as fd:
+        fd.write(f"{json.dumps(outcome, separators=(',', ':'))}\n")
+        fd.flush()
+        os.fsync(fd.fileno())
+
+
+def finish(directory=JOURNAL_DIR):
+    """Removes the journal of the finished run."""
+    shutil.rmtree(directory, ignore_errors=True)
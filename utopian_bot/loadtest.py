@@ -0,0 +1,976 @@
+"""
+End-to-end load test of the bots against simulated backends. A local
+stand-in for a Steem node (JSON-RPC content, votes, account history and
+broadcasts, with configurable latency and failure rates), the batch API and
+Watson is started and filled with generated contributions, review comments
+and trail votes, and `upvote_bot`, `unvote_bot` and `resteem_bot` are run
+against it, each in its own process with a stand-in for gspread. For every
+bot the throughput, the p50/p99 latency of each type of action and the peak
+memory are reported.
+
+    $ python utopian_bot/loadtest.py --contributions 20000 --comments 20000 \\
+        --trail-votes 20000 --latency 0.005 --failure-rate 0.01
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+CATEGORIES = ["ideas", "development", "bug-hunting", "translations",
+              "graphics", "analysis", "social", "documentation", "tutorials",
+              "video-tutorials", "copywriting", "blog", "anti-abuse",
+              "task-development", "iamutopian"]
+TRAILS = ["steemstem", "steemmakers", "mspwaves"]
+BOT_ACCOUNTS = ["utopian-io", "utopian.signup", "utopian.tasks"]
+BOTS = ("upvote", "unvote", "resteem")
+WORDS = ("science research data code open source project feature test "
+         "design release community review tutorial molecule chemistry "
+         "biology experiment analysis graph painting travel music").split()
+
+
+def sheet_titles(today=None):
+    """Returns the titles of the previous and current review worksheets, as
+    computed in `constants.py`.
+    """
+    today = today or date.today()
+    this_week = today - timedelta(days=(today.weekday() - 3) % 7)
+    last_week = this_week - timedelta(days=7)
+    next_week = this_week + timedelta(days=7)
+    return (f"Reviewed - {last_week:%b %-d} - {this_week:%b %-d}",
+            f"Reviewed - {this_week:%b %-d} - {next_week:%b %-d}")
+
+
+def generate(contributions, comments, trail_votes, seed=0):
+    """Returns a synthetic dataset with the given number of contributions,
+    review comments and trail votes.
+    """
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    posts = {}
+    history = {trail: [] for trail in TRAILS}
+
+    def text():
+        return " ".join(rng.choice(WORDS) for _ in range(rng.randint(40, 80)))
+
+    def add_post(author, permlink, category, created, parent=None):
+        posts[f"{author}/{permlink}"] = {
+            "id": len(posts) + 1,
+            "author": author,
+            "permlink": permlink,
+            "category": category,
+            "parent": parent,
+            "created": created.strftime(TIME_FORMAT),
+            "body": text(),
+            "beneficiaries": ([{"account": "utopian.pay", "weight": 500}]
+                              if rng.random() < 0.9 else []),
+            "active_votes": [],
+            "replies": [],
+            "reblogged_by": [],
+        }
+        if parent:
+            posts[parent]["replies"].append(f"{author}/{permlink}")
+
+    previous_title, current_title = sheet_titles()
+    header = ["Moderator", "Review date", "URL", "Repository", "Category",
+              "Score", "Staff pick", "Staff pick date", "Picked by",
+              "Review status", "Vote status", "Weight"]
+    sheets = {previous_title: [header], current_title: [header]}
+    fingerprints = {previous_title: [], current_title: []}
+    batch_contributions = []
+    urls = []
+
+    for index in range(contributions):
+        author = f"author{index % 5000}"
+        permlink = f"contribution-{index}"
+        category = rng.choice(CATEGORIES)
+        created = now - timedelta(hours=rng.uniform(1, 160))
+        add_post(author, permlink, category, created)
+        url = f"https://steemit.com/utopian-io/@{author}/{permlink}"
+        urls.append(url)
+        score = rng.choice([0, 10, 30, 50, 70, 90, 100])
+        title = current_title if created > now - timedelta(days=3) else \
+            previous_title
+
+        # Contributions that were scored 0 after being voted on, which
+        # unvote_bot has to unvote
+        unvote = score == 0 and rng.random() < 0.5
+        if unvote:
+            posts[f"{author}/{permlink}"]["active_votes"].append(
+                {"voter": "utopian.signup", "weight": 5000,
+                 "rshares": "1000000", "percent": 5000,
+                 "reputation": "0", "time": created.strftime(TIME_FORMAT)})
+        vote_status = "Yes" if unvote else "Pending"
+        sheets[title].append([
+            f"moderator{index % 50}", created.strftime("%Y-%m-%d %H:%M:%S"),
+            url, "https://github.com/utopian-io/utopian-bot", category,
+            str(score), "No", "", "", "Yes", vote_status, "0"])
+        fingerprints[title].append([url, str(30 if unvote else score),
+                                    vote_status])
+
+        if score > 0 and vote_status == "Pending":
+            batch_contributions.append({
+                "url": url,
+                "category": category,
+                "score": score,
+                "voting_weight": rng.uniform(5, 100),
+                "created": created.strftime(TIME_FORMAT),
+                "staff_picked": rng.random() < 0.05,
+            })
+
+    batch_comments = []
+    for index in range(comments):
+        moderator = f"moderator{index % 50}"
+        permlink = f"review-{index}"
+        parent = urls[index % len(urls)].split("@")[1] if urls else None
+        created = now - timedelta(hours=rng.uniform(1, 120))
+        category = posts[parent]["category"] if parent else "ideas"
+        add_post(moderator, permlink, category, created, parent)
+        batch_comments.append({
+            "moderator": moderator,
+            "comment_url": permlink,
+            "url": urls[index % len(urls)] if urls else "",
+            "category": category,
+            "review_date": created.strftime("%Y-%m-%d %H:%M:%S"),
+        })
+
+    for index in range(trail_votes):
+        trail = TRAILS[index % len(TRAILS)]
+        author = f"trailauthor{index % 2000}"
+        permlink = f"trail-post-{index}"
+        timestamp = now - timedelta(hours=rng.uniform(0, 60))
+        add_post(author, permlink, rng.choice(["stem", "science", "makers"]),
+                 timestamp)
+        history[trail].append({
+            "timestamp": timestamp.strftime(TIME_FORMAT),
+            "op": ["vote", {"voter": trail, "author": author,
+                            "permlink": permlink,
+                            "weight": rng.randint(1000, 10000)}],
+        })
+
+    for trail in TRAILS:
+        history[trail].sort(key=lambda x: x["timestamp"])
+
+    return {
+        "posts": posts,
+        "history": history,
+        "batch": {"contributions": batch_contributions,
+                  "comments": batch_comments},
+        "sheets": sheets,
+        "reviews": {"modified": "before the load test",
+                    "sheets": fingerprints},
+    }
+
+
+class FakeNode():
+    """In-memory Steem node answering the JSON-RPC calls the bots (through
+    beem) make, plus the batch API and Watson's analyze endpoint.
+    """
+    def __init__(self, dataset, public_key, latency=0.0,
+                 broadcast_latency=0.0, failure_rate=0.0, seed=0):
+        self.posts = dataset["posts"]
+        self.history = dataset["history"]
+        self.batch = dataset["batch"]
+        self.public_key = public_key
+        self.latency = latency
+        self.broadcast_latency = broadcast_latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.accounts = {}
+        self.calls = {}
+
+    def head_block_number(self):
+        return 30000000 + int((time.time() - self.started) / 3)
+
+    def now(self):
+        return datetime.utcnow().strftime(TIME_FORMAT)
+
+    def account(self, name):
+        """Returns the account with the given name, creating it on first
+        use.
+        """
+        if name not in self.accounts:
+            authority = {"weight_threshold": 1, "account_auths": [],
+                         "key_auths": [[self.public_key, 1]]}
+            self.accounts[name] = {
+                "id": len(self.accounts) + 1,
+                "name": name,
+                "owner": authority,
+                "active": authority,
+                "posting": authority,
+                "memo_key": self.public_key,
+                "json_metadata": "",
+                "proxy": "",
+                "created": "2018-01-01T00:00:00",
+                "last_vote_time": "2018-01-01T00:00:00",
+                "last_post": "2018-01-01T00:00:00",
+                "last_root_post": "2018-01-01T00:00:00",
+                "last_account_update": "2018-01-01T00:00:00",
+                "last_owner_update": "2018-01-01T00:00:00",
+                "next_vesting_withdrawal": "1969-12-31T23:59:59",
+                "voting_power": 10000,
+                "balance": "1000.000 STEEM",
+                "savings_balance": "0.000 STEEM",
+                "sbd_balance": "100.000 SBD",
+                "savings_sbd_balance": "0.000 SBD",
+                "reward_sbd_balance": "0.000 SBD",
+                "reward_steem_balance": "0.000 STEEM",
+                "reward_vesting_balance": "0.000000 VESTS",
+                "reward_vesting_steem": "0.000 STEEM",
+                "vesting_shares": "4000000000.000000 VESTS",
+                "delegated_vesting_shares": "0.000000 VESTS",
+                "received_vesting_shares": "0.000000 VESTS",
+                "vesting_withdraw_rate": "0.000000 VESTS",
+                "vesting_balance": "0.000 STEEM",
+                "to_withdraw": 0,
+                "withdrawn": 0,
+                "post_count": 0,
+                "reputation": "0",
+                "can_vote": True,
+                "proxied_vsf_votes": [0, 0, 0, 0],
+                "witness_votes": [],
+                "delegations": [],
+            }
+        return self.accounts[name]
+
+    def content(self, key):
+        """Returns the post with the given author/permlink as the node would,
+        or an empty post if it doesn't exist.
+        """
+        post = self.posts.get(key)
+        if not post:
+            return {"author": "", "permlink": "", "id": 0, "active_votes": []}
+
+        parent = self.posts.get(post["parent"]) if post["parent"] else None
+        created = post["created"]
+        cashout = (datetime.strptime(created, TIME_FORMAT) +
+                   timedelta(days=7)).strftime(TIME_FORMAT)
+        return {
+            "id": post["id"],
+            "author": post["author"],
+            "permlink": post["permlink"],
+            "category": post["category"],
+            "parent_author": parent["author"] if parent else "",
+            "parent_permlink": (parent["permlink"] if parent else
+                                post["category"]),
+            "title": "" if parent else f"Post {post['permlink']}",
+            "body": post["body"],
+            "json_metadata": json.dumps({"tags": [post["category"]]}),
+            "created": created,
+            "last_update": created,
+            "active": created,
+            "last_payout": "1970-01-01T00:00:00",
+            "cashout_time": cashout,
+            "max_cashout_time": "1969-12-31T23:59:59",
+            "depth": 1 if parent else 0,
+            "children": len(post["replies"]),
+            "net_rshares": 0,
+            "abs_rshares": 0,
+            "vote_rshares": 0,
+            "children_abs_rshares": 0,
+            "total_vote_weight": 0,
+            "reward_weight": 10000,
+            "author_rewards": 0,
+            "net_votes": len(post["active_votes"]),
+            "root_author": parent["author"] if parent else post["author"],
+            "root_permlink": (parent["permlink"] if parent else
+                              post["permlink"]),
+            "root_title": f"Post {post['permlink']}",
+            "url": f"/{post['category']}/@{post['author']}/"
+                   f"{post['permlink']}",
+            "total_payout_value": "0.000 SBD",
+            "curator_payout_value": "0.000 SBD",
+            "pending_payout_value": "0.000 SBD",
+            "total_pending_payout_value": "0.000 STEEM",
+            "promoted": "0.000 SBD",
+            "max_accepted_payout": "1000000.000 SBD",
+            "percent_steem_dollars": 10000,
+            "allow_replies": True,
+            "allow_votes": True,
+            "allow_curation_rewards": True,
+            "beneficiaries": post["beneficiaries"],
+            "active_votes": post["active_votes"],
+            "replies": [],
+            "reblogged_by": [],
+            "author_reputation": "0",
+            "body_length": len(post["body"]),
+        }
+
+    def dynamic_global_properties(self):
+        number = self.head_block_number()
+        return {
+            "id": 0,
+            "head_block_number": number,
+            "head_block_id": f"{number:08x}{'0' * 32}",
+            "time": self.now(),
+            "current_witness": "witness",
+            "total_pow": 0,
+            "num_pow_witnesses": 0,
+            "virtual_supply": "300000000.000 STEEM",
+            "current_supply": "280000000.000 STEEM",
+            "confidential_supply": "0.000 STEEM",
+            "current_sbd_supply": "15000000.000 SBD",
+            "confidential_sbd_supply": "0.000 SBD",
+            "total_vesting_fund_steem": "190000000.000 STEEM",
+            "total_vesting_shares": "385000000000.000000 VESTS",
+            "total_reward_fund_steem": "0.000 STEEM",
+            "total_reward_shares2": "0",
+            "pending_rewarded_vesting_shares": "0.000000 VESTS",
+            "pending_rewarded_vesting_steem": "0.000 STEEM",
+            "sbd_interest_rate": 0,
+            "sbd_print_rate": 10000,
+            "maximum_block_size": 65536,
+            "current_aslot": number,
+            "recent_slots_filled": "340282366920938463463374607431768211455",
+            "participation_count": 128,
+            "last_irreversible_block_num": number - 20,
+            "vote_power_reserve_rate": 10,
+            "delegation_return_period": 432000,
+            "reverse_auction_seconds": 1800,
+            "available_account_subsidies": 0,
+            "sbd_stop_percent": 1000,
+            "sbd_start_percent": 900,
+            "next_maintenance_time": self.now(),
+            "last_budget_time": self.now(),
+            "content_reward_percent": 7500,
+            "vesting_reward_percent": 1500,
+            "sps_fund_percent": 1000,
+            "sps_interval_ledger": "0.000 SBD",
+        }
+
+    def account_history(self, name, start, limit, *args):
+        operations = self.history.get(name, [])
+        if not operations:
+            return []
+        if start < 0 or start >= len(operations):
+            start = len(operations) - 1
+        first = max(0, start - limit)
+        return [[index, dict(operations[index], trx_id="0" * 40,
+                             block=30000000 + index, trx_in_block=0,
+                             op_in_trx=0, virtual_op=0)]
+                for index in range(first, start + 1)]
+
+    def apply(self, operation):
+        """Applies a broadcast operation to the node's state."""
+        if isinstance(operation, dict):
+            name = operation["type"].replace("_operation", "")
+            value = operation["value"]
+        else:
+            name, value = operation
+
+        if name == "vote":
+            post = self.posts.get(f"{value['author']}/{value['permlink']}")
+            if post is None:
+                raise ValueError("Post does not exist")
+            votes = [vote for vote in post["active_votes"]
+                     if vote["voter"] != value["voter"]]
+            votes.append({"voter": value["voter"],
+                          "weight": value["weight"],
+                          "rshares": str(value["weight"] * 1000),
+                          "percent": value["weight"], "reputation": "0",
+                          "time": self.now()})
+            post["active_votes"] = votes
+            voter = self.account(value["voter"])
+            used = voter["voting_power"] * abs(value["weight"]) // 500000
+            voter["voting_power"] = max(voter["voting_power"] - used, 0)
+            voter["last_vote_time"] = self.now()
+        elif name == "comment":
+            key = f"{value['author']}/{value['permlink']}"
+            parent = f"{value['parent_author']}/{value['parent_permlink']}"
+            if key not in self.posts:
+                self.posts[key] = {
+                    "id": len(self.posts) + 1,
+                    "author": value["author"],
+                    "permlink": value["permlink"],
+                    "category": value["parent_permlink"],
+                    "parent": parent if value["parent_author"] else None,
+                    "created": self.now(),
+                    "body": value["body"],
+                    "beneficiaries": [],
+                    "active_votes": [],
+                    "replies": [],
+                    "reblogged_by": [],
+                }
+                if parent in self.posts:
+                    self.posts[parent]["replies"].append(key)
+            else:
+                self.posts[key]["body"] = value["body"]
+        elif name == "custom_json":
+            data = json.loads(value["json"])
+            if data and data[0] == "reblog":
+                reblog = data[1]
+                post = self.posts.get(f"{reblog['author']}/"
+                                      f"{reblog['permlink']}")
+                if post is not None:
+                    post["reblogged_by"].append(reblog["account"])
+        elif name == "delegate_vesting_shares":
+            delegator = self.account(value["delegator"])
+            delegator["delegations"] = [
+                delegation for delegation in delegator["delegations"]
+                if delegation["delegatee"] != value["delegatee"]]
+
+    def broadcast(self, transaction, *args):
+        time.sleep(self.broadcast_latency)
+        with self.lock:
+            if self.random.random() < self.failure_rate:
+                raise ValueError("Simulated broadcast failure")
+            for operation in transaction["operations"]:
+                self.apply(operation)
+        return {"id": "0" * 40, "block_num": self.head_block_number(),
+                "trx_num": 0, "expired": False}
+
+    def rc_accounts(self, request):
+        names = request["accounts"] if isinstance(request, dict) else request
+        return {"rc_accounts": [{
+            "account": name,
+            "rc_manabar": {"current_mana": "1000000000000000",
+                           "last_update_time": int(time.time())},
+            "max_rc_creation_adjustment": "0.000000 VESTS",
+            "max_rc": "1000000000000000",
+        } for name in names]}
+
+    def state(self, path):
+        key = path.split("@", 1)[-1]
+        content = {}
+        if key in self.posts:
+            content[key] = self.content(key)
+            for reply in self.posts[key]["replies"]:
+                content[reply] = self.content(reply)
+        return {"content": content, "accounts": {}}
+
+    def methods(self):
+        price = {"base": "0.500 SBD", "quote": "1.000 STEEM"}
+        fund = {
+            "id": 0, "name": "post",
+            "reward_balance": "800000.000 STEEM",
+            "recent_claims": "500000000000000000",
+            "last_update": self.now(),
+            "content_constant": "2000000000000",
+            "percent_curation_rewards": 2500,
+            "percent_content_rewards": 10000,
+            "author_reward_curve": "linear",
+            "curation_reward_curve": "square_root",
+        }
+        return {
+            "get_config": lambda *args: {
+                "STEEM_CHAIN_ID": "0" * 64,
+                "STEEM_ADDRESS_PREFIX": "STM",
+                "STEEM_BLOCKCHAIN_VERSION": "0.20.5",
+                "STEEM_100_PERCENT": 10000,
+                "STEEM_1_PERCENT": 100,
+                "STEEM_VOTE_REGENERATION_SECONDS": 432000,
+                "STEEM_VOTE_DUST_THRESHOLD": 50000000,
+                "STEEM_UPVOTE_LOCKOUT_HF17": 43200,
+                "STEEM_REVERSE_AUCTION_WINDOW_SECONDS": 1800,
+                "STEEM_CONTENT_CONSTANT_HF0": "2000000000000",
+            },
+            "get_version": lambda *args: {
+                "blockchain_version": "0.20.5",
+                "steem_revision": "0" * 40,
+                "fc_revision": "0" * 40,
+            },
+            "get_hardfork_version": lambda *args: "0.20.0",
+            "get_hardfork_properties": lambda *args: {
+                "id": 0, "processed_hardforks": [],
+                "last_hardfork": 20,
+                "current_hardfork_version": "0.20.0",
+                "next_hardfork": "0.20.0",
+                "next_hardfork_time": "2018-09-25T15:00:00"},
+            "get_witness_schedule": lambda *args: {
+                "id": 0, "current_virtual_time": "0",
+                "next_shuffle_block_num": self.head_block_number() + 21,
+                "current_shuffled_witnesses": ["witness"],
+                "num_scheduled_witnesses": 1,
+                "median_props": {
+                    "account_creation_fee": "3.000 STEEM",
+                    "maximum_block_size": 65536,
+                    "sbd_interest_rate": 0},
+                "majority_version": "0.20.5"},
+            "get_dynamic_global_properties":
+                lambda *args: self.dynamic_global_properties(),
+            "get_chain_properties": lambda *args: {
+                "account_creation_fee": "3.000 STEEM",
+                "maximum_block_size": 65536,
+                "sbd_interest_rate": 0,
+            },
+            "get_reward_fund": lambda *args: fund,
+            "get_reward_funds": lambda *args: {"funds": [fund]},
+            "get_current_median_history_price": lambda *args: price,
+            "get_feed_history": lambda *args: {
+                "id": 0, "current_median_history": price,
+                "price_history": [price]},
+            "get_accounts": lambda names, *args: [
+                self.account(name) for name in names],
+            "lookup_account_names": lambda names, *args: [
+                self.account(name) for name in names],
+            "get_content": lambda author, permlink, *args: self.content(
+                f"{author}/{permlink}"),
+            "get_content_replies": lambda author, permlink, *args: [
+                self.content(reply) for reply in self.posts.get(
+                    f"{author}/{permlink}", {"replies": []})["replies"]],
+            "get_active_votes": lambda author, permlink, *args: self.posts.get(
+                f"{author}/{permlink}", {"active_votes": []})["active_votes"],
+            "get_reblogged_by": lambda author, permlink, *args: [author] + (
+                self.posts.get(f"{author}/{permlink}", {"reblogged_by": []})
+                ["reblogged_by"]),
+            "get_account_history": self.account_history,
+            "get_state": lambda path, *args: self.state(path),
+            "get_vesting_delegations": lambda name, *args: self.account(
+                name)["delegations"],
+            "find_rc_accounts": self.rc_accounts,
+            "get_block_header": lambda number, *args: {
+                "previous": f"{number - 1:08x}{'0' * 32}",
+                "timestamp": self.now(), "witness": "witness",
+                "transaction_merkle_root": "0" * 40, "extensions": []},
+            "get_block": lambda number, *args: {
+                "previous": f"{number - 1:08x}{'0' * 32}",
+                "timestamp": self.now(), "witness": "witness",
+                "transaction_merkle_root": "0" * 40, "extensions": [],
+                "transactions": [], "block_id": f"{number:08x}{'0' * 32}",
+                "transaction_ids": []},
+            "get_transaction_hex": lambda *args: "",
+            "get_required_signatures": lambda *args: [self.public_key],
+            "get_potential_signatures": lambda *args: [self.public_key],
+            "verify_authority": lambda *args: True,
+            "broadcast_transaction": self.broadcast,
+            "broadcast_transaction_synchronous": self.broadcast,
+        }
+
+    def appbase_methods(self):
+        """Returns the handlers of the appbase calls, which take their
+        parameters as a single object and which beem makes instead of the
+        condenser ones once the node reports an appbase version.
+        """
+        def replies(request):
+            key = f"{request['author']}/{request['permlink']}"
+            return [self.content(reply) for reply in self.posts.get(
+                key, {"replies": []})["replies"]]
+
+        return {
+            "database_api.find_accounts": lambda request: {
+                "accounts": [self.account(name)
+                             for name in request["accounts"]]},
+            "tags_api.get_discussion": lambda request: self.content(
+                f"{request['author']}/{request['permlink']}"),
+            "tags_api.get_content_replies": lambda request: {
+                "discussions": replies(request)},
+            "tags_api.get_active_votes": lambda request: {
+                "votes": self.posts.get(
+                    f"{request['author']}/{request['permlink']}",
+                    {"active_votes": []})["active_votes"]},
+            "follow_api.get_reblogged_by": lambda request: {
+                "accounts": [request["author"]] + self.posts.get(
+                    f"{request['author']}/{request['permlink']}",
+                    {"reblogged_by": []})["reblogged_by"]},
+            "account_history_api.get_account_history": lambda request: {
+                "history": self.account_history(
+                    request["account"], request["start"],
+                    request["limit"])},
+            "database_api.find_vesting_delegations": lambda request: {
+                "delegations": self.account(
+                    request["account"])["delegations"]},
+            "database_api.get_transaction_hex": lambda request: {
+                "hex": ""},
+            "database_api.get_required_signatures": lambda request: {
+                "keys": [self.public_key]},
+            "database_api.get_potential_signatures": lambda request: {
+                "keys": [self.public_key]},
+            "database_api.verify_authority": lambda request: {
+                "valid": True},
+            "network_broadcast_api.broadcast_transaction":
+                lambda request: self.broadcast(request["trx"]),
+        }
+
+    def call(self, request):
+        """Returns the JSON-RPC response to a single request. Both the
+        `call` form and `api.method` names are accepted, with the parameters
+        of appbase calls given as an object.
+        """
+        method = request.get("method", "")
+        params = request.get("params", [])
+        if method == "call":
+            api, method, params = params
+        else:
+            api, _, method = method.rpartition(".")
+
+        handler = None
+        if isinstance(params, dict):
+            name = f"{api}.{method}"
+            handler = self.appbase_methods().get(name)
+            params = [params]
+        if handler is None:
+            name = method
+            handler = self.methods().get(method)
+
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+        response = {"jsonrpc": "2.0", "id": request.get("id", 0)}
+        if handler is None:
+            response["error"] = {"code": -32601,
+                                 "message": f"Unknown method: {name}"}
+            return response
+
+        time.sleep(self.latency)
+        try:
+            if method.startswith("broadcast"):
+                response["result"] = handler(*params)
+            else:
+                with self.lock:
+                    response["result"] = handler(*params)
+        except Exception as error:
+            response["error"] = {"code": -32000, "message": str(error)}
+        return response
+
+    def analyze(self, request):
+        """Returns a Watson-like classification of the text."""
+        digest = hashlib.md5(request.get("text", "").encode()).digest()
+        score = digest[0] / 255.0
+        label = ("/science/chemistry" if digest[1] % 2 else
+                 "/art and entertainment")
+        return {"categories": [{"label": label, "score": score}],
+                "language": "en"}
+
+
+class NodeRequestHandler(BaseHTTPRequestHandler):
+    node = None
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path.endswith("/contributions"):
+            self.reply(self.node.batch["contributions"])
+        elif path.endswith("/comments"):
+            self.reply(self.node.batch["comments"])
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if urlparse(self.path).path.endswith("/analyze"):
+            self.reply(self.node.analyze(request))
+        elif isinstance(request, list):
+            self.reply([self.node.call(item) for item in request])
+        else:
+            self.reply(self.node.call(request))
+
+
+def serve(node, port=0):
+    """Serves the node on a background thread and returns its URL."""
+    handler = type("Handler", (NodeRequestHandler,), {"node": node})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+class FakeResponse():
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+def column_index(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter.upper()) - ord("A") + 1
+    return index
+
+
+class FakeWorksheet():
+    """Stand-in for a gspread worksheet holding its rows in memory."""
+    def __init__(self, client, title, rows):
+        self.client = client
+        self.title = title
+        self.rows = rows
+
+    def get_all_values(self):
+        self.client.wait()
+        return [list(row) for row in self.rows]
+
+    def col_values(self, col):
+        self.client.wait()
+        values = [row[col - 1] if len(row) >= col else ""
+                  for row in self.rows]
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    def row_values(self, row):
+        self.client.wait()
+        return list(self.rows[row - 1]) if row <= len(self.rows) else []
+
+    def update_cell(self, row, col, value):
+        self.client.wait()
+        while len(self.rows) < row:
+            self.rows.append([])
+        cells = self.rows[row - 1]
+        while len(cells) < col:
+            cells.append("")
+        cells[col - 1] = str(value)
+        self.client.modified = datetime.utcnow().isoformat()
+
+    def update_cells(self, cells):
+        latency, self.client.latency = self.client.latency, 0.0
+        try:
+            for cell in cells:
+                self.update_cell(cell.row, cell.col, cell.value)
+        finally:
+            self.client.latency = latency
+        self.client.wait()
+
+
+class FakeSpreadsheet():
+    """Stand-in for a gspread spreadsheet."""
+    def __init__(self, client, sheets):
+        self.id = "loadtest"
+        self.client = client
+        self.worksheets = {title: FakeWorksheet(client, title, rows)
+                           for title, rows in sheets.items()}
+
+    def worksheet(self, title):
+        return self.worksheets[title]
+
+    def values_get(self, range_name):
+        self.client.wait()
+        match = re.match(r"'(.+)'!([A-Z]+)(\d*):([A-Z]+)(\d*)", range_name)
+        title, first_col, first_row, last_col, last_row = match.groups()
+        rows = self.worksheets[title].rows
+        first_row = int(first_row or 1)
+        last_row = int(last_row or len(rows))
+        first_col, last_col = column_index(first_col), column_index(last_col)
+        return {"range": range_name,
+                "values": [row[first_col - 1:last_col]
+                           for row in rows[first_row - 1:last_row]]}
+
+
+class FakeClient():
+    """Stand-in for an authorised gspread client, loading the worksheets
+    from a JSON file and keeping all changes in memory. Every call waits
+    `FAKE_SHEETS_LATENCY` seconds.
+    """
+    def __init__(self, path):
+        with open(path) as fd:
+            sheets = json.load(fd)
+        self.latency = float(os.environ.get("FAKE_SHEETS_LATENCY", 0))
+        self.modified = datetime.utcnow().isoformat()
+        self.spreadsheet = FakeSpreadsheet(self, sheets)
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def open(self, title):
+        self.wait()
+        return self.spreadsheet
+
+    def request(self, method, endpoint, params=None, **kwargs):
+        self.wait()
+        return FakeResponse({"modifiedTime": self.modified})
+
+
+def timed(function, samples, action):
+    """Wraps the function so the duration of every call is recorded."""
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            samples.append((action, time.perf_counter() - start))
+    return wrapper
+
+
+def time_tasks(module, samples):
+    """Wraps the functions executing the module's tasks of the work queue so
+    the duration of every task is recorded.
+    """
+    import work_queue
+    for kind in module.QUEUE_TASKS:
+        _, function = work_queue.HANDLERS[kind].split(":")
+        setattr(module, function, timed(getattr(module, function), samples,
+                                        kind))
+
+
+def use_fake_sheets(path):
+    """Makes gspread hand out a `FakeClient` with the worksheets stored at the
+    given path. The bots open their worksheets as soon as they are imported,
+    so this has to be called before importing them.
+    """
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
+
+    ServiceAccountCredentials.from_json_keyfile_name = staticmethod(
+        lambda *args, **kwargs: None)
+    gspread.authorize = lambda credentials: FakeClient(path)
+
+
+def run_bot(bot, samples_path):
+    """Runs the bot in this process, timing each of its actions and the tasks
+    it leaves to the work queue, and writes the samples to the given path.
+    """
+    use_fake_sheets(os.environ["FAKE_SHEETS"])
+    samples = []
+    if bot == "upvote":
+        import upvote_bot
+        for action, handler in list(upvote_bot.ACTION_HANDLERS.items()):
+            upvote_bot.ACTION_HANDLERS[action] = timed(handler, samples,
+                                                       action)
+        time_tasks(upvote_bot, samples)
+        run = upvote_bot.main
+    elif bot == "unvote":
+        import unvote_bot
+        time_tasks(unvote_bot, samples)
+        run = unvote_bot.main
+    else:
+        import resteem_bot
+        time_tasks(resteem_bot, samples)
+        run = resteem_bot.main
+
+    start = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - start
+
+    with open(samples_path, "w") as fd:
+        json.dump({"elapsed": elapsed, "samples": samples}, fd)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def summarise(bot, result, max_rss):
+    """Returns the report lines of a bot's run."""
+    samples = result["samples"]
+    elapsed = result["elapsed"]
+    lines = [f"{bot}: {len(samples)} actions in {elapsed:.1f}s "
+             f"({len(samples) / elapsed if elapsed else 0:.1f}/s), "
+             f"peak memory {max_rss / 1024:.1f} MiB"]
+    actions = {}
+    for action, duration in samples:
+        actions.setdefault(action, []).append(duration)
+    for action, durations in sorted(actions.items()):
+        lines.append(f"    {action}: {len(durations)}, "
+                     f"p50 {percentile(durations, 0.5) * 1000:.1f}ms, "
+                     f"p99 {percentile(durations, 0.99) * 1000:.1f}ms")
+    return lines
+
+
+def main(contributions, comments, trail_votes, latency, broadcast_latency,
+         failure_rate, sheets_latency, bots, seed=0):
+    """Generates a synthetic dataset, serves it from a simulated node and
+    runs the bots against it, reporting their throughput, per-action
+    latency and peak memory.
+    """
+    from beemgraphenebase.account import PrivateKey
+
+    key = PrivateKey()
+    workdir = tempfile.mkdtemp(prefix="utopian-loadtest-")
+    dataset = generate(contributions, comments, trail_votes, seed)
+
+    sheets_path = os.path.join(workdir, "sheets.json")
+    with open(sheets_path, "w") as fd:
+        json.dump(dataset["sheets"], fd)
+    reviews_path = os.path.join(workdir, "reviews.json")
+    with open(reviews_path, "w") as fd:
+        json.dump(dataset["reviews"], fd)
+
+    node = FakeNode(dataset, format(key.pubkey, "STM"), latency,
+                    broadcast_latency, failure_rate, seed)
+    url = serve(node)
+    print(f"Serving {len(dataset['posts'])} posts at {url} ({workdir})")
+
+    environment = dict(
+        os.environ,
+        STEEM_NODE=url,
+        STEEM_KEYS=str(key),
+        FAKE_SHEETS=sheets_path,
+        FAKE_SHEETS_LATENCY=str(sheets_latency),
+        CONTRIBUTION_BATCH=f"{url}/api/batch/contributions",
+        COMMENT_BATCH=f"{url}/api/batch/comments",
+        WATSON_URL=url,
+        WATSON_USERNAME=os.environ.get("WATSON_USERNAME", "loadtest"),
+        WATSON_PASSWORD=os.environ.get("WATSON_PASSWORD", "loadtest"),
+        VOTE_INTERVAL="0",
+        DATABASE_PATH=os.path.join(workdir, "utopian-io.db"),
+        ARCHIVE_DIR=os.path.join(workdir, "archive"),
+        JOURNAL_DIR=os.path.join(workdir, "journal"),
+        RC_DIR=os.path.join(workdir, "rc"),
+        QUEUE_PATH=os.path.join(workdir, "queue.db"),
+        # Drain the queue inside the bots, so their actions are timed
+        QUEUE_WORKERS="0",
+        METRICS_DIR=workdir,
+        LOG_FILE=os.path.join(workdir, "bot.log"),
+        REVIEWS_PATH=reviews_path,
+    )
+
+    report = []
+    for bot in bots:
+        samples_path = os.path.join(workdir, f"{bot}-samples.json")
+        process = subprocess.Popen(
+            [sys.executable, os.path.realpath(__file__), "--child", bot,
+             "--samples", samples_path], env=environment, cwd=DIR_PATH)
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = status
+        if status or not os.path.exists(samples_path):
+            report.append(f"{bot}: failed with status {status}")
+            continue
+        with open(samples_path) as fd:
+            report.extend(summarise(bot, json.load(fd), usage.ru_maxrss))
+
+    calls = sorted(node.calls.items(), key=lambda x: x[1], reverse=True)
+    report.append("node calls: " + ", ".join(f"{method} {count}"
+                                             for method, count in calls))
+    print("\n".join(report))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--contributions", type=int, default=10000)
+    parser.add_argument("--comments", type=int, default=10000)
+    parser.add_argument("--trail-votes", type=int, default=10000)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds every RPC call takes")
+    parser.add_argument("--broadcast-latency", type=float, default=0.0,
+                        help="seconds every broadcast takes")
+    parser.add_argument("--failure-rate", type=float, default=0.0,
+                        help="fraction of broadcasts that fail")
+    parser.add_argument("--sheets-latency", type=float, default=0.0,
+                        help="seconds every Sheets call takes")
+    parser.add_argument("--bots", nargs="+", choices=BOTS, default=BOTS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--child", choices=BOTS, help=argparse.SUPPRESS)
+    parser.add_argument("--samples", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_bot(args.child, args.samples)
+    else:
+        main(args.contributions, args.comments, args.trail_votes,
+             args.latency, args.broadcast_latency, args.failure_rate,
+             args.sheets_latency, args.bots, args.seed)
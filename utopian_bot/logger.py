@@ -0,0 +1,166 @@
+"""
+Shared logging setup for all bots. Records are put on an in-memory queue by
+the bot and written to a rotating `bot.log` by a background thread, so the
+voting loop never waits on disk writes.
+
+Only the bot's own process writes (and rotates) the log file. Its worker
+processes send their records to it through a pipe instead: forked workers
+switch over as soon as they are forked, and spawned workers (e.g. of the work
+queue) `attach` to the pipe they are handed.
+"""
+
+import atexit
+import logging
+import multiprocessing
+import os
+import queue
+from logging.handlers import (QueueHandler, QueueListener,
+                              RotatingFileHandler, TimedRotatingFileHandler)
+
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+LOG_FILE = os.environ.get("LOG_FILE", f"{DIR_PATH}/bot.log")
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# Rotate once the log reaches this size, unless LOG_ROTATE_WHEN is set, in
+# which case it is rotated on time instead (e.g. "midnight" or "W3").
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_ROTATE_WHEN = os.environ.get("LOG_ROTATE_WHEN")
+LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", 5))
+# Set for processes that never write the log file themselves. Processes
+# spawned by the bots (e.g. the work queue's workers) never do either: their
+# name is set before they import anything, so they are told apart by it.
+LOG_WORKER = bool(os.environ.get("LOG_WORKER")) or \
+    multiprocessing.current_process().name != "MainProcess"
+FORMATTER = logging.Formatter(
+    "%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+
+class SharedQueueHandler(QueueHandler):
+    """Queue handler putting the records on the in-memory queue of this
+    process's writer or, in a worker process, straight on the pipe to the
+    parent's writer, so none are lost when the worker is terminated.
+    """
+    def enqueue(self, record):
+        self.queue.put(record)
+
+
+class ProcessQueueListener(QueueListener):
+    """Listener draining the records the worker processes send through a
+    `multiprocessing.SimpleQueue`.
+    """
+    def dequeue(self, block):
+        return self.queue.get()
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+# Handler shared by every logger
+_HANDLER = SharedQueueHandler(queue.Queue(-1))
+_STATE = {"process_queue": None, "file_handler": None, "listeners": [],
+          "worker": LOG_WORKER}
+
+
+def file_handler():
+    """Returns the handler that writes to the rotating log file."""
+    if LOG_ROTATE_WHEN:
+        handler = TimedRotatingFileHandler(LOG_FILE, when=LOG_ROTATE_WHEN,
+                                           backupCount=LOG_BACKUP_COUNT)
+    else:
+        handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES,
+                                      backupCount=LOG_BACKUP_COUNT)
+    handler.setLevel(logging.DEBUG)
+    handler.setFormatter(FORMATTER)
+    return handler
+
+
+def process_queue():
+    """Returns the queue worker processes send their records through. It's
+    made for spawned workers, and forked ones simply inherit it.
+    """
+    if _STATE["process_queue"] is None:
+        _STATE["process_queue"] = multiprocessing.get_context(
+            "spawn").SimpleQueue()
+    return _STATE["process_queue"]
+
+
+def start_listeners():
+    """Starts the background writers draining the records of this process
+    and of its workers into the log file, which only they write to.
+    """
+    if _STATE["worker"] or _STATE["listeners"]:
+        return
+    if _STATE["file_handler"] is None:
+        _STATE["file_handler"] = file_handler()
+    handler = _STATE["file_handler"]
+    _STATE["listeners"] = [
+        QueueListener(_HANDLER.queue, handler, respect_handler_level=True),
+        ProcessQueueListener(process_queue(), handler,
+                             respect_handler_level=True),
+    ]
+    for listener in _STATE["listeners"]:
+        listener.start()
+
+
+def get_logger(name="utopian-io"):
+    """Returns the logger with the given name, attaching the shared queue
+    handler and starting the background writers the first time a logger is
+    requested.
+    """
+    logger = logging.getLogger(name)
+    if _HANDLER not in logger.handlers:
+        logger.setLevel(LOG_LEVEL)
+        logger.addHandler(_HANDLER)
+    start_listeners()
+    return logger
+
+
+def stop_listeners():
+    """Flushes all queued records to the log file."""
+    for listener in _STATE["listeners"]:
+        listener.stop()
+    _STATE["listeners"] = []
+
+
+def attach(records):
+    """Makes this spawned worker process send its records, including the
+    ones logged so far, through the given queue of its parent.
+    """
+    _STATE["worker"] = True
+    buffered, _HANDLER.queue = _HANDLER.queue, records
+    while not buffered.empty():
+        records.put(buffered.get_nowait())
+
+
+def after_fork():
+    """Background threads do not survive a fork, so a forked worker process
+    sends its records to the parent's writers instead. The records still
+    queued in this process are the parent's and are written by it.
+    """
+    if _STATE["worker"] or _STATE["process_queue"] is None:
+        return
+    _STATE["worker"] = True
+    _STATE["listeners"] = []
+    _STATE["file_handler"] = None
+    _HANDLER.queue = _STATE["process_queue"]
+
+
+def flush():
+    """Waits until all queued records have been written to the log file.
+    Workers write their records to the pipe right away.
+    """
+    if _STATE["worker"]:
+        return
+    stop_listeners()
+    start_listeners()
+
+
+atexit.register(stop_listeners)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=after_fork)
+
+
+def enabled_for(logger, level=logging.INFO):
+    """Returns True if a record of the given level would actually be emitted,
+    so callers can skip building expensive messages.
+    """
+    return logger.isEnabledFor(level)
@@ -0,0 +1,339 @@
+"""
+Collects metrics about a bot run (stage durations, RPC, Sheets and Watson
+calls, broadcasts and voting power spent) and exports them in the Prometheus
+text exposition format, either to a file that can be picked up by the node
+exporter's textfile collector or through a small local HTTP endpoint.
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import profiling
+
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+METRICS_DIR = os.environ.get("METRICS_DIR", DIR_PATH)
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+           60.0, 300.0, 900.0)
+
+DESCRIPTIONS = {
+    "utopian_stage_duration_seconds": (
+        "histogram", "Time spent in each stage of a bot run."),
+    "utopian_stage_failures_total": (
+        "counter", "Number of stages that raised an exception."),
+    "utopian_rpc_calls_total": (
+        "counter", "Number of RPC calls made to the Steem node."),
+    "utopian_rpc_errors_total": (
+        "counter", "Number of RPC calls that raised an exception."),
+    "utopian_rpc_latency_seconds": (
+        "histogram", "Latency of RPC calls made to the Steem node."),
+    "utopian_history_operations_total": (
+        "counter", "Account history operations downloaded, by whether the "
+                   "node filtered them by type."),
+    "utopian_sheets_calls_total": (
+        "counter", "Number of calls made to the Google Sheets API."),
+    "utopian_sheets_latency_seconds": (
+        "histogram", "Latency of calls made to the Google Sheets API."),
+    "utopian_watson_calls_total": (
+        "counter", "Number of calls made to Watson NLU."),
+    "utopian_watson_latency_seconds": (
+        "histogram", "Latency of calls made to Watson NLU."),
+    "utopian_cache_requests_total": (
+        "counter", "Lookups of chain globals and account snapshots, by "
+                   "whether they were cached."),
+    "utopian_classifier_decisions_total": (
+        "counter", "Trail contributions accepted or rejected locally, "
+                   "decided by Watson before, or sent to Watson."),
+    "utopian_validation_rejections_total": (
+        "counter", "Contributions of the batch rejected by each check."),
+    "utopian_action_duration_seconds": (
+        "histogram", "Time spent executing each action of a vote plan."),
+    "utopian_expired_actions_total": (
+        "counter", "Actions skipped because they could no longer be voted "
+                   "on before their cutoff."),
+    "utopian_queue_tasks_total": (
+        "counter", "Tasks of the work queue enqueued, done, retried or "
+                   "dead-lettered."),
+    "utopian_queue_task_duration_seconds": (
+        "histogram", "Time spent executing each task of the work queue."),
+    "utopian_broadcasts_total": (
+        "counter", "Number of operations broadcast to the blockchain."),
+    "utopian_votes_total": (
+        "counter", "Number of votes broadcast."),
+    "utopian_vp_spent_percent_total": (
+        "counter", "Estimated voting power spent on votes."),
+    "utopian_voting_power_percent": (
+        "gauge", "Voting power of the account at the start of the run."),
+    "utopian_trail_queue_length": (
+        "gauge", "Number of trail contributions waiting for voting power."),
+    "utopian_last_run_timestamp_seconds": (
+        "gauge", "Unix time at which the metrics were last exported."),
+}
+
+_LOCK = threading.Lock()
+_BOT = {"name": "bot"}
+_COUNTERS = {}
+_GAUGES = {}
+_HISTOGRAMS = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def set_bot(name):
+    """Sets the name of the bot, which is added as a label to every metric
+    and used for the name of the exported file.
+    """
+    _BOT["name"] = name
+
+
+def reset():
+    """Clears all collected metrics, e.g. in a freshly forked worker."""
+    with _LOCK:
+        _COUNTERS.clear()
+        _GAUGES.clear()
+        _HISTOGRAMS.clear()
+
+
+def inc(name, value=1.0, **labels):
+    """Increments the counter with the given name and labels."""
+    key = _key(name, labels)
+    with _LOCK:
+        _COUNTERS[key] = _COUNTERS.get(key, 0.0) + value
+
+
+def set_gauge(name, value, **labels):
+    """Sets the gauge with the given name and labels."""
+    with _LOCK:
+        _GAUGES[_key(name, labels)] = value
+
+
+def observe(name, value, **labels):
+    """Adds an observation to the histogram with the given name and labels."""
+    key = _key(name, labels)
+    with _LOCK:
+        histogram = _HISTOGRAMS.setdefault(key, [0] * len(BUCKETS) + [0.0, 0])
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram[index] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+
+@contextmanager
+def stage(name):
+    """Times the enclosed block as a stage of the bot run, and profiles it
+    when profiling is enabled.
+    """
+    start = time.perf_counter()
+    try:
+        with profiling.span(name):
+            yield
+    except Exception:
+        inc("utopian_stage_failures_total", stage=name)
+        raise
+    finally:
+        observe("utopian_stage_duration_seconds",
+                time.perf_counter() - start, stage=name)
+
+
+def timed(name):
+    """Decorator that times every call of the function as the given stage."""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def watson_call():
+    """Counts and times the enclosed call to Watson NLU."""
+    start = time.perf_counter()
+    inc("utopian_watson_calls_total")
+    try:
+        yield
+    finally:
+        observe("utopian_watson_latency_seconds", time.perf_counter() - start)
+
+
+def record_broadcast(operation):
+    """Counts an operation (vote, comment, resteem etc.) that was broadcast."""
+    inc("utopian_broadcasts_total", op=operation)
+
+
+def record_vote(vote_type, voting_weight, voting_power):
+    """Counts a vote of the given type (comment, contribution or trail) and the
+    voting power it is estimated to have used.
+    """
+    record_broadcast("vote")
+    inc("utopian_votes_total", type=vote_type)
+    inc("utopian_vp_spent_percent_total",
+        voting_weight / 100.0 * 0.02 * voting_power, type=vote_type)
+
+
+def _rpc_method(payload):
+    """Returns the name of the API method called in the given payload."""
+    if isinstance(payload, list):
+        return "batch"
+    method = payload.get("method", "unknown")
+    params = payload.get("params")
+    if method == "call" and isinstance(params, list) and len(params) > 1:
+        return f"{params[0]}.{params[1]}"
+    return method
+
+
+def instrument_rpc():
+    """Wraps beem's RPC class so every call made to a node is counted and
+    timed per method.
+    """
+    from beemapi.graphenerpc import GrapheneRPC
+
+    rpcexec = GrapheneRPC.rpcexec
+    if getattr(rpcexec, "instrumented", False):
+        return
+
+    @wraps(rpcexec)
+    def wrapper(self, payload, *args, **kwargs):
+        method = _rpc_method(payload)
+        start = time.perf_counter()
+        inc("utopian_rpc_calls_total", method=method)
+        try:
+            return rpcexec(self, payload, *args, **kwargs)
+        except Exception:
+            inc("utopian_rpc_errors_total", method=method)
+            raise
+        finally:
+            observe("utopian_rpc_latency_seconds",
+                    time.perf_counter() - start, method=method)
+
+    wrapper.instrumented = True
+    GrapheneRPC.rpcexec = wrapper
+
+
+def instrument_sheets():
+    """Wraps gspread's client so every request made to the Sheets API is
+    counted and timed per HTTP method. Nothing is counted if the installed
+    gspread doesn't make its requests through a `request` method.
+    """
+    import gspread
+
+    # Newer gspread releases make the requests with a separate HTTP client
+    client = gspread.Client
+    if not hasattr(client, "request"):
+        try:
+            from gspread.http_client import HTTPClient as client
+        except ImportError:
+            return
+        if not hasattr(client, "request"):
+            return
+
+    request = client.request
+    if getattr(request, "instrumented", False):
+        return
+
+    @wraps(request)
+    def wrapper(self, method, *args, **kwargs):
+        start = time.perf_counter()
+        inc("utopian_sheets_calls_total", method=method.upper())
+        try:
+            return request(self, method, *args, **kwargs)
+        finally:
+            observe("utopian_sheets_latency_seconds",
+                    time.perf_counter() - start, method=method.upper())
+
+    wrapper.instrumented = True
+    client.request = wrapper
+
+
+def _labels(labels, extra=()):
+    labels = (("bot", _BOT["name"]),) + labels + extra
+    rendered = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\")
+                         .replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels)
+    return "{" + rendered + "}"
+
+
+def render():
+    """Returns all metrics in the Prometheus text exposition format."""
+    set_gauge("utopian_last_run_timestamp_seconds", time.time())
+
+    with _LOCK:
+        samples = {}
+        for (name, labels), value in _COUNTERS.items():
+            samples.setdefault(name, []).append(
+                f"{name}{_labels(labels)} {value}")
+        for (name, labels), value in _GAUGES.items():
+            samples.setdefault(name, []).append(
+                f"{name}{_labels(labels)} {value}")
+        for (name, labels), histogram in _HISTOGRAMS.items():
+            lines = samples.setdefault(name, [])
+            for bound, count in zip(BUCKETS, histogram):
+                le = (("le", bound),)
+                lines.append(f"{name}_bucket{_labels(labels, le)} {count}")
+            le = (("le", "+Inf"),)
+            lines.append(f"{name}_bucket{_labels(labels, le)} {histogram[-1]}")
+            lines.append(f"{name}_sum{_labels(labels)} {histogram[-2]}")
+            lines.append(f"{name}_count{_labels(labels)} {histogram[-1]}")
+
+    output = []
+    for name in sorted(samples):
+        metric_type, description = DESCRIPTIONS.get(name, ("untyped", name))
+        output.append(f"# HELP {name} {description}")
+        output.append(f"# TYPE {name} {metric_type}")
+        output.extend(samples[name])
+
+    return "\n".join(output) + "\n"
+
+
+def export(directory=METRICS_DIR):
+    """Atomically writes all metrics to `utopian_<bot>.prom` in the given
+    directory.
+    """
+    path = os.path.join(directory, f"utopian_{_BOT['name']}.prom")
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "w") as fd:
+        fd.write(render())
+    os.replace(temporary, path)
+    return path
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=METRICS_PORT, address="127.0.0.1"):
+    """Serves the metrics on a local HTTP endpoint in a background thread for
+    as long as the bot is running.
+    """
+    server = HTTPServer((address, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def start(bot_name):
+    """Prepares metric collection for the bot with the given name."""
+    set_bot(bot_name)
+    instrument_rpc()
+    instrument_sheets()
+    if METRICS_PORT:
+        serve(METRICS_PORT)
@@ -0,0 +1,761 @@
+"""
+Computes how the voting power of a batch run is allocated and turns it into a
+vote plan: the ordered list of every comment, contribution and trail action
+with its voting weight and expected voting power usage. Planning works on
+prefetched inputs only and has no side effects, so plans can be written to a
+file, checked, diffed and benchmarked before `upvote_bot` executes them.
+"""
+
+import json
+import logging
+import math
+import os
+import time
+from operator import itemgetter
+
+import numpy as np
+from prettytable import PrettyTable
+
+from constants import (CATEGORY_WEIGHTING, LOGGER, LOGGING, MODERATION_REWARD,
+                       TRAIL_VP_FLOOR, VP_COMMENTS, VP_TOTAL)
+from logger import enabled_for
+import metrics
+
+# Steps of the bisection searching the trail multiplier
+BISECTION_STEPS = 40
+
+
+def log_tables():
+    """Returns True if the tables will actually be emitted, so they are only
+    rendered when needed.
+    """
+    return LOGGING and enabled_for(LOGGER, logging.INFO)
+
+
+def comment_weights_table(comment_weights):
+    """Prints a table containing the voting weight for comments made by
+    moderators in each category.
+    """
+    table = PrettyTable()
+    table.title = "COMMENT WEIGHTS"
+    table.field_names = ["Category", "Weight"]
+
+    for category, weight in sorted(comment_weights.items()):
+        table.add_row([category, f"{weight:.2f}%"])
+
+    table.align["Category"] = "l"
+    table.align["Weight"] = "r"
+
+    LOGGER.info(f"\n{table}")
+
+
+def get_comment_weights(voting_value, moderation_reward=MODERATION_REWARD):
+    """Returns a dictionary containing the key, value pair of the category and
+    the voting weight needed upvote a review comment with each category's point
+    equivalence in STU, given the value (in SBD) of a full vote.
+    """
+    comment_weights = {
+        category: 100.0 * points / voting_value for
+        category, points in moderation_reward.items()
+    }
+
+    if log_tables():
+        comment_weights_table(comment_weights)
+
+    return comment_weights
+
+
+def update_weights(comment_weights, comment_usage, vp_comments=VP_COMMENTS):
+    """Updates the weights used to upvote comments so that the actual voting
+    power usage is equal to the estimated usage.
+    """
+    desired_usage = 1.0 - vp_comments / 100.0
+    actual_usage = 1.0 - comment_usage / 100.0
+    scaler = np.log(desired_usage) / np.log(actual_usage)
+
+    for category in comment_weights.keys():
+        comment_weights[category] *= scaler
+
+    return comment_weights
+
+
+def voting_power_usage_table(comment_vp, contribution_vp):
+    """Prints a table containing the voting power usage of all comments and all
+    contributions.
+    """
+    table = PrettyTable()
+    table.title = "VOTING POWER USAGE"
+    table.field_names = ["Type", "Usage"]
+
+    table.add_row(["Comments", f"{comment_vp:.2f}%"])
+    table.add_row(["Contributions", f"{contribution_vp:.2f}%"])
+    table.add_row(["All", f"{comment_vp + contribution_vp:.2f}%"])
+
+    table.align["Type"] = "l"
+    table.align["Usage"] = "r"
+
+    LOGGER.info(f"\n{table}")
+
+
+def comment_voting_power(comments, comment_weights, scaling=1.0):
+    """Returns the amount of voting power that will be used to upvote all the
+    currently pending review comments.
+    """
+    voting_power = 100.0
+    for contribution in sorted(comments, key=lambda x: x["review_date"]):
+        category = contribution["category"]
+        try:
+            voting_weight = comment_weights[category]
+        except KeyError:
+            voting_weight = comment_weights["task-request"]
+
+        usage = scaling * voting_weight / 100.0 * 0.02 * voting_power
+        voting_power -= usage
+
+    return 100.0 - voting_power
+
+
+def sort_batch_contributions(contributions):
+    """Returns the list of contributions sorted by creation date (old -> young)
+    and score (high -> low).
+    """
+    by_creation = sorted(contributions, key=lambda x: x["created"])
+    by_score = sorted(by_creation, key=lambda x: x["score"], reverse=True)
+
+    return by_score
+
+
+def contribution_voting_power(contributions, voting_power, reward_scaler=None):
+    """Returns the amount of voting power that will be used to upvote all the
+    currently pending contributions.
+    """
+    starting_vp = voting_power
+    scaler = 1.0
+    for contribution in sort_batch_contributions(contributions):
+        category = contribution["category"]
+        voting_weight = contribution["voting_weight"]
+
+        if reward_scaler:
+            try:
+                scaler = reward_scaler[category]
+            except KeyError:
+                scaler = reward_scaler["task-request"]
+
+        usage = scaler * voting_weight / 100.0 * 0.02 * voting_power
+        voting_power -= usage
+
+    return starting_vp - voting_power
+
+
+def category_share_table(category_share):
+    """Prints a table containing each category and their share of the allocated
+    voting power for contributions.
+    """
+    table = PrettyTable()
+    table.title = "CATEGORY SHARE"
+    table.field_names = ["Category", "Share"]
+
+    total_share = sum(category_share.values())
+
+    for category, share in sorted(category_share.items()):
+        table.add_row([category, f"{share:.2f}%"])
+
+    table.add_row(["all", f"{total_share:.2f}%"])
+    table.align["Category"] = "l"
+    table.align["Share"] = "r"
+
+    LOGGER.info(f"\n{table}")
+
+
+def get_category_share(voting_power, category_weighting=CATEGORY_WEIGHTING):
+    """Returns a dictionary with a key, value pair of each category and their
+    share of the calculated voting power that can be used for contributions.
+    """
+    total_vote = sum(category_weighting.values())
+    category_share = {category: max_vote / total_vote * voting_power
+                      for category, max_vote in category_weighting.items()}
+
+    if log_tables():
+        category_share_table(category_share)
+
+    return category_share
+
+
+def category_usage_table(category_usage):
+    """Prints a table containing each category and the amount of voting power
+    will be used to upvote all contributions in the category.
+    """
+    table = PrettyTable()
+    table.title = "CATEGORY USAGE"
+    table.field_names = ["Category", "Usage"]
+
+    for category in sorted(CATEGORY_WEIGHTING.keys()):
+        try:
+            usage = category_usage[category]
+        except KeyError:
+            usage = 0
+        table.add_row([category, f"{usage:.2f}%"])
+
+    table.add_row(["all", f"{sum(category_usage.values()):.2f}%"])
+
+    table.align["Category"] = "l"
+    table.align["Usage"] = "r"
+
+    LOGGER.info(f"\n{table}")
+
+
+def get_category_usage(contributions, voting_power):
+    """Returns a dictionary containing the key, value pair of the category and
+    the amount of voting power it will need to upvote all contributions in the
+    category.
+    """
+    vp_usages = {}
+    for contribution in contributions:
+        category = contribution["category"]
+
+        if "task" in category:
+            category = "task-request"
+
+        voting_weight = contribution["voting_weight"]
+        vp_usage = voting_weight / 100.0 * 0.02 * voting_power
+
+        vp_usages.setdefault(category, []).append(vp_usage)
+
+    # Summed exactly, so the usage doesn't depend on the order of the
+    # contributions (see `allocator.py`)
+    category_usage = {category: math.fsum(usages)
+                      for category, usages in vp_usages.items()}
+
+    if log_tables():
+        category_usage_table(category_usage)
+
+    return category_usage
+
+
+def new_share_table(new_share):
+    """Prints a table containing the new share of the voting power of each
+    category.
+    """
+    table = PrettyTable()
+    table.title = "NEW CATEGORY SHARE"
+    table.field_names = ["Category", "Share"]
+
+    for category in sorted(CATEGORY_WEIGHTING.keys()):
+        try:
+            share = new_share[category]
+        except KeyError:
+            share = 0
+        table.add_row([category, f"{share:.2f}%"])
+
+    table.add_row(["all", f"{sum(new_share.values()):.2f}%"])
+
+    table.align["Category"] = "l"
+    table.align["Share"] = "r"
+
+    LOGGER.info(f"\n{table}")
+
+
+def distribute_remainder(remainder, category_usage, new_share, need_more_vp):
+    """Distributes the remaining voting power over the categories that need it.
+    """
+    while remainder > 0:
+        # Get voting power needed for every category
+        needed_per_category = {category: category_usage[category] - share
+                               for category, share in new_share.items()
+                               if category in need_more_vp}
+
+        # Get category who needs the least to reach its usage
+        least_under = min(needed_per_category.items(), key=itemgetter(1))
+        least_under_category = least_under[0]
+        least_needed = least_under[1]
+
+        # If this amount can be added to all categories without using the
+        # entire remainder then do this
+        if len(needed_per_category) * least_needed < remainder:
+            for category in need_more_vp:
+                new_share[category] += least_needed
+                remainder -= least_needed
+            need_more_vp.remove(least_under_category)
+        # Distribute the remainder evenly over the categories that need it
+        else:
+            remaining_categories = len(need_more_vp)
+            for category in need_more_vp:
+                percentage_share = 1.0 / remaining_categories
+                to_be_added = percentage_share * remainder
+                new_vp = new_share[category] + to_be_added
+
+                # Category's new share is still less than what it needs
+                if new_vp < category_usage[category]:
+                    new_share[category] += to_be_added
+                    remainder -= to_be_added
+                # Category's new share is more than it needs, so distribute to
+                # the other categories
+                else:
+                    not_needed = new_vp - category_usage[category]
+                    remainder -= to_be_added - not_needed
+                    new_share[category] = category_usage[category]
+
+                remaining_categories -= 1
+
+    if log_tables():
+        new_share_table(new_share)
+
+    return new_share
+
+
+def calculate_new_share(category_share, category_usage):
+    """Calculates the new share of the voting power for each category."""
+    new_share = {}
+    remainder = 0
+    need_more_vp = []
+
+    for category, share in category_share.items():
+        try:
+            usage = category_usage[category]
+            # Category's share is more than the voting power it will use
+            if share > usage:
+                remainder += share - usage
+                new_share[category] = usage
+            # Category needs more voting power to vote everything
+            else:
+                new_share[category] = share
+                need_more_vp.append(category)
+        except KeyError:
+            remainder += share
+
+    return distribute_remainder(remainder, category_usage, new_share,
+                                need_more_vp)
+
+
+def reward_scaler_table(category_scaling):
+    """Prints a table containing each category and the scaler that the voting
+    weight of contributions in each respective category will be multiplied
+    with.
+    """
+    table = PrettyTable()
+    table.title = "REWARD MULTIPLIER"
+    table.field_names = ["Category", "Reward scaling"]
+
+    for category, scaling in category_scaling.items():
+        table.add_row([category, f"{scaling:.2f}"])
+
+    table.align["Category"] = "l"
+    table.align["Usage"] = "r"
+
+    LOGGER.info(f"\n{table}")
+
+
+def get_reward_scaler(category_usage, category_share):
+    """Returns a dictionary containing the key, value pair of the category and
+    the ratio that will be used to scale the voting_weight of contributions
+    in the category.
+    """
+    category_ratio = {}
+
+    for category, share in category_share.items():
+        category_ratio[category] = share / category_usage[category]
+
+    if log_tables():
+        reward_scaler_table(category_ratio)
+
+    return category_ratio
+
+
+def update_reward_scaler(reward_scaler, contribution_usage, comment_usage):
+    """Updates the reward scaling dictionary so that the actual voting power
+    usage is roughly the same as the estimated usage.
+    """
+    desired_usage = 1.0 - (VP_TOTAL - comment_usage) / 100.0
+    actual_usage = 1.0 - contribution_usage / 100.0
+    scaler = np.log(desired_usage) / np.log(actual_usage)
+
+    for category in reward_scaler.keys():
+        reward_scaler[category] *= scaler
+
+    return reward_scaler
+
+
+@metrics.timed("init_comments")
+def init_comments(comments, voting_value, vp_comments=VP_COMMENTS,
+                  moderation_reward=MODERATION_REWARD):
+    """Initialises everything needed for upvoting the comments."""
+    comment_weights = get_comment_weights(voting_value, moderation_reward)
+    comment_usage = comment_voting_power(comments, comment_weights)
+
+    if comment_usage > vp_comments:
+        comment_weights = update_weights(comment_weights, comment_usage,
+                                         vp_comments)
+        comment_usage = comment_voting_power(comments, comment_weights)
+
+    LOGGER.info(f"Estimated voting power usage (comments): {comment_usage:.2f}%")
+    return comment_weights, comment_usage
+
+
+@metrics.timed("get_batch")
+def get_batch(contributions, category_share, voting_power):
+    """Returns the batch of contributions that will be voted on in the next
+    voting round. Contributions are packed into their category's share from
+    the highest score down, and one that doesn't fit is skipped instead of
+    closing the category, so the smaller contributions after it can still use
+    what is left of the share. A category is only closed once its smallest
+    remaining contribution can't fit at the lowest voting power the batch
+    could leave the account with.
+    """
+    return pack_batch(sort_batch_contributions(contributions), category_share,
+                      voting_power)
+
+
+def pack_batch(contributions, category_share, voting_power):
+    """Returns the voting power left and the batch packed from the given
+    contributions, which are already sorted (see `get_batch`).
+    """
+    categories = [batch_category(contribution["category"])
+                  for contribution in contributions]
+
+    # Smallest voting weight from each position onwards in its category
+    smallest = [0.0] * len(contributions)
+    remaining = {}
+    for index in range(len(contributions) - 1, -1, -1):
+        category = categories[index]
+        voting_weight = contributions[index]["voting_weight"]
+        remaining[category] = min(remaining.get(category, voting_weight),
+                                  voting_weight)
+        smallest[index] = remaining[category]
+
+    lowest_voting_power = voting_power - math.fsum(
+        max(share, 0.0) for share in category_share.values())
+    closed = set()
+    batch = []
+
+    for index, contribution in enumerate(contributions):
+        category = categories[index]
+
+        if category in closed:
+            continue
+
+        share = category_share[category]
+        if smallest[index] / 100.0 * 0.02 * lowest_voting_power > share:
+            closed.add(category)
+            if len(closed) == len(remaining):
+                break
+            continue
+
+        usage = contribution["voting_weight"] / 100.0 * 0.02 * voting_power
+
+        if share - usage < 0:
+            continue
+
+        category_share[category] -= usage
+        voting_power -= usage
+        batch.append(contribution)
+
+    LOGGER.info(f"Voting power after contributions: {voting_power:.2f}%")
+    return voting_power, batch
+
+
+@metrics.timed("init_contributions")
+def init_contributions(contributions, comment_usage, vp_total=VP_TOTAL,
+                       category_weighting=CATEGORY_WEIGHTING):
+    """Initialises everything needed for upvoting the contributions."""
+    voting_power = 100.0 - comment_usage
+    contribution_usage = contribution_voting_power(contributions, voting_power)
+    category_usage = get_category_usage(contributions, voting_power)
+
+    return contribution_shares(contribution_usage, category_usage,
+                               comment_usage, vp_total, category_weighting)
+
+
+def contribution_shares(contribution_usage, category_usage, comment_usage,
+                        vp_total=VP_TOTAL,
+                        category_weighting=CATEGORY_WEIGHTING):
+    """Returns the share of the voting power of each category, given the
+    voting power that upvoting all contributions, and all contributions in
+    each category, would use.
+    """
+    if contribution_usage + comment_usage > vp_total:
+        contribution_usage = vp_total - comment_usage
+
+    category_share = get_category_share(contribution_usage, category_weighting)
+
+    if contribution_usage + comment_usage == vp_total:
+        new_share = calculate_new_share(category_share, category_usage)
+    else:
+        new_share = category_usage
+
+    return new_share
+
+
+def trail_usage(contributions, voting_power, multiplier=1.0):
+    """Returns the voting power left after upvoting the contributions with
+    their weights scaled by the multiplier.
+    """
+    for contribution in contributions:
+        voting_weight = contribution["voting_weight"] * multiplier
+        voting_power -= voting_weight / 100.0 * 0.02 * voting_power
+    return voting_power
+
+
+def trail_multiplier(contributions, voting_power, floor=TRAIL_VP_FLOOR):
+    """Returns the multiplier (at most 1) of the weights of the non-priority
+    trail contributions with which upvoting all of them uses exactly the
+    voting power left above the floor after the priority contributions. It's
+    found by bisection, since the voting power used by a vote depends on the
+    voting power left by the votes before it.
+    """
+    priority = [contribution for contribution in contributions
+                if contribution["is_priority"]]
+    others = [contribution for contribution in contributions
+              if not contribution["is_priority"]]
+
+    voting_power = trail_usage(priority, voting_power)
+    if voting_power <= floor:
+        LOGGER.error("Not enough voting power left to upvote trail.")
+        return 0.0
+
+    if trail_usage(others, voting_power) >= floor:
+        return 1.0
+
+    low, high = 0.0, 1.0
+    for _ in range(BISECTION_STEPS):
+        middle = (low + high) / 2.0
+        if trail_usage(others, voting_power, middle) >= floor:
+            low = middle
+        else:
+            high = middle
+
+    LOGGER.info("Scaling non-priority trail contributions with multiplier: "
+                f"{low:.3f}")
+    return low
+
+
+def batch_category(category):
+    """Returns the category whose weight and share is used for the given
+    category.
+    """
+    if "task" in category:
+        return "task-request"
+    return category
+
+
+def plan_comments(comments, comment_weights, voting_power):
+    """Returns the actions for upvoting all pending review comments in the
+    order they were reviewed.
+    """
+    actions = []
+    for comment in sorted(comments, key=lambda x: x["review_date"]):
+        category = batch_category(comment["category"])
+        voting_weight = comment_weights[category]
+        usage = voting_weight / 100.0 * 0.02 * voting_power
+        voting_power -= usage
+
+        actions.append({
+            "type": "comment",
+            "url": comment["url"],
+            "authorperm": f"{comment['moderator']}/{comment['comment_url']}",
+            "moderator": comment["moderator"],
+            "category": category,
+            "created": comment["review_date"],
+            "voting_weight": voting_weight,
+            "usage": usage,
+        })
+
+    return actions, voting_power
+
+
+def plan_contributions(batch, voting_power):
+    """Returns the actions for upvoting the contributions in the batch."""
+    actions = []
+    for contribution in batch:
+        voting_weight = contribution["voting_weight"]
+        usage = voting_weight / 100.0 * 0.02 * voting_power
+        voting_power -= usage
+
+        actions.append({
+            "type": "contribution",
+            "url": contribution["url"],
+            "category": contribution["category"],
+            "created": contribution["created"],
+            "staff_picked": contribution["staff_picked"],
+            "voting_weight": voting_weight,
+            "usage": usage,
+        })
+
+    return actions, voting_power
+
+
+def plan_trail(contributions, voting_power, floor=TRAIL_VP_FLOOR):
+    """Returns the actions for upvoting the trail's contributions. Priority
+    contributions are upvoted with their own weights as far as the voting
+    power above the floor allows, and the weights of the others are scaled
+    with `trail_multiplier` so they use exactly what is left of it.
+    """
+    actions = []
+    contributions = sorted(
+        contributions,
+        key=lambda x: (x["is_priority"], x["voting_weight"]),
+        reverse=True
+    )
+    multiplier = None
+
+    for contribution in contributions:
+        voting_weight = contribution["voting_weight"]
+        if not contribution["is_priority"]:
+            # Scale the rest with what the priority contributions left
+            if multiplier is None:
+                multiplier = trail_multiplier(
+                    [x for x in contributions if not x["is_priority"]],
+                    voting_power, floor)
+            voting_weight *= multiplier
+        # Weights are broadcast in hundredths of a percent
+        voting_weight = math.floor(voting_weight * 100.0) / 100.0
+        usage = voting_weight / 100.0 * 0.02 * voting_power
+
+        if voting_weight <= 0.0 or voting_power - usage < floor:
+            continue
+
+        voting_power -= usage
+        actions.append({
+            "type": "trail",
+            "authorperm": contribution["authorperm"],
+            "id": contribution["id"],
+            "trail_name": contribution["trail_name"],
+            "author": contribution["author"],
+            "created": contribution.get("created"),
+            "is_priority": contribution["is_priority"],
+            "voting_weight": voting_weight,
+            "usage": usage,
+        })
+
+    LOGGER.info(f"Estimated voting power usage (trail): "
+                f"{sum(action['usage'] for action in actions):.2f}%")
+    return actions, voting_power
+
+
+@metrics.timed("build_plan")
+def build_plan(inputs, vp_total=VP_TOTAL, vp_comments=VP_COMMENTS,
+               category_weighting=CATEGORY_WEIGHTING,
+               moderation_reward=MODERATION_REWARD):
+    """Returns the vote plan for the given prefetched inputs, which is a
+    dictionary containing the account's `voting_power`, the `voting_value` of
+    a full vote in SBD, the `comments` and `contributions` from the batch API
+    and the eligible `trail` contributions.
+    """
+    voting_power = inputs["voting_power"]
+    comments = inputs["comments"]
+    contributions = inputs["contributions"]
+
+    comment_weights, comment_usage = init_comments(
+        comments, inputs["voting_value"], vp_comments, moderation_reward)
+    category_share = init_contributions(contributions, comment_usage,
+                                        vp_total, category_weighting)
+
+    comment_actions, voting_power = plan_comments(comments, comment_weights,
+                                                  voting_power)
+    _, batch = get_batch(contributions, category_share, voting_power)
+    contribution_actions, voting_power = plan_contributions(batch,
+                                                            voting_power)
+    trail_actions, voting_power = plan_trail(inputs["trail"], voting_power)
+
+    return {
+        "voting_power": inputs["voting_power"],
+        "expected_voting_power": voting_power,
+        "actions": comment_actions + contribution_actions + trail_actions,
+    }
+
+
+def account_capacity(settings, item_type, category=None):
+    """Returns how much of the given type of item (and category for
+    contributions) the account with the given settings should take on.
+    """
+    if item_type == "comment":
+        return settings["vp_comments"]
+    if item_type == "trail":
+        return 1.0 if settings["trail"] else 0.0
+    return settings["category_weighting"].get(batch_category(category), 0.0)
+
+
+def assign_accounts(items, accounts, item_type, load_key=None):
+    """Returns a dictionary with the items assigned to each account. Every
+    item goes to the account whose load of that kind of item is currently the
+    smallest relative to its capacity for it, so items are spread in
+    proportion to the accounts' budgets and category weighting.
+    """
+    assigned = {name: [] for name in accounts}
+    loads = {}
+
+    for item in items:
+        category = item.get("category")
+        kind = None
+        if item_type == "contribution":
+            kind = batch_category(category)
+        best = None
+
+        for name, settings in accounts.items():
+            capacity = account_capacity(settings, item_type, category)
+            if capacity <= 0:
+                continue
+            load = loads.get((name, kind), 0.0) / capacity
+            if best is None or load < best[0]:
+                best = (load, name)
+
+        if best is None:
+            continue
+
+        name = best[1]
+        load = item[load_key] if load_key else 1.0
+        loads[(name, kind)] = loads.get((name, kind), 0.0) + load
+        assigned[name].append(item)
+
+    return assigned
+
+
+def build_plans(inputs, accounts):
+    """Returns a vote plan for each of the given voting accounts. The inputs
+    are the same as for `build_plan`, except that `voting_power` and
+    `voting_value` are given per account in `inputs["accounts"]`.
+    """
+    eligible = {name: settings for name, settings in accounts.items()
+                if name in inputs["accounts"]}
+    comments = assign_accounts(inputs["comments"], eligible, "comment")
+    contributions = assign_accounts(inputs["contributions"], eligible,
+                                    "contribution", "voting_weight")
+    trail = assign_accounts(inputs["trail"], eligible, "trail",
+                            "voting_weight")
+
+    plans = {}
+    for name, settings in eligible.items():
+        account_inputs = dict(inputs["accounts"][name],
+                              comments=comments[name],
+                              contributions=contributions[name],
+                              trail=trail[name])
+        plan = build_plan(account_inputs, settings["vp_total"],
+                          settings["vp_comments"],
+                          settings["category_weighting"])
+        for action in plan["actions"]:
+            action["account"] = name
+        plans[name] = plan
+
+    return {"accounts": plans}
+
+
+def save_inputs(inputs, directory):
+    """Archives the inputs of a batch run in the given directory, so the run
+    can be replayed later.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"inputs-{time.strftime('%Y%m%d-%H%M%S')}"
+                                   ".json")
+    write_plan(inputs, path)
+    return path
+
+
+def write_plan(plan, path):
+    """Writes the plan to the given path as compact JSON."""
+    with open(path, "w") as fd:
+        json.dump(plan, fd, separators=(",", ":"))
+
+
+def read_plan(path):
+    """Returns the plan stored at the given path."""
+    with open(path) as fd:
+        return json.load(fd)
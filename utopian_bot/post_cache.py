@@ -0,0 +1,103 @@
+"""
+Persistent cache of the metadata of posts that never changes once they are
+created, such as their author, creation date, beneficiaries and whether they
+allow curation rewards. Posts stay in the sheets and batches for up to seven
+days, so this saves downloading their full content on every run. Mutable data
+like the active votes is always fetched live, and the body, which changes
+when the post is edited, is fetched again once it's `BODY_MAX_AGE` old.
+"""
+
+import time
+
+from beem.comment import Comment
+from beem.utils import resolve_authorperm
+from beem.vote import ActiveVotes
+
+from connections import thread_steem
+from database.database_handler import DatabaseHandler
+
+# Seconds the cached body of a post is used before it's fetched again
+BODY_MAX_AGE = 3600
+
+
+def normalise_authorperm(identifier):
+    """Returns the authorperm (@author/permlink) of the given URL or
+    authorperm.
+    """
+    author, permlink = resolve_authorperm(identifier)
+    return f"@{author}/{permlink}"
+
+
+def fetch_metadata(authorperm, steem=None):
+    """Returns the metadata of the post fetched from the node."""
+    post = Comment(authorperm, steem_instance=steem or thread_steem())
+    post_json = post.json()
+
+    return {
+        "authorperm": authorperm,
+        "id": post.id,
+        "author": post.author,
+        "permlink": post.permlink,
+        "category": post.category,
+        "created": post_json["created"],
+        "is_comment": post.is_comment(),
+        "allow_curation_rewards": post_json["allow_curation_rewards"],
+        "beneficiaries": post_json["beneficiaries"],
+        "body": post.body,
+        "body_fetched": time.time(),
+    }
+
+
+def post_metadata(identifier, steem=None):
+    """Returns the metadata of the post with the given URL or authorperm,
+    from the cache if possible and otherwise fetched and added to it.
+    """
+    authorperm = normalise_authorperm(identifier)
+    database = DatabaseHandler.get_instance()
+    metadata = database.get_post(authorperm)
+
+    if metadata is None:
+        metadata = fetch_metadata(authorperm, steem)
+        database.add_post(metadata)
+
+    return metadata
+
+
+def post_body(post, steem=None, max_age=BODY_MAX_AGE):
+    """Returns the body of the post with the given cached metadata, fetched
+    again (and cached) if the cached one is older than `max_age` seconds, so
+    edits are seen.
+    """
+    if time.time() - post.get("body_fetched", 0.0) <= max_age:
+        return post["body"]
+
+    authorperm = post["authorperm"]
+    body = Comment(authorperm, steem_instance=steem or thread_steem()).body
+    DatabaseHandler.get_instance().update_post_body(authorperm, body,
+                                                    time.time())
+    return body
+
+
+def vote_weights(identifier, steem=None):
+    """Returns the weight of the vote of every account that voted on the
+    post, always fetched live.
+    """
+    votes = ActiveVotes(normalise_authorperm(identifier),
+                        steem_instance=steem or thread_steem())
+    return {vote.voter: vote.weight for vote in votes}
+
+
+def active_voters(identifier, steem=None, positive_only=True):
+    """Returns the accounts that currently have a vote (with a positive
+    weight, unless `positive_only` is False) on the post, always fetched live.
+    """
+    return [voter for voter, weight in vote_weights(identifier, steem).items()
+            if weight > 0 or not positive_only]
+
+
+def lazy_post(identifier, steem=None):
+    """Returns a beem Comment for the post that can be voted on or replied to
+    without fetching its content.
+    """
+    return Comment(normalise_authorperm(identifier), lazy=True,
+                   steem_instance=steem or thread_steem())
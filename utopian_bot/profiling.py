@@ -0,0 +1,282 @@
+"""
+Optional profiling of bot runs. When enabled, every stage timed by
+`metrics.stage` is also run under cProfile and tracemalloc, and at exit the
+collected spans are written as collapsed stacks (ready for flamegraph.pl or
+speedscope), raw pstats files and a summary of each stage's allocation peak.
+Spans of the same stage (e.g. `build_plan` when replaying archived runs in
+`simulator.py`) are added up. A stage nested in another one (e.g. `get_batch`
+in `build_plan`) is profiled on its own and kept below its parent, in the
+flamegraph as well as in the summary.
+
+cProfile only profiles the thread that enabled it and tracemalloc measures
+the whole process, so only stages run by the main thread are profiled. Stages
+run by other threads (e.g. the concurrent fetches of `upvote_bot`) only have
+their duration recorded, and their work shows up in the main thread's
+enclosing stage's allocation peak. Forked workers start without the spans of
+their parent and have to `write` their own before exiting.
+"""
+
+import argparse
+import atexit
+import cProfile
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+PROFILE_DIR = os.path.join(DIR_PATH, "profiles")
+MAX_DEPTH = 64
+
+_LOCK = threading.Lock()
+_STATE = {"enabled": False, "directory": PROFILE_DIR, "stack": []}
+_SPANS = {}
+
+
+def argument_parser(description):
+    """Returns an argument parser with the profiling options every bot's
+    entry point accepts.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--profile", action="store_true",
+                        help="profile each stage with cProfile and "
+                             "tracemalloc")
+    parser.add_argument("--profile-dir", default=PROFILE_DIR,
+                        help="directory the profiling output is written to")
+    return parser
+
+
+def enable(directory=PROFILE_DIR):
+    """Enables profiling of stages and writes the results when the process
+    exits.
+    """
+    if _STATE["enabled"]:
+        return
+    _STATE["enabled"] = True
+    _STATE["directory"] = directory
+    atexit.register(write)
+
+
+def is_enabled():
+    return _STATE["enabled"]
+
+
+def _span(name):
+    """Returns the collected span of the stage with the given name, which is
+    the path of the stages it's nested in joined by semicolons.
+    """
+    return _SPANS.setdefault(name, {
+        "name": name,
+        "calls": 0,
+        "duration": 0.0,
+        "own_duration": 0.0,
+        "cpu": 0.0,
+        "peak": 0,
+        "top": [],
+        "stats": None,
+        "threads": set(),
+    })
+
+
+def _checkpoint():
+    """Folds the peak of the traced memory since the last checkpoint into the
+    peak of every active span, as they were all running in the meantime, and
+    starts measuring a new peak.
+    """
+    peak = tracemalloc.get_traced_memory()[1]
+    for frame in _STATE["stack"]:
+        frame["peak"] = max(frame["peak"], peak)
+    if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+
+
+@contextmanager
+def span(name):
+    """Profiles the enclosed block as the stage with the given name. Only a
+    single profiler can be active at a time, so the profiler of the enclosing
+    span is paused while a nested span runs, and every span's statistics only
+    hold its own calls. Spans of other threads than the main thread are only
+    timed.
+    """
+    if not _STATE["enabled"]:
+        yield
+        return
+
+    if threading.current_thread() is not threading.main_thread():
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with _LOCK:
+                profiled = _span(f"{name} (threads)")
+                profiled["calls"] += 1
+                profiled["duration"] += time.perf_counter() - start
+                profiled["threads"].add(threading.current_thread().name)
+        return
+
+    stack = _STATE["stack"]
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start(25)
+    _checkpoint()
+    if stack:
+        stack[-1]["profile"].disable()
+
+    frame = {
+        "name": f"{stack[-1]['name']};{name}" if stack else name,
+        "profile": cProfile.Profile(),
+        "memory": tracemalloc.get_traced_memory()[0],
+        "peak": 0,
+        "nested": 0.0,
+    }
+    stack.append(frame)
+    start = time.perf_counter()
+    start_cpu = time.process_time()
+    frame["profile"].enable()
+    try:
+        yield
+    finally:
+        frame["profile"].disable()
+        duration = time.perf_counter() - start
+        cpu = time.process_time() - start_cpu
+        _checkpoint()
+        stack.remove(frame)
+        peak = max(frame["peak"] - frame["memory"], 0)
+        try:
+            stats = pstats.Stats(frame["profile"])
+        except TypeError:
+            # Nothing was profiled outside of the nested spans
+            stats = None
+
+        with _LOCK:
+            profiled = _span(frame["name"])
+            profiled["calls"] += 1
+            profiled["duration"] += duration
+            profiled["own_duration"] += duration - frame["nested"]
+            profiled["cpu"] += cpu
+            # Only the snapshot of the stage's largest peak is kept
+            if peak >= profiled["peak"]:
+                profiled["peak"] = peak
+                profiled["top"] = tracemalloc.take_snapshot().statistics(
+                    "lineno")[:10]
+            if profiled["stats"] is None:
+                profiled["stats"] = stats
+            elif stats is not None:
+                profiled["stats"].add(stats)
+
+        if stack:
+            stack[-1]["nested"] += duration
+            stack[-1]["profile"].enable()
+        if started_tracing:
+            tracemalloc.stop()
+
+
+def reset():
+    """Drops the spans and the profilers inherited from the parent in a
+    freshly forked worker.
+    """
+    for frame in _STATE["stack"]:
+        frame["profile"].disable()
+    _STATE["stack"] = []
+    _SPANS.clear()
+
+
+def _label(function):
+    """Returns a readable label for a function in pstats' format."""
+    filename, line, name = function
+    if filename == "~":
+        label = name
+    else:
+        label = f"{name} ({os.path.basename(filename)}:{line})"
+    return label.replace(";", ",").replace(" ", "_")
+
+
+def collapsed_stacks(stage_name, stats):
+    """Converts cProfile statistics into collapsed stacks of the form
+    `stage;caller;callee microseconds`. Since cProfile only records direct
+    caller/callee pairs, time is attributed to deeper paths in proportion to
+    the calls made along each edge.
+    """
+    children = {}
+    for function, (_, _, _, _, callers) in stats.items():
+        for caller, edge in callers.items():
+            children.setdefault(caller, []).append((function, edge[3]))
+
+    roots = [function for function, (_, _, _, _, callers) in stats.items()
+             if not any(caller in stats for caller in callers)]
+
+    stacks = {}
+
+    def walk(function, path, scale):
+        _, _, self_time, cumulative_time, _ = stats[function]
+        path = path + (_label(function),)
+        stacks[path] = stacks.get(path, 0.0) + self_time * scale
+
+        if len(path) > MAX_DEPTH or cumulative_time <= 0:
+            return
+
+        for child, edge_time in children.get(function, []):
+            child_cumulative = stats[child][3]
+            if child_cumulative <= 0 or _label(child) in path:
+                continue
+            child_scale = scale * edge_time / child_cumulative
+            if edge_time * scale < 1e-6:
+                continue
+            walk(child, path, min(child_scale, 1.0))
+
+    for root in roots:
+        walk(root, (stage_name,), 1.0)
+
+    return [f"{';'.join(path)} {int(round(seconds * 1e6))}"
+            for path, seconds in stacks.items() if seconds * 1e6 >= 1]
+
+
+def write():
+    """Writes the collapsed stacks, pstats files and summary of all profiled
+    stages to the profiling directory. Nested stages are listed below the
+    stage they ran in, with their own duration, CPU time and allocation peak.
+    """
+    with _LOCK:
+        spans = sorted(_SPANS.values(),
+                       key=lambda profiled: profiled["name"].split(";"))
+        _SPANS.clear()
+    if not spans:
+        return
+
+    directory = _STATE["directory"]
+    os.makedirs(directory, exist_ok=True)
+    prefix = os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-"
+                                     f"{os.getpid()}")
+    profiled_spans = [profiled for profiled in spans if profiled["stats"]]
+
+    with open(f"{prefix}.collapsed", "w") as fd:
+        for profiled in profiled_spans:
+            for line in collapsed_stacks(profiled["name"],
+                                         profiled["stats"].stats):
+                fd.write(f"{line}\n")
+
+    with open(f"{prefix}-memory.txt", "w") as fd:
+        for profiled in spans:
+            path = profiled["name"].split(";")
+            indent = "    " * (len(path) - 1)
+            fd.write(f"{indent}{path[-1]}: {profiled['duration']:.3f}s in "
+                     f"{profiled['calls']} calls")
+            if profiled["threads"]:
+                threads = ", ".join(sorted(profiled["threads"]))
+                fd.write(f", not profiled (ran in {threads})\n")
+                continue
+            fd.write(f" ({profiled['own_duration']:.3f}s outside nested "
+                     f"stages), {profiled['cpu']:.3f}s CPU, peak "
+                     f"{profiled['peak'] / 1024:.1f} KiB\n")
+            for statistic in profiled["top"]:
+                fd.write(f"{indent}    {statistic}\n")
+
+    for index, profiled in enumerate(profiled_spans):
+        name = profiled["name"].replace(";", ".")
+        profiled["stats"].dump_stats(f"{prefix}-{index:02d}-{name}.prof")
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset)
@@ -0,0 +1,281 @@
+"""
+Resource credit budget shared by all bots. Every account's resource credits
+are modelled by a token bucket stored in a small JSON file, which all bot
+processes update under a file lock. Before broadcasting a batch, a bot
+reserves the estimated cost of its operations and shrinks the batch to what
+the account can afford, instead of running out of resource credits halfway
+through it.
+"""
+
+import fcntl
+import json
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+from beem.account import Account
+
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+RC_DIR = os.environ.get("RC_DIR", f"{DIR_PATH}/rc")
+# Resource credits regenerate fully in five days
+RC_REGENERATION_TIME = 5 * 86400
+# Fraction of the account's resource credits that is never reserved
+RC_MARGIN = float(os.environ.get("RC_MARGIN", 0.05))
+# How often the bucket is synchronised with the account on the chain
+SYNC_INTERVAL = 300
+# Reservations of crashed processes are dropped after this many seconds
+RESERVATION_TIMEOUT = 3600
+# How quickly the cost estimates follow the costs observed on the chain
+CALIBRATION_RATE = 0.3
+
+# Estimated resource credits used by each operation, used until the costs
+# have been estimated with the chain's resource parameters
+DEFAULT_COSTS = {
+    "vote": 2.0e8,
+    "comment": 1.5e9,
+    "custom_json": 3.0e8,
+    "delegate_vesting_shares": 4.0e8,
+}
+
+
+def estimate_costs(steem=None):
+    """Returns the cost of each operation type, estimated with the chain's
+    current resource parameters if beem supports it.
+    """
+    costs = dict(DEFAULT_COSTS)
+    try:
+        from beem.rc import RC
+        rc = RC(steem_instance=steem)
+        costs["vote"] = rc.vote()
+        costs["comment"] = rc.comment()
+        costs["custom_json"] = rc.custom_json()
+        costs["delegate_vesting_shares"] = rc.transfer(market_op_count=0)
+    except Exception:
+        pass
+    return costs
+
+
+def item_cost(costs, operations):
+    """Returns the cost of an item consisting of the given number of each
+    operation type.
+    """
+    return sum(costs.get(operation, DEFAULT_COSTS.get(operation, 0.0)) *
+               number for operation, number in operations.items())
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Budget():
+    """Resource credit budget of an account. Reservations are shared with
+    every other process using the same account, so concurrently running bots
+    never plan with the same resource credits.
+    """
+    def __init__(self, account, steem=None, directory=RC_DIR,
+                 clock=time.time):
+        self.account = account
+        self.steem = steem
+        self.clock = clock
+        # Reservations made through this budget, newest last
+        self.reservations = []
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{account}.json")
+        self.lock_path = os.path.join(directory, f"{account}.lock")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    @contextmanager
+    def state(self):
+        """Yields the bucket's state while holding the file lock and writes
+        it back afterwards.
+        """
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.path) as fd:
+                        state = json.load(fd)
+                except (OSError, ValueError):
+                    state = {}
+                yield state
+                temporary = f"{self.path}.{os.getpid()}.tmp"
+                with open(temporary, "w") as fd:
+                    json.dump(state, fd)
+                os.replace(temporary, self.path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def regenerate(self, state, now):
+        """Adds the resource credits regenerated since the last update."""
+        elapsed = max(now - state["updated"], 0.0)
+        state["mana"] = min(
+            state["max_mana"],
+            state["mana"] + elapsed * state["max_mana"] / RC_REGENERATION_TIME)
+        state["updated"] = now
+
+    def sync(self, force=False):
+        """Synchronises the bucket with the account's resource credits on the
+        chain, calibrating the cost estimates with what was actually used
+        since the last synchronisation.
+        """
+        with self.state() as state:
+            if not force and self.clock() - state.get("synced", 0) < \
+                    SYNC_INTERVAL:
+                return
+            needs_costs = "costs" not in state
+
+        manabar = Account(self.account, steem_instance=self.steem)\
+            .get_rc_manabar()
+        costs = estimate_costs(self.steem) if needs_costs else None
+        now = self.clock()
+
+        with self.state() as state:
+            if costs:
+                state["costs"] = costs
+            state.setdefault("costs", dict(DEFAULT_COSTS))
+            state.setdefault("scale", 1.0)
+            state.setdefault("reservations", {})
+
+            estimated = state.get("spent", 0.0)
+            if "mana" in state and estimated > 0:
+                self.regenerate(state, now)
+                # The local bucket already subtracted the estimated costs, so
+                # the difference with the chain is the estimation error
+                observed = estimated + state["mana"] - \
+                    float(manabar["current_mana"])
+                ratio = min(max(observed / estimated, 0.5), 3.0)
+                state["scale"] += CALIBRATION_RATE * (
+                    ratio * state["scale"] - state["scale"])
+
+            state["mana"] = float(manabar["current_mana"])
+            state["max_mana"] = float(manabar["max_mana"])
+            state["updated"] = state["synced"] = now
+            state["spent"] = 0.0
+
+    def available(self, state, now):
+        """Returns the resource credits that aren't reserved by any process,
+        dropping reservations of processes that no longer exist.
+        """
+        self.regenerate(state, now)
+        reservations = state["reservations"]
+        for key, reservation in list(reservations.items()):
+            if reservation["expires"] < now or \
+                    not process_alive(reservation["pid"]):
+                del reservations[key]
+        reserved = sum(reservation["amount"]
+                       for reservation in reservations.values())
+        return state["mana"] - reserved - RC_MARGIN * state["max_mana"]
+
+    def reserve(self, operations, items=1):
+        """Reserves resource credits for as many of the given number of
+        items, each consisting of the given number of each operation type, as
+        the account can afford and returns that number.
+        """
+        return self.hold(operations, items)[1]
+
+    def hold(self, operations, items=1):
+        """Like `reserve`, but also returns the new reservation, so only it
+        can be released.
+        """
+        self.sync()
+        key = uuid.uuid4().hex
+        with self.state() as state:
+            now = self.clock()
+            cost = item_cost(state["costs"], operations) * state["scale"]
+            available = self.available(state, now)
+            if cost <= 0:
+                affordable = items
+            else:
+                affordable = min(items, max(int(available // cost), 0))
+
+            state["reservations"][key] = {
+                "amount": affordable * cost, "pid": os.getpid(),
+                "expires": now + RESERVATION_TIMEOUT}
+        self.reservations.append(key)
+        return key, affordable
+
+    def spend(self, operation, number=1):
+        """Records that an operation was broadcast, moving its estimated cost
+        from this budget's reservations (newest first) to the spent resource
+        credits.
+        """
+        with self.state() as state:
+            if "costs" not in state:
+                return
+            cost = item_cost(state["costs"], {operation: number}) * \
+                state["scale"]
+            self.regenerate(state, self.clock())
+            state["mana"] -= cost
+            state["spent"] = state.get("spent", 0.0) + cost
+            reservations = state.get("reservations", {})
+            for key in reversed(self.reservations):
+                if cost <= 0:
+                    break
+                reservation = reservations.get(key)
+                if reservation:
+                    taken = min(reservation["amount"], cost)
+                    reservation["amount"] -= taken
+                    cost -= taken
+
+    def release(self, reservation=None):
+        """Returns whatever is left of the given reservation, or of all
+        reservations made through this budget.
+        """
+        keys = [reservation] if reservation else list(self.reservations)
+        with self.state() as state:
+            for key in keys:
+                state.get("reservations", {}).pop(key, None)
+        for key in keys:
+            if key in self.reservations:
+                self.reservations.remove(key)
+
+
+_BUDGETS = {}
+
+
+def budget(account, steem=None):
+    """Returns this process's budget of the given account."""
+    key = (account, os.getpid())
+    if key not in _BUDGETS:
+        _BUDGETS[key] = Budget(account, steem)
+    return _BUDGETS[key]
+
+
+def spend(account, operation, number=1):
+    """Records a broadcast operation against the account's budget. Failing to
+    update the budget must never stop a bot, so errors are ignored.
+    """
+    try:
+        budget(account).spend(operation, number)
+    except Exception:
+        pass
+
+
+@contextmanager
+def reserved(account, operations, steem=None):
+    """Reserves the resource credits of the given number of each operation
+    type for the duration of the block, raising an error if the account can't
+    afford them (so a queued task is retried later).
+    """
+    account_budget = budget(account, steem)
+    reservation, affordable = account_budget.hold(operations)
+    if not affordable:
+        account_budget.release(reservation)
+        raise RuntimeError(f"{account} doesn't have enough resource credits")
+    try:
+        yield account_budget
+    finally:
+        # Reservations held around the block (e.g. by the executor) are kept
+        account_budget.release(reservation)
@@ -1,33 +1,32 @@
-from beem import Steem
 from beem.account import Account
 from beem.comment import Comment, RecentReplies
+from connections import steem_client
 from datetime import date, datetime, timedelta
 from dateutil.parser import parse
+from logger import get_logger
 from oauth2client.service_account import ServiceAccountCredentials
 import gspread
 import json
-import logging
+import metrics
 import os
+import profiling
+import rc_budget
 import time
+import work_queue
 
 # Minimum score required to be resteemed
 MINIMUM_SCORE = 10
+# Kinds of tasks the bot leaves to the work queue
+QUEUE_TASKS = ("resteem",)
 
 # Get path of current folder
 DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 
 # Logging
-logger = logging.getLogger("utopian-io")
-logger.setLevel(logging.INFO)
-fh = logging.FileHandler(f"{DIR_PATH}/bot.log")
-fh.setLevel(logging.DEBUG)
-formatter = logging.Formatter(
-    "%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-fh.setFormatter(formatter)
-logger.addHandler(fh)
+logger = get_logger("utopian-io")
 
 # Beem
-steem = Steem()
+steem = steem_client()
 ACCOUNT = "utopian.tasks"
 
 # Spreadsheet variables
@@ -52,25 +51,59 @@ previous_reviewed = sheet.worksheet(title_previous)
 current_reviewed = sheet.worksheet(title_current)
 
 
-def main():
-    """Gets all task requests that are above the minimum score and resteems
-    them if they haven't been resteemed yet.
+def resteem_post(url):
+    """Resteems the post unless it has been resteemed already. Runs as a task
+    of the work queue, so errors are raised to have it retried.
+    """
+    post = Comment(url)
+    if ACCOUNT in post.get_reblogged_by():
+        return
+    post.resteem(account=Account(ACCOUNT))
+    metrics.record_broadcast("resteem")
+    rc_budget.spend(ACCOUNT, "custom_json")
+    logger.info(f"Resteemed {url}")
+
+
+def resteem_tasks():
+    """Gets all task requests that are above the minimum score and enqueues
+    the resteem of the ones that haven't been enqueued yet. The queue keeps
+    the finished tasks, so only the new rows of the sheets become tasks.
     """
     # Get data from both the current sheet and previous one
-    previous = previous_reviewed.get_all_values()
-    current = current_reviewed.get_all_values()
+    with metrics.stage("fetch_sheets"):
+        previous = previous_reviewed.get_all_values()
+        current = current_reviewed.get_all_values()
     reviewed = previous[1:] + current[1:]
 
-    account = Account(ACCOUNT)
+    budget = rc_budget.budget(ACCOUNT, steem)
     # Resteem all eligible contributions that haven't been resteemed already
     for row in reviewed:
         category = row[4]
         score = float(row[5])
         if "task" in category and score > MINIMUM_SCORE:
             url = row[2]
-            post = Comment(url)
-            if ACCOUNT not in post.get_reblogged_by():
-                post.resteem(account=account)
+            key = f"resteem:{url}"
+            if work_queue.queue().known(key):
+                continue
+            if not budget.reserve({"custom_json": 1}):
+                logger.warning("Not enough resource credits to resteem "
+                               f"{url}, stopping")
+                break
+            work_queue.enqueue("resteem", {"url": url}, key=key)
+    work_queue.drain(QUEUE_TASKS)
+    budget.release()
+
+
+def main():
+    """Resteems all task requests above the minimum score."""
+    metrics.start("resteem")
+    try:
+        resteem_tasks()
+    finally:
+        metrics.export()
 
 if __name__ == '__main__':
+    args = profiling.argument_parser(main.__doc__).parse_args()
+    if args.profile:
+        profiling.enable(args.profile_dir)
     main()
@@ -0,0 +1,110 @@
+"""
+Decides the order in which the actions of a vote plan are executed. Every
+action has a deadline, the voting cutoff of its post, and a value, its voting
+weight. The most valuable action is executed first unless that would make
+another action miss its deadline, and actions that can no longer land before
+their deadline are dropped before any time is spent on them. A run that is cut
+short by time, voting power or resource credits has then still cast the most
+valuable votes it could.
+"""
+
+import calendar
+import math
+import time
+
+from dateutil.parser import parse
+
+from constants import VOTE_CUTOFF, VOTE_INTERVAL
+
+# Initial estimate of how many seconds an action takes, including the pause
+# between votes, and how quickly the estimate follows the measured durations
+ACTION_TIME = VOTE_INTERVAL + 2.0
+SMOOTHING = 0.2
+
+
+def deadline(action):
+    """Returns the Unix time before which the action's vote has to land, or
+    infinity if the plan doesn't say when its post was created.
+    """
+    created = action.get("created")
+    if not created:
+        return math.inf
+    created = calendar.timegm(parse(created).utctimetuple())
+    return created + VOTE_CUTOFF.total_seconds()
+
+
+class ActionScheduler():
+    """Schedules the actions of a plan with the given indices. If `capacity`
+    is given only that many of the most valuable actions are scheduled.
+    """
+    def __init__(self, actions, indices=None, capacity=None, clock=time.time):
+        self.clock = clock
+        self.action_time = ACTION_TIME
+        self.expired = []
+
+        if indices is None:
+            indices = range(len(actions))
+        pending = [(deadline(actions[index]), actions[index]["voting_weight"],
+                    index) for index in indices]
+        if capacity is not None and capacity < len(pending):
+            pending = sorted(pending, key=lambda x: (-x[1], x[2]))[:capacity]
+
+        # Pending actions in the order of their deadlines
+        self.pending = sorted(pending, key=lambda x: (x[0], x[2]))
+
+    def __len__(self):
+        return len(self.pending)
+
+    def least_valuable(self, last):
+        """Returns the position of the least valuable action up to the given
+        position, preferring the action that comes latest in the plan.
+        """
+        return min(range(last + 1),
+                   key=lambda x: (self.pending[x][1], -self.pending[x][2]))
+
+    def drop_expired(self, now):
+        """Drops the least valuable actions until every pending action can
+        land before its deadline when they are executed in deadline order.
+        """
+        while self.pending:
+            finish = now
+            for position, (action_deadline, _, _) in enumerate(self.pending):
+                finish += self.action_time
+                if finish > action_deadline:
+                    break
+            else:
+                return
+
+            dropped = self.pending.pop(self.least_valuable(position))
+            self.expired.append(dropped[2])
+
+    def pop(self):
+        """Returns the index of the action to execute next, or None if there
+        are none left. Any action that comes before the first one without time
+        to spare (in deadline order) can be executed first without making
+        another miss its deadline, so the most valuable of those is chosen.
+        """
+        self.drop_expired(self.clock())
+        if not self.pending:
+            return None
+
+        finish = self.clock()
+        last = len(self.pending) - 1
+        for position, (action_deadline, _, _) in enumerate(self.pending):
+            finish += self.action_time
+            if action_deadline - finish < self.action_time:
+                last = position
+                break
+
+        best = max(range(last + 1),
+                   key=lambda x: (self.pending[x][1], -self.pending[x][2]))
+        return self.pending.pop(best)[2]
+
+    def take_expired(self):
+        """Returns the indices of the actions dropped since the last call."""
+        expired, self.expired = self.expired, []
+        return expired
+
+    def finished(self, duration):
+        """Updates the estimated duration of an action with a measured one."""
+        self.action_time += SMOOTHING * (duration - self.action_time)
@@ -0,0 +1,244 @@
+"""
+Offline simulator for tuning the voting power budget. Archived batch run
+inputs are replayed through the planner for every combination of the given
+parameters (`VP_TOTAL`, `VP_COMMENTS`, `CATEGORY_WEIGHTING`,
+`MODERATION_REWARD` and the trails' `weight_multiplier` and `max_weight`),
+spread over a process pool, and the voting power spent, contributions voted
+and unused budget of each combination are reported.
+
+The sweep is described by a JSON file in which every parameter maps to the
+list of values to try, for example
+
+    {
+        "vp_total": [16.0, 18.0, 20.0],
+        "vp_comments": [2.5, 3.2],
+        "trail": {"steemstem": {"weight_multiplier": [0.3, 0.4]}}
+    }
+
+Parameters that are left out keep their value from `constants.py`.
+"""
+
+import csv
+import glob
+import itertools
+import json
+import multiprocessing
+import multiprocessing.util
+import os
+import sys
+import time
+
+from constants import (ARCHIVE_DIR, CATEGORY_WEIGHTING, LOGGER,
+                       MODERATION_REWARD, TRAIL_ACCOUNTS, VP_COMMENTS,
+                       VP_TOTAL)
+from planner import build_plan, plan_trail, read_plan
+import profiling
+
+FIELDS = ["batches", "vp_spent", "vp_comments_spent",
+          "vp_contributions_spent", "vp_trail_spent", "unused_budget",
+          "comments_voted", "contributions_voted", "contributions_skipped",
+          "trail_voted"]
+
+_BATCHES = []
+
+
+def load_batches(directory=ARCHIVE_DIR):
+    """Returns the archived batch run inputs in the given directory, oldest
+    first.
+    """
+    paths = sorted(glob.glob(os.path.join(directory, "inputs-*.json")))
+    return [read_plan(path) for path in paths]
+
+
+def account_inputs(inputs):
+    """Returns the inputs of a single account with full voting power, as used
+    by `build_plan`, from archived inputs.
+    """
+    if "accounts" in inputs:
+        voting_value = next(iter(inputs["accounts"].values()))["voting_value"]
+    else:
+        voting_value = inputs["voting_value"]
+
+    return {
+        "voting_power": 100.0,
+        "voting_value": voting_value,
+        "comments": inputs["comments"],
+        "contributions": inputs["contributions"],
+        "trail": inputs["trail"],
+    }
+
+
+def combinations(sweep):
+    """Yields every combination of parameters in the sweep."""
+    trails = sweep.get("trail", {})
+    trail_keys = [(trail_name, key) for trail_name in sorted(trails)
+                  for key in sorted(trails[trail_name])]
+    keys = ["vp_total", "vp_comments", "category_weighting",
+            "moderation_reward"]
+    defaults = {
+        "vp_total": [VP_TOTAL],
+        "vp_comments": [VP_COMMENTS],
+        "category_weighting": [CATEGORY_WEIGHTING],
+        "moderation_reward": [MODERATION_REWARD],
+    }
+    values = [sweep.get(key, defaults[key]) for key in keys]
+    values += [trails[trail_name][key] for trail_name, key in trail_keys]
+
+    for combination in itertools.product(*values):
+        parameters = dict(zip(keys, combination))
+        parameters["trail"] = {}
+        for (trail_name, key), value in zip(trail_keys,
+                                            combination[len(keys):]):
+            parameters["trail"].setdefault(trail_name, {})[key] = value
+        yield parameters
+
+
+def trail_weights(trail, settings):
+    """Returns the trail contributions with their voting weight recomputed
+    for the simulated trail settings.
+    """
+    contributions = []
+    for contribution in trail:
+        trail_name = contribution["trail_name"]
+        trail_settings = dict(TRAIL_ACCOUNTS[trail_name],
+                              **settings.get(trail_name, {}))
+        voting_weight = min(
+            contribution["weight"] * trail_settings["weight_multiplier"] /
+            100.0, trail_settings["max_weight"] / 100.0)
+        contributions.append(dict(contribution, voting_weight=voting_weight))
+    return contributions
+
+
+def simulate_batch(inputs, parameters):
+    """Returns the results of planning the given batch with the parameters."""
+    plan = build_plan(dict(inputs, trail=[]), parameters["vp_total"],
+                      parameters["vp_comments"],
+                      parameters["category_weighting"],
+                      parameters["moderation_reward"])
+    voting_power = plan["expected_voting_power"]
+
+    trail = trail_weights(inputs["trail"], parameters["trail"])
+    trail_actions, _ = plan_trail(trail, voting_power)
+
+    spent = {"comment": 0.0, "contribution": 0.0}
+    voted = {"comment": 0, "contribution": 0}
+    for action in plan["actions"]:
+        spent[action["type"]] += action["usage"]
+        voted[action["type"]] += 1
+
+    batch_spent = spent["comment"] + spent["contribution"]
+    trail_spent = sum(action["usage"] for action in trail_actions)
+
+    return {
+        "vp_spent": batch_spent + trail_spent,
+        "vp_comments_spent": spent["comment"],
+        "vp_contributions_spent": spent["contribution"],
+        "vp_trail_spent": trail_spent,
+        "unused_budget": max(parameters["vp_total"] - batch_spent, 0.0),
+        "comments_voted": voted["comment"],
+        "contributions_voted": voted["contribution"],
+        "contributions_skipped": (len(inputs["contributions"]) -
+                                  voted["contribution"]),
+        "trail_voted": len(trail_actions),
+    }
+
+
+def simulate(parameters):
+    """Returns the totals of replaying every loaded batch with the given
+    parameters.
+    """
+    totals = dict.fromkeys(FIELDS, 0)
+    for inputs in _BATCHES:
+        for key, value in simulate_batch(inputs, parameters).items():
+            totals[key] += value
+    totals["batches"] = len(_BATCHES)
+    return parameters, totals
+
+
+def init_worker(batches):
+    """Keeps the batches in the worker and silences the planner's logging,
+    which would otherwise write thousands of tables to the log. When
+    profiling, the worker writes its profile once the pool is closed.
+    """
+    _BATCHES[:] = batches
+    LOGGER.disabled = True
+    if profiling.is_enabled():
+        multiprocessing.util.Finalize(None, profiling.write, exitpriority=10)
+
+
+def sweep(batches, parameters, processes=None, chunksize=16):
+    """Yields the parameters and totals of every combination, evaluated in a
+    process pool.
+    """
+    context = multiprocessing.get_context("fork")
+    with context.Pool(processes, initializer=init_worker,
+                      initargs=(batches,)) as pool:
+        for result in pool.imap(simulate, parameters, chunksize):
+            yield result
+        # Let the workers exit on their own instead of being terminated, so
+        # they run their finalizers
+        pool.close()
+        pool.join()
+
+
+def describe(parameters):
+    """Returns a short, flat description of the parameters of a combination,
+    leaving out the category weighting and moderation reward dictionaries
+    (which are identified by their index in the sweep instead).
+    """
+    description = {
+        "vp_total": parameters["vp_total"],
+        "vp_comments": parameters["vp_comments"],
+    }
+    for trail_name, settings in sorted(parameters["trail"].items()):
+        for key, value in sorted(settings.items()):
+            description[f"{trail_name}.{key}"] = value
+    return description
+
+
+def main(sweep_path, archive_dir=ARCHIVE_DIR, output=None, processes=None):
+    """Replays the archived batches for every combination of parameters in
+    the sweep and writes the results as CSV.
+    """
+    with open(sweep_path) as fd:
+        sweep_config = json.load(fd)
+
+    batches = [account_inputs(inputs) for inputs in load_batches(archive_dir)]
+    parameters = list(combinations(sweep_config))
+    weightings = sweep_config.get("category_weighting", [CATEGORY_WEIGHTING])
+    rewards = sweep_config.get("moderation_reward", [MODERATION_REWARD])
+
+    start = time.perf_counter()
+    fd = open(output, "w", newline="") if output else sys.stdout
+    try:
+        writer = None
+        for combination, totals in sweep(batches, parameters, processes):
+            row = describe(combination)
+            row["category_weighting"] = weightings.index(
+                combination["category_weighting"])
+            row["moderation_reward"] = rewards.index(
+                combination["moderation_reward"])
+            row.update(totals)
+            if writer is None:
+                writer = csv.DictWriter(fd, fieldnames=list(row))
+                writer.writeheader()
+            writer.writerow(row)
+    finally:
+        if output:
+            fd.close()
+
+    print(f"Simulated {len(parameters)} combinations over {len(batches)} "
+          f"batches in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+if __name__ == '__main__':
+    parser = profiling.argument_parser(main.__doc__)
+    parser.add_argument("sweep", help="JSON file describing the sweep")
+    parser.add_argument("--archive", default=ARCHIVE_DIR,
+                        help="directory with the archived batch inputs")
+    parser.add_argument("--output", help="CSV file to write the results to")
+    parser.add_argument("--processes", type=int,
+                        help="number of worker processes")
+    args = parser.parse_args()
+    if args.profile:
+        profiling.enable(args.profile_dir)
+    main(args.sweep, args.archive, args.output, args.processes)
@@ -0,0 +1,304 @@
+"""
+Follows the trails in real time. Instead of waiting for the next batch run to
+scan the trails' account history, the follower streams vote operations from
+the blockchain as blocks are produced, applies the same rules as the batch run
+and queues the accepted posts, which are upvoted as soon as the account's
+voting power allows it. The replies to them are sent from the work queue.
+
+The follower runs alongside the batch run, which only starts once the
+account's voting power is back at 100%. So the follower doesn't spend
+everything above `TRAIL_VP_FLOOR`, only the trail's share of the voting power
+that regenerates: what the batch leaves for the trail above the floor.
+"""
+
+import heapq
+import json
+import time
+from datetime import datetime, timedelta
+
+from beem.blockchain import Blockchain
+
+from constants import (ACCOUNT, LOGGER, STEEM, TRAIL_ACCOUNTS, TRAIL_VP_FLOOR,
+                       VP_TOTAL)
+from database.database_handler import DatabaseHandler
+from upvote_bot import (get_account, handle_trail_contribution, trail_post,
+                        trail_vote, trail_voting_weight,
+                        valid_trail_contribution)
+import metrics
+import profiling
+import rc_budget
+import work_queue
+
+# Voting power regenerates 20% a day
+VP_REGENERATION = 20.0 / 86400
+# Voting power the trail gets per batch run: what the batch leaves above the
+# floor when it starts at 100%
+TRAIL_BUDGET = max(100.0 - VP_TOTAL - TRAIL_VP_FLOOR, 0.0)
+# Share of the regenerated voting power the follower may spend, so the rest
+# brings the account back to 100% for the next batch run
+TRAIL_SHARE = TRAIL_BUDGET / (VP_TOTAL + TRAIL_BUDGET)
+# Seconds to wait before resuming the block stream after the node failed
+RECONNECT_DELAY = 10
+# How often the number of upvotes per trail is reloaded from the database
+REFRESH_INTERVAL = 3600
+# How often the queued replies to the trail contributions are sent
+REPLY_INTERVAL = 5
+EXPORT_INTERVAL = 60
+
+
+class TrailQueue():
+    """Queue of accepted trail contributions, which are handed out priority
+    trails and highest weights first, as long as voting on them keeps the
+    estimated voting power above the floor and fits in the allowance. The
+    allowance grows by the trail's `share` of the voting power that
+    regenerates, up to the trail's `budget`, and starts out empty.
+    """
+    def __init__(self, voting_power, floor=TRAIL_VP_FLOOR, share=TRAIL_SHARE,
+                 budget=TRAIL_BUDGET, clock=time.time):
+        self.voting_power = voting_power
+        self.floor = floor
+        self.share = share
+        self.budget = budget
+        self.allowance = 0.0
+        self.clock = clock
+        self.updated = clock()
+        self.queue = []
+        self.queued = set()
+        self.counter = 0
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __contains__(self, authorperm):
+        return authorperm in self.queued
+
+    def push(self, contribution):
+        key = (not contribution["is_priority"],
+               -contribution["voting_weight"], self.counter)
+        heapq.heappush(self.queue, (key, contribution))
+        self.queued.add(contribution["authorperm"])
+        self.counter += 1
+
+    def current_voting_power(self):
+        """Returns the estimated voting power, including what has regenerated
+        since it was last updated, and adds the trail's share of it to the
+        allowance.
+        """
+        now = self.clock()
+        regenerated = (now - self.updated) * VP_REGENERATION
+        self.voting_power = min(100.0, self.voting_power + regenerated)
+        self.allowance = min(self.budget,
+                             self.allowance + regenerated * self.share)
+        self.updated = now
+        return self.voting_power
+
+    def pop(self):
+        """Returns the next contribution if there is enough voting power to
+        vote on it, otherwise None.
+        """
+        if not self.queue:
+            return None
+
+        voting_power = self.current_voting_power()
+        contribution = self.queue[0][1]
+        usage = contribution["voting_weight"] / 100.0 * 0.02 * voting_power
+
+        if voting_power - usage < self.floor or usage > self.allowance:
+            return None
+
+        heapq.heappop(self.queue)
+        self.queued.discard(contribution["authorperm"])
+        return contribution
+
+    def spend(self, voting_weight):
+        """Subtracts the voting power used by a vote of the given weight."""
+        voting_power = self.current_voting_power()
+        usage = voting_weight / 100.0 * 0.02 * voting_power
+        self.voting_power -= usage
+        self.allowance -= usage
+
+
+class ReplayBlockchain():
+    """Local stand-in for beem's `Blockchain` that produces recorded
+    operations (one JSON object per line) instead of streaming them from a
+    node, so the follower can be run without touching the chain.
+    """
+    def __init__(self, path, delay=0.0):
+        self.path = path
+        self.delay = delay
+
+    def stream(self, opNames=None, **kwargs):
+        with open(self.path) as fd:
+            for line in fd:
+                operation = json.loads(line)
+                if opNames and operation.get("type") not in opNames:
+                    continue
+                yield operation
+                time.sleep(self.delay)
+
+
+def upvoted_per_trail():
+    """Returns the number of contributions upvoted for each trail in the
+    last week.
+    """
+    database = DatabaseHandler.get_instance()
+    week_ago = datetime.now() - timedelta(days=7)
+    return {trail_name: database.number_upvoted(trail_name, week_ago)
+            for trail_name in TRAIL_ACCOUNTS.keys()}
+
+
+def accept_vote(vote, queue, number_upvoted, fetch=trail_post):
+    """Queues the post the vote was cast on if the vote was made by one of the
+    trails and the post passes the same checks as in the batch run.
+    """
+    candidate = trail_vote(vote)
+    if not candidate or candidate["authorperm"] in queue:
+        return False
+
+    trail_name = candidate["trail_name"]
+    settings = TRAIL_ACCOUNTS[trail_name]
+
+    if number_upvoted[trail_name] > settings["upvote_limit"]:
+        return False
+
+    post = fetch(candidate["authorperm"])
+    if post is None:
+        return False
+
+    if settings["check_context"] and not valid_trail_contribution(post):
+        return False
+
+    queue.push(dict(
+        candidate,
+        authorperm=post["authorperm"],
+        id=post["id"],
+        voting_weight=trail_voting_weight(trail_name, candidate["weight"]),
+        is_priority=settings["is_priority"],
+    ))
+    number_upvoted[trail_name] += 1
+    LOGGER.info(f"Queued trail contribution from {trail_name}: "
+                f"{post['authorperm']}")
+    return True
+
+
+def drain(queue, vote=handle_trail_contribution, budget=None):
+    """Votes on queued contributions for as long as the voting power (and the
+    resource credits, if a budget is given) allows it.
+    """
+    while True:
+        contribution = queue.pop()
+        if contribution is None:
+            return
+
+        if budget and not budget.reserve({"vote": 1, "comment": 1}):
+            queue.push(contribution)
+            return
+
+        voting_power = queue.current_voting_power()
+        if vote(contribution, voting_power):
+            queue.spend(contribution["voting_weight"])
+
+        if budget:
+            budget.release()
+
+
+def stream_votes(blockchain, delay=RECONNECT_DELAY):
+    """Yields the vote operations of the given blockchain. When the stream
+    fails (e.g. because the node is down) it's resumed from the last block,
+    skipping the operations of that block that were already yielded.
+    """
+    block = None
+    handled = 0
+    while True:
+        skip = handled
+        try:
+            for operation in blockchain.stream(opNames=["vote"], start=block):
+                number = operation.get("block_num")
+                if number != block:
+                    block, handled, skip = number, 0, 0
+                elif skip:
+                    skip -= 1
+                    continue
+                handled += 1
+                yield operation
+            return
+        except Exception as error:
+            LOGGER.error(f"Lost the block stream after block {block}, "
+                         f"resuming in {delay}s: {error}")
+            time.sleep(delay)
+
+
+def send_replies():
+    """Sends the queued replies to trail contributions whose turn it is."""
+    work_queue.run_available("trail_follower", ["reply_trail"])
+
+
+def follow(blockchain, queue, vote=handle_trail_contribution,
+           fetch=trail_post, clock=time.time, budget=None, reply=None):
+    """Streams vote operations from the given blockchain (anything with a
+    beem-like `stream` method) and votes on the trails' posts as they
+    arrive. The replies to the posts are left to the work queue, and sent
+    with `reply` every `REPLY_INTERVAL` seconds if it's given.
+    """
+    number_upvoted = upvoted_per_trail()
+    refreshed = exported = replied = clock()
+
+    for operation in stream_votes(blockchain):
+        now = clock()
+        if now - refreshed > REFRESH_INTERVAL:
+            number_upvoted = upvoted_per_trail()
+            refreshed = now
+
+        accept_vote(operation, queue, number_upvoted, fetch)
+        drain(queue, vote, budget)
+
+        if reply and now - replied > REPLY_INTERVAL:
+            reply()
+            replied = now
+
+        if now - exported > EXPORT_INTERVAL:
+            metrics.set_gauge("utopian_trail_queue_length", len(queue))
+            metrics.export()
+            exported = now
+
+
+def dry_run_vote(contribution, voting_power):
+    """Logs the vote that would be cast instead of broadcasting it."""
+    LOGGER.info(f"Would upvote trail contribution "
+                f"({contribution['voting_weight']:.2f}%): "
+                f"{contribution['authorperm']}")
+    return True
+
+
+def main(replay_path=None, dry_run=False):
+    """Follows the trails' votes on the blockchain in real time."""
+    metrics.start("trail_follower")
+
+    if replay_path:
+        blockchain = ReplayBlockchain(replay_path)
+    else:
+        blockchain = Blockchain(steem_instance=STEEM, mode="head")
+
+    queue = TrailQueue(get_account(ACCOUNT).get_voting_power())
+    vote = dry_run_vote if dry_run else handle_trail_contribution
+    budget = None if dry_run else rc_budget.budget(ACCOUNT, STEEM)
+    reply = None if dry_run else send_replies
+
+    LOGGER.info("STARTED FOLLOWING TRAILS")
+    try:
+        follow(blockchain, queue, vote, budget=budget, reply=reply)
+    finally:
+        metrics.export()
+        LOGGER.info("STOPPED FOLLOWING TRAILS")
+
+if __name__ == '__main__':
+    parser = profiling.argument_parser(main.__doc__)
+    parser.add_argument("--replay", metavar="PATH",
+                        help="replay vote operations recorded in the given "
+                             "file instead of streaming them from the chain")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="log the votes instead of broadcasting them")
+    args = parser.parse_args()
+    if args.profile:
+        profiling.enable(args.profile_dir)
+    main(args.replay, args.dry_run)
@@ -1,42 +1,60 @@
-from beem import Steem
 from beem.account import Account
+from connections import steem_client
 from datetime import datetime
 from dateutil.parser import parse
-import logging
+from logger import get_logger
+import metrics
 import os
+import profiling
+import rc_budget
 
 # Beem
-steem = Steem()
+steem = steem_client()
 ACCOUNT = "utopian.signup"
 
 # Get path of current folder
 DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 
 # Logging
-logger = logging.getLogger("utopian-io")
-logger.setLevel(logging.INFO)
-fh = logging.FileHandler(f"{DIR_PATH}/bot.log")
-fh.setLevel(logging.DEBUG)
-formatter = logging.Formatter(
-    "%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-fh.setFormatter(formatter)
-logger.addHandler(fh)
+logger = get_logger("utopian-io")
 
 
 def get_delegations(limit):
     return steem.rpc.get_vesting_delegations(ACCOUNT, 0, limit)
 
 
-def main():
+def undelegate():
     account = Account(ACCOUNT)
+    budget = rc_budget.budget(ACCOUNT, steem)
     today = datetime.today()
-    for delegation in get_delegations(1000):
+    with metrics.stage("fetch_delegations"):
+        delegations = get_delegations(1000)
+    for delegation in delegations:
         min_delegation_time = parse(delegation["min_delegation_time"])
         delegatee = delegation["delegatee"]
         # Check if delegation should be withdrawn
         if today > min_delegation_time:
+            if not budget.reserve({"delegate_vesting_shares": 1}):
+                logger.warning("Not enough resource credits to undelegate, "
+                               "stopping")
+                break
             logger.info(f"Undelegating from {delegatee}")
             account.delegate_vesting_shares(delegatee, "0", ACCOUNT)
+            metrics.record_broadcast("delegate_vesting_shares")
+            budget.spend("delegate_vesting_shares")
+    budget.release()
+
+
+def main():
+    """Removes all delegations that can be withdrawn."""
+    metrics.start("undelegate")
+    try:
+        undelegate()
+    finally:
+        metrics.export()
 
 if __name__ == '__main__':
+    args = profiling.argument_parser(main.__doc__).parse_args()
+    if args.profile:
+        profiling.enable(args.profile_dir)
     main()
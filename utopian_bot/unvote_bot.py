@@ -1,26 +1,38 @@
-from beem.account import Account
 from beem.comment import Comment, RecentReplies
-from contribution import Contribution
 from datetime import timedelta
+from post_cache import lazy_post, post_metadata, vote_weights
+import chain_cache
 import constants
 import json
+import metrics
 import os
+import profiling
+import rc_budget
+import work_queue
+
+DRIVE_FILES_URL = "https://www.googleapis.com/drive/v3/files"
+REVIEWS_PATH = os.environ.get("REVIEWS_PATH",
+                              f"{constants.DIR_PATH}/reviews.json")
+# Kinds of tasks the bot leaves to the work queue
+QUEUE_TASKS = ("unvote", "edit_comment", "mark_unvoted")
 
 
 def get_replies(post):
     """
     Gets all replies to the given post.
     """
-    url = f"{post.category}/{post.authorperm}"
+    url = f"{post['category']}/{post['authorperm']}"
     return constants.STEEM.rpc.get_state(url)["content"].keys()
 
 
-def update_comment(post):
+def update_comment(url):
     """
     Updates the comment left by the bot to reflect that the contribution was
-    unvoted.
+    unvoted. Runs as a task of the work queue, so errors are raised to have it
+    retried.
     """
-    body = constants.COMMENT_UNVOTE.format(post.author)
+    post = post_metadata(url, constants.STEEM)
+    body = constants.COMMENT_UNVOTE.format(post["author"])
 
     # Iterate over replies until bot's comment is found
     for comment in get_replies(post):
@@ -29,71 +41,238 @@ def update_comment(post):
             try:
                 constants.LOGGER.info(f"Updating comment {comment.authorperm}")
                 comment.edit(body, replace=True)
+                metrics.record_broadcast("comment")
+                rc_budget.spend(constants.ACCOUNT, "comment")
             except Exception as error:
                 constants.LOGGER.error(error)
+                raise
             return
 
 
-def unvote_post(row, previous, current):
+def reviewed_worksheet(title):
+    """
+    Returns the worksheet with the given title, which is usually one of the
+    two that were opened at startup.
+    """
+    for worksheet in (constants.PREVIOUS_REVIEWED, constants.CURRENT_REVIEWED):
+        if worksheet.title == title:
+            return worksheet
+    return constants.SHEET.worksheet(title)
+
+
+def zero_score(score):
+    """
+    Returns True if the score in the sheet is 0, and not empty or something
+    else.
+    """
+    try:
+        return float(score) == 0
+    except ValueError:
+        return False
+
+
+def find_row(worksheet, row_index, url):
+    """
+    Returns the index and values of the row of the worksheet that holds the
+    URL, looking for it in the whole worksheet if it's no longer in the given
+    row (e.g. because rows were inserted or sorted), or None if it isn't in
+    the worksheet at all.
+    """
+    row = worksheet.row_values(row_index)
+    if len(row) > 2 and row[2] == url:
+        return row_index, row
+
+    urls = worksheet.col_values(3)
+    if url not in urls:
+        return None
+    row_index = urls.index(url) + 1
+    return row_index, worksheet.row_values(row_index)
+
+
+def unvoted_row(title, row_index, url):
+    """
+    Returns the index of the row of the worksheet with the given title that
+    holds the URL, or None if the post isn't in it anymore or its score is no
+    longer 0, so it mustn't be unvoted.
+    """
+    found = find_row(reviewed_worksheet(title), row_index, url)
+    # gspread trims the row's trailing empty cells, so it can be too short to
+    # hold the score
+    if found is None or len(found[1]) < 6 or not zero_score(found[1][5]):
+        constants.LOGGER.info(f"{url} no longer has a score of 0 in {title}")
+        return None
+    return found[0]
+
+
+def mark_unvoted(title, row_index, url):
+    """
+    Updates the row of an unvoted contribution in the worksheet with the given
+    title to reflect this.
+    """
+    row_index = unvoted_row(title, row_index, url)
+    if row_index is None:
+        return
+
+    worksheet = reviewed_worksheet(title)
+    worksheet.update_cell(row_index, 11, "Unvoted")
+    worksheet.update_cell(row_index, 12, 0)
+
+
+def unvote_post(title, row_index, url):
     """
-    Unvotes the given post and updates the spreadsheet to reflect this.
+    Unvotes the post with the given URL, seen in the given row of the
+    worksheet with the given title, and enqueues the edit of the bot's comment
+    and the update of the row. Runs as a task of the work queue, so errors are
+    raised to have it retried, and a post that was already unvoted isn't
+    unvoted again. The task can run a while after the row was seen, so the
+    post is only unvoted if the sheet still gives it a score of 0.
     """
-    url = row.url
-    account = Account(constants.ACCOUNT)
-    post = Comment(url, steem_instance=constants.STEEM)
+    row_index = unvoted_row(title, row_index, url)
+    if row_index is None:
+        return
 
-    votes = [vote["voter"] for vote in post.json()["active_votes"]]
-    if constants.ACCOUNT not in votes:
+    weights = vote_weights(url, constants.STEEM)
+    if constants.ACCOUNT not in weights:
         constants.LOGGER.info(f"Never voted on {url} in the first place!")
         return
 
     # Unvote the post
+    if weights[constants.ACCOUNT] > 0:
+        account = chain_cache.account(constants.ACCOUNT, constants.STEEM)
+        try:
+            constants.LOGGER.info(f"Unvoting {url}")
+            lazy_post(url, constants.STEEM).vote(0, account=account)
+            metrics.record_broadcast("vote")
+            rc_budget.spend(constants.ACCOUNT, "vote")
+            chain_cache.invalidate(constants.ACCOUNT)
+        except Exception as error:
+            constants.LOGGER.error(error)
+            raise
+
+    work_queue.enqueue("edit_comment", {"url": url},
+                       key=f"edit_comment:{url}",
+                       throttle=f"{constants.ACCOUNT}:comment")
+    work_queue.enqueue("mark_unvoted",
+                       {"title": title, "row_index": row_index, "url": url},
+                       key=f"mark_unvoted:{url}")
+
+
+def sheet_modified(spreadsheet):
+    """
+    Returns the time the spreadsheet was last modified according to Drive,
+    which is a single small request.
+    """
+    response = spreadsheet.client.request(
+        "get", f"{DRIVE_FILES_URL}/{spreadsheet.id}",
+        params={"fields": "modifiedTime"})
+    return response.json()["modifiedTime"]
+
+
+def fingerprints(spreadsheet, worksheet):
+    """
+    Returns the URL, score and vote status of every row in the worksheet,
+    fetched as a single range instead of the whole worksheet.
+    """
+    response = spreadsheet.values_get(f"'{worksheet.title}'!C2:K")
+    rows = response.get("values", [])
+    return [[row[index] if len(row) > index else "" for index in (0, 3, 8)]
+            for row in rows]
+
+
+def changed_rows(old, new):
+    """
+    Returns the sheet row indices of the rows whose fingerprint has changed or
+    that have been added.
+    """
+    return [index + 2 for index, fingerprint in enumerate(new)
+            if index >= len(old) or old[index] != fingerprint]
+
+
+def read_state(path):
     try:
-        constants.LOGGER.info(f"Unvoting {url}")
-        post.vote(0, account=account)
-        update_comment(post)
-    except Exception as error:
-        constants.LOGGER.error(error)
-
-    previous_reviewed = constants.SHEET.worksheet(constants.TITLE_PREVIOUS)
-    current_reviewed = constants.SHEET.worksheet(constants.TITLE_CURRENT)
-
-    row = list(row.__dict__.values())
-    if row in previous:
-        row_index = previous.index(row) + 1
-        previous_reviewed.update_cell(row_index, 11, "Unvoted")
-        previous_reviewed.update_cell(row_index, 12, 0)
-    elif row in current:
-        row_index = current.index(row) + 1
-        current_reviewed.update_cell(row_index, 11, "Unvoted")
-        current_reviewed.update_cell(row_index, 12, 0)
+        with open(path) as fd:
+            state = json.load(fd)
+    except (OSError, ValueError):
+        return None
+    # Older versions stored the rows of both worksheets in a list
+    if not isinstance(state, dict):
+        return None
+    return state
 
 
-def main():
+def write_state(state, path):
+    with open(path, "w") as fd:
+        json.dump(state, fd, separators=(",", ":"))
+
+
+def check_reviews(spreadsheet=None, worksheets=None, state_path=None):
     """
     Checks if post's score has been changed to zero and unvotes it if
-    necessary.
-    """
-    # Get data from both the current sheet and previous one
-    previous = constants.PREVIOUS_REVIEWED.get_all_values()
-    current = constants.CURRENT_REVIEWED.get_all_values()
-    reviewed = previous[1:] + current[1:]
-
-    # If file already exists compare with current data
-    if os.path.isfile(f"{constants.DIR_PATH}/reviews.json"):
-        with open(f"{constants.DIR_PATH}/reviews.json") as fd:
-            data = json.load(fd)
-        for row in reviewed:
-            row = Contribution(row)
-            # Row has been changed
-            if row not in data:
-                score = float(row.score)
+    necessary. Nothing is fetched from the worksheets if the spreadsheet
+    hasn't been modified since the last run, and otherwise only the rows
+    that have changed are. The unvotes are enqueued in the work queue.
+    """
+    spreadsheet = spreadsheet or constants.SHEET
+    worksheets = worksheets or [constants.PREVIOUS_REVIEWED,
+                                constants.CURRENT_REVIEWED]
+    state_path = state_path or REVIEWS_PATH
+
+    state = read_state(state_path)
+    with metrics.stage("fetch_sheets"):
+        modified = sheet_modified(spreadsheet)
+    if state and state.get("modified") == modified:
+        constants.LOGGER.info("Sheet hasn't changed since the last check")
+        return
+
+    with metrics.stage("fetch_sheets"):
+        sheets = {worksheet.title: fingerprints(spreadsheet, worksheet)
+                  for worksheet in worksheets}
+
+    # The first run only records the sheets
+    if state:
+        budget = rc_budget.budget(constants.ACCOUNT, constants.STEEM)
+        for worksheet in worksheets:
+            new = sheets[worksheet.title]
+            old = state["sheets"].get(worksheet.title, [])
+            for row_index in changed_rows(old, new):
+                url, score, vote_status = new[row_index - 2]
                 # Only unvote posts with score 0 that have been voted on
-                if score == 0 and row.vote_status == "Yes":
-                    unvote_post(row, previous, current)
+                if not url or vote_status != "Yes" or not zero_score(score):
+                    continue
 
-    with open(f"{constants.DIR_PATH}/reviews.json", "w") as fd:
-        json.dump(reviewed, fd, indent=4)
+                if not budget.reserve({"vote": 1, "comment": 1}):
+                    # Forget the row so it's still seen as changed next run
+                    new[row_index - 2] = None
+                    modified = None
+                    continue
+
+                work_queue.enqueue(
+                    "unvote",
+                    {"title": worksheet.title, "row_index": row_index,
+                     "url": url},
+                    key=f"unvote:{url}",
+                    throttle=f"{constants.ACCOUNT}:vote")
+                new[row_index - 2] = [url, score, "Unvoted"]
+        budget.release()
+
+        if modified is None:
+            constants.LOGGER.warning("Not enough resource credits to unvote "
+                                     "every contribution")
+
+    write_state({"modified": modified, "sheets": sheets}, state_path)
+
+
+def main():
+    """Unvotes contributions whose score was changed to zero."""
+    metrics.start("unvote")
+    try:
+        check_reviews()
+        work_queue.drain(QUEUE_TASKS)
+    finally:
+        metrics.export()
 
 if __name__ == '__main__':
+    args = profiling.argument_parser(main.__doc__).parse_args()
+    if args.profile:
+        profiling.enable(args.profile_dir)
     main()
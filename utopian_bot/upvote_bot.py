@@ -1,367 +1,43 @@
-import json
+import multiprocessing
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from operator import itemgetter
 
-import numpy as np
+import gspread
 import requests
-from beem.account import Account
 from beem.comment import Comment
-from dateutil.parser import parse
-from prettytable import PrettyTable
-from watson_developer_cloud.natural_language_understanding_v1 import (CategoriesResult,
-                                                                      Features)
-
-from constants import (ACCOUNT, CATEGORY_WEIGHTING, COMMENT_BATCH,
-                       COMMENT_FOOTER, COMMENT_HEADER, COMMENT_REVIEW,
-                       COMMENT_STAFF_PICK, CONTRIBUTION_BATCH, LOGGER, LOGGING,
-                       MODERATION_REWARD, SHEET, STEEM, TESTING, TITLE_CURRENT,
-                       TITLE_PREVIOUS, TRAIL_ACCOUNTS, VP_COMMENTS, VP_TOTAL,
-                       WATSON_LABELS, WATSON_SCORE, WATSON_SERVICE)
-from database.database_handler import DatabaseHandler
-
-account = Account(ACCOUNT)
-
-
-def comment_weights_table(comment_weights):
-    """Prints a table containing the voting weight for comments made by
-    moderators in each category.
-    """
-    table = PrettyTable()
-    table.title = "COMMENT WEIGHTS"
-    table.field_names = ["Category", "Weight"]
-
-    for category, weight in sorted(comment_weights.items()):
-        table.add_row([category, f"{weight:.2f}%"])
-
-    table.align["Category"] = "l"
-    table.align["Weight"] = "r"
-
-    LOGGER.info(f"\n{table}")
-
-
-def get_comment_weights():
-    """Returns a dictionary containing the key, value pair of the category and
-    the voting weight needed upvote a review comment with each category's point
-    equivalence in STU.
-    """
-    account = Account("utopian-io")
-    comment_weights = {
-        category: 100.0 * points / account.get_voting_value_SBD() for
-        category, points in MODERATION_REWARD.items()
-    }
-
-    if LOGGING:
-        comment_weights_table(comment_weights)
-
-    return comment_weights
-
-
-def update_weights(comment_weights, comment_usage):
-    """Updates the weights used to upvote comments so that the actual voting
-    power usage is equal to the estimated usage.
-    """
-    desired_usage = 1.0 - VP_COMMENTS / 100.0
-    actual_usage = 1.0 - comment_usage / 100.0
-    scaler = np.log(desired_usage) / np.log(actual_usage)
-
-    for category in comment_weights.keys():
-        comment_weights[category] *= scaler
-
-    return comment_weights
-
-
-def voting_power_usage_table(comment_vp, contribution_vp):
-    """Prints a table containing the voting power usage of all comments and all
-    contributions.
-    """
-    table = PrettyTable()
-    table.title = "VOTING POWER USAGE"
-    table.field_names = ["Type", "Usage"]
-
-    table.add_row(["Comments", f"{comment_vp:.2f}%"])
-    table.add_row(["Contributions", f"{contribution_vp:.2f}%"])
-    table.add_row(["All", f"{comment_vp + contribution_vp:.2f}%"])
-
-    table.align["Type"] = "l"
-    table.align["Usage"] = "r"
-
-    LOGGER.info(f"\n{table}")
-
-
-def comment_voting_power(comments, comment_weights, scaling=1.0):
-    """Returns the amount of voting power that will be used to upvote all the
-    currently pending review comments.
-    """
-    voting_power = 100.0
-    for contribution in sorted(comments, key=lambda x: x["review_date"]):
-        category = contribution["category"]
-        try:
-            voting_weight = comment_weights[category]
-        except KeyError:
-            voting_weight = comment_weights["task-request"]
-
-        usage = scaling * voting_weight / 100.0 * 0.02 * voting_power
-        voting_power -= usage
-
-    return 100.0 - voting_power
-
-
-def sort_batch_contributions(contributions):
-    """Returns the list of contributions sorted by creation date (old -> young)
-    and score (high -> low).
-    """
-    by_creation = sorted(contributions, key=lambda x: x["created"])
-    by_score = sorted(by_creation, key=lambda x: x["score"], reverse=True)
-
-    return by_score
-
-
-def contribution_voting_power(contributions, voting_power, reward_scaler=None):
-    """Returns the amount of voting power that will be used to upvote all the
-    currently pending contributions.
-    """
-    starting_vp = voting_power
-    scaler = 1.0
-    for contribution in sort_batch_contributions(contributions):
-        category = contribution["category"]
-        voting_weight = contribution["voting_weight"]
-
-        if reward_scaler:
-            try:
-                scaler = reward_scaler[category]
-            except KeyError:
-                scaler = reward_scaler["task-request"]
-
-        usage = scaler * voting_weight / 100.0 * 0.02 * voting_power
-        voting_power -= usage
-
-    return starting_vp - voting_power
-
-
-def category_share_table(category_share):
-    """Prints a table containing each category and their share of the allocated
-    voting power for contributions.
-    """
-    table = PrettyTable()
-    table.title = "CATEGORY SHARE"
-    table.field_names = ["Category", "Share"]
-
-    total_share = sum(category_share.values())
-
-    for category, share in sorted(category_share.items()):
-        table.add_row([category, f"{share:.2f}%"])
-
-    table.add_row(["all", f"{total_share:.2f}%"])
-    table.align["Category"] = "l"
-    table.align["Share"] = "r"
-
-    LOGGER.info(f"\n{table}")
-
-
-def get_category_share(voting_power):
-    """Returns a dictionary with a key, value pair of each category and their
-    share of the calculated voting power that can be used for contributions.
-    """
-    total_vote = sum(CATEGORY_WEIGHTING.values())
-    category_share = {category: max_vote / total_vote * voting_power
-                      for category, max_vote in CATEGORY_WEIGHTING.items()}
-
-    if LOGGING:
-        category_share_table(category_share)
-
-    return category_share
-
-
-def category_usage_table(category_usage):
-    """Prints a table containing each category and the amount of voting power
-    will be used to upvote all contributions in the category.
-    """
-    table = PrettyTable()
-    table.title = "CATEGORY USAGE"
-    table.field_names = ["Category", "Usage"]
-
-    for category in sorted(CATEGORY_WEIGHTING.keys()):
-        try:
-            usage = category_usage[category]
-        except KeyError:
-            usage = 0
-        table.add_row([category, f"{usage:.2f}%"])
-
-    table.add_row(["all", f"{sum(category_usage.values()):.2f}%"])
-
-    table.align["Category"] = "l"
-    table.align["Usage"] = "r"
-
-    LOGGER.info(f"\n{table}")
-
-
-def get_category_usage(contributions, voting_power):
-    """Returns a dictionary containing the key, value pair of the category and
-    the amount of voting power it will need to upvote all contributions in the
-    category.
-    """
-    category_usage = {}
-    for contribution in sort_batch_contributions(contributions):
-        category = contribution["category"]
-
-        if "task" in category:
-            category = "task-request"
-
-        category_usage.setdefault(category, 0)
-
-        voting_weight = contribution["voting_weight"]
-        vp_usage = voting_weight / 100.0 * 0.02 * voting_power
-
-        category_usage[category] += vp_usage
-
-    if LOGGING:
-        category_usage_table(category_usage)
-
-    return category_usage
-
-
-def new_share_table(new_share):
-    """Prints a table containing the new share of the voting power of each
-    category.
-    """
-    table = PrettyTable()
-    table.title = "NEW CATEGORY SHARE"
-    table.field_names = ["Category", "Share"]
-
-    for category in sorted(CATEGORY_WEIGHTING.keys()):
-        try:
-            share = new_share[category]
-        except KeyError:
-            share = 0
-        table.add_row([category, f"{share:.2f}%"])
-
-    table.add_row(["all", f"{sum(new_share.values()):.2f}%"])
-
-    table.align["Category"] = "l"
-    table.align["Share"] = "r"
-
-    LOGGER.info(f"\n{table}")
-
-
-def distribute_remainder(remainder, category_usage, new_share, need_more_vp):
-    """Distributes the remaining voting power over the categories that need it.
-    """
-    while remainder > 0:
-        # Get voting power needed for every category
-        needed_per_category = {category: category_usage[category] - share
-                               for category, share in new_share.items()
-                               if category in need_more_vp}
-
-        # Get category who needs the least to reach its usage
-        least_under = min(needed_per_category.items(), key=itemgetter(1))
-        least_under_category = least_under[0]
-        least_needed = least_under[1]
-
-        # If this amount can be added to all categories without using the
-        # entire remainder then do this
-        if len(needed_per_category) * least_needed < remainder:
-            for category in need_more_vp:
-                new_share[category] += least_needed
-                remainder -= least_needed
-            need_more_vp.remove(least_under_category)
-        # Distribute the remainder evenly over the categories that need it
-        else:
-            remaining_categories = len(need_more_vp)
-            for category in need_more_vp:
-                percentage_share = 1.0 / remaining_categories
-                to_be_added = percentage_share * remainder
-                new_vp = new_share[category] + to_be_added
-
-                # Category's new share is still less than what it needs
-                if new_vp < category_usage[category]:
-                    new_share[category] += to_be_added
-                    remainder -= to_be_added
-                # Category's new share is more than it needs, so distribute to
-                # the other categories
-                else:
-                    not_needed = new_vp - category_usage[category]
-                    remainder -= to_be_added - not_needed
-                    new_share[category] = category_usage[category]
-
-                remaining_categories -= 1
-
-    if LOGGING:
-        new_share_table(new_share)
-
-    return new_share
-
-
-def calculate_new_share(category_share, category_usage):
-    """Calculates the new share of the voting power for each category."""
-    new_share = {}
-    remainder = 0
-    need_more_vp = []
-
-    for category, share in category_share.items():
-        try:
-            usage = category_usage[category]
-            # Category's share is more than the voting power it will use
-            if share > usage:
-                remainder += share - usage
-                new_share[category] = usage
-            # Category needs more voting power to vote everything
-            else:
-                new_share[category] = share
-                need_more_vp.append(category)
-        except KeyError:
-            remainder += share
-
-    return distribute_remainder(remainder, category_usage, new_share,
-                                need_more_vp)
-
-
-def reward_scaler_table(category_scaling):
-    """Prints a table containing each category and the scaler that the voting
-    weight of contributions in each respective category will be multiplied
-    with.
-    """
-    table = PrettyTable()
-    table.title = "REWARD MULTIPLIER"
-    table.field_names = ["Category", "Reward scaling"]
-
-    for category, scaling in category_scaling.items():
-        table.add_row([category, f"{scaling:.2f}"])
 
-    table.align["Category"] = "l"
-    table.align["Usage"] = "r"
-
-    LOGGER.info(f"\n{table}")
-
-
-def get_reward_scaler(category_usage, category_share):
-    """Returns a dictionary containing the key, value pair of the category and
-    the ratio that will be used to scale the voting_weight of contributions
-    in the category.
-    """
-    category_ratio = {}
-
-    for category, share in category_share.items():
-        category_ratio[category] = share / category_usage[category]
-
-    if LOGGING:
-        reward_scaler_table(category_ratio)
-
-    return category_ratio
-
-
-def update_reward_scaler(reward_scaler, contribution_usage, comment_usage):
-    """Updates the reward scaling dictionary so that the actual voting power
-    usage is roughly the same as the estimated usage.
-    """
-    desired_usage = 1.0 - (VP_TOTAL - comment_usage) / 100.0
-    actual_usage = 1.0 - contribution_usage / 100.0
-    scaler = np.log(desired_usage) / np.log(actual_usage)
-
-    for category in reward_scaler.keys():
-        reward_scaler[category] *= scaler
-
-    return reward_scaler
+from classifier import classify
+from constants import (ACCOUNT, ARCHIVE_DIR, COMMENT_BATCH, COMMENT_FOOTER,
+                       COMMENT_HEADER, COMMENT_REVIEW, COMMENT_STAFF_PICK,
+                       CONTRIBUTION_BATCH, CURRENT_REVIEWED, LOGGER,
+                       PREVIOUS_REVIEWED, STEEM, TESTING, TRAIL_ACCOUNTS,
+                       TRAIL_VP_FLOOR, TRAIL_WORKERS, VOTE_INTERVAL,
+                       VOTING_ACCOUNTS)
+from database.database_handler import DatabaseHandler
+from history import record_run
+from planner import build_plans, read_plan, save_inputs, write_plan
+from post_cache import (active_voters, lazy_post, normalise_authorperm,
+                        post_metadata)
+from scheduler import ActionScheduler
+from validation import validate_contributions, voted_by_us
+import account_history
+import chain_cache
+import journal
+import metrics
+import profiling
+import rc_budget
+import work_queue
+
+SHEET_INDEX = {}
+# Kinds of tasks the bot leaves to the work queue
+QUEUE_TASKS = ("reply_contribution", "reply_comment", "reply_trail",
+               "update_sheet")
+
+
+def get_account(name=ACCOUNT):
+    """Returns a recent snapshot of the beem account with the given name."""
+    return chain_cache.account(name, STEEM)
 
 
 """
@@ -369,30 +45,27 @@ VOTING PART
 """
 
 
-def valid_translation(post):
-    """Returns True if the translation contribution has the correct
-    beneficiaries set, otherwise False.
+def replied_by_us(identifier):
+    """Returns True if any of the voting accounts already replied to the post.
+    A reply whose broadcast seemed to fail (e.g. timed out) may still have
+    gone through, so retried replies check this first.
     """
-    beneficiaries = []
-    for beneficiary in post.json()["beneficiaries"]:
-        if beneficiary["account"] == "utopian.pay":
-            weight = beneficiary["weight"]
-            if weight >= 500:
-                beneficiaries.append(True)
-
-        if beneficiary["account"] == "davinci.pay":
-            weight = beneficiary["weight"]
-            if weight == 1000:
-                beneficiaries.append(True)
-
-    return all(beneficiaries)
+    post = Comment(normalise_authorperm(identifier), steem_instance=STEEM)
+    return any(reply.author in VOTING_ACCOUNTS
+               for reply in post.get_replies())
 
 
 def reply_to_contribution(contribution):
     """Replies to the contribution with a message confirming that it has been
-    voted on.
+    voted on. Runs as a task of the work queue, so errors are raised to have
+    it retried.
     """
-    post = Comment(contribution["url"])
+    if replied_by_us(contribution["url"]):
+        LOGGER.error("Already replied to the contribution: "
+                     f"{contribution['url']}")
+        return
+
+    post = post_metadata(contribution["url"])
     category = contribution["category"]
 
     if "task" in category:
@@ -400,7 +73,7 @@ def reply_to_contribution(contribution):
     else:
         contribution_type = "contribution"
 
-    body = COMMENT_HEADER.format(post.author)
+    body = COMMENT_HEADER.format(post["author"])
 
     if contribution["staff_picked"]:
         body += COMMENT_STAFF_PICK.format(category)
@@ -409,75 +82,96 @@ def reply_to_contribution(contribution):
 
     try:
         if not TESTING:
-            post.reply(body, author=ACCOUNT)
+            author = contribution.get("account", ACCOUNT)
+            with rc_budget.reserved(author, {"comment": 1}, STEEM):
+                lazy_post(contribution["url"]).reply(body, author=author)
+                metrics.record_broadcast("comment")
+                rc_budget.spend(author, "comment")
             LOGGER.info(f"Replied to contribution: {contribution['url']}")
-    except Exception as error:
+    except Exception:
         LOGGER.error("Something went wrong while trying to reply to the "
                      f"contribution: {contribution['url']}")
+        raise
+
+
+def sheet_index():
+    """Returns the worksheet and row of every URL in the previous and current
+    review worksheets, keyed by URL. A URL in both worksheets is found in the
+    previous one.
+    """
+    index = {}
+    for worksheet in (PREVIOUS_REVIEWED, CURRENT_REVIEWED):
+        for row_index, url in enumerate(worksheet.col_values(3), start=1):
+            index.setdefault(url, (worksheet, row_index))
+    return index
 
 
 def update_sheet(url, vote_successful=True, is_contribution=True):
     """Updates the status of a contribution or review comment in the
     spreadsheet to indicate whether it has been voted on (Yes) or if something
-    has gone wrong (Error).
+    has gone wrong (Error). Rows are looked up in the index fetched before the
+    run, which is only fetched again for a URL that isn't in it. Runs as a
+    task of the work queue, so errors are raised to have it retried.
     """
     status = "Yes" if vote_successful else "Error"
     column_index = 11 if is_contribution else 10
 
-    previous_reviewed = SHEET.worksheet(TITLE_PREVIOUS)
-    current_reviewed = SHEET.worksheet(TITLE_CURRENT)
-
     update_type = "contribution" if is_contribution else "comment"
 
     try:
-        if url in previous_reviewed.col_values(3):
-            row_index = previous_reviewed.col_values(3).index(url) + 1
-            previous_reviewed.update_cell(row_index, column_index, status)
-        else:
-            row_index = current_reviewed.col_values(3).index(url) + 1
-            current_reviewed.update_cell(row_index, column_index, status)
+        if url not in SHEET_INDEX:
+            SHEET_INDEX.update(sheet_index())
+        worksheet, row_index = SHEET_INDEX[url]
+        worksheet.update_cell(row_index, column_index, status)
         LOGGER.info(f"Updated {update_type} in sheet: {url}")
     except Exception as error:
         LOGGER.error(f"Something went wrong while updating the {update_type}: "
                      f"{url} - {error}")
+        raise
 
 
-def valid_age(post):
-    """Checks if post is within last twelve hours before payout."""
-    if post.time_elapsed() > timedelta(days=6, hours=12):
-        return False
-    return True
-
-
-def vote_on_contribution(contribution):
-    """Tries to vote on the given contribution and updates the sheet with
-    whether or not the vote was successful.
+def update_sheet_rows(urls, vote_successful=False, is_contribution=True):
+    """Updates the status of many contributions or review comments in the
+    spreadsheet at once, with a single request per worksheet.
     """
-    url = contribution["url"]
-    category = contribution["category"]
-    post = Comment(url, steem_instance=STEEM)
+    status = "Yes" if vote_successful else "Error"
+    column_index = 11 if is_contribution else 10
 
-    voters = [v.voter for v in post.get_votes() if v.weight > 0]
-    if ACCOUNT in voters:
-        update_sheet(url, vote_successful=False)
-        return False
+    if any(url not in SHEET_INDEX for url in urls):
+        SHEET_INDEX.update(sheet_index())
 
-    allows_curation = post.json()["allow_curation_rewards"]
-    if not allows_curation:
-        update_sheet(url, vote_successful=False)
-        return False
+    worksheets = {}
+    for url in urls:
+        if url not in SHEET_INDEX:
+            LOGGER.error(f"Couldn't find {url} in the sheet")
+            continue
+        worksheet, row_index = SHEET_INDEX[url]
+        worksheets.setdefault(worksheet.title, (worksheet, []))[1].append(
+            gspread.Cell(row_index, column_index, status))
 
-    if category == "translations" and not valid_translation(post):
-        update_sheet(url, vote_successful=False)
-        return False
+    for worksheet, cells in worksheets.values():
+        try:
+            worksheet.update_cells(cells)
+            LOGGER.info(f"Updated {len(cells)} rows in {worksheet.title}")
+        except Exception as error:
+            LOGGER.error("Something went wrong while updating "
+                         f"{worksheet.title}: {error}")
 
-    if not valid_age(post):
-        update_sheet(url, vote_successful=False)
-        return False
+
+def vote_on_contribution(contribution, voting_power=100.0):
+    """Tries to vote on the given contribution, which passed the checks in
+    `validation.py` when the batch was fetched, and returns True if the vote
+    was successful.
+    """
+    url = contribution["url"]
+    voter = contribution.get("account", ACCOUNT)
 
     try:
         voting_weight = contribution["voting_weight"]
-        post.vote(voting_weight, account=account)
+        lazy_post(url, STEEM).vote(voting_weight, account=get_account(voter))
+        metrics.record_vote("contribution", voting_weight, voting_power)
+        chain_cache.invalidate(voter)
+        rc_budget.spend(voter, "vote")
         LOGGER.info(f"Upvoted contribution ({voting_weight:.2f}%): "
                     f"{url}")
     except Exception as error:
@@ -487,42 +181,59 @@ def vote_on_contribution(contribution):
     return True
 
 
-def handle_contributions(contributions):
-    """Votes and replies to the given contributions."""
-    for contribution in contributions:
-        voted_on = vote_on_contribution(contribution)
-        if voted_on:
-            reply_to_contribution(contribution)
-            update_sheet(contribution["url"])
+def handle_contribution(contribution, voting_power):
+    """Votes on the given contribution and enqueues the reply to it and the
+    update of its row.
+    """
+    voted_on = vote_on_contribution(contribution, voting_power)
+    if voted_on:
+        url = contribution["url"]
+        voter = contribution.get("account", ACCOUNT)
+        work_queue.enqueue("reply_contribution",
+                           {"contribution": contribution},
+                           key=f"reply_contribution:{url}",
+                           throttle=f"{voter}:comment")
+        work_queue.enqueue("update_sheet", {"url": url},
+                           key=f"update_sheet:contribution:{url}")
 
-        time.sleep(3)
+    return voted_on
 
 
-def reply_to_comment(comment):
+def reply_to_comment(authorperm, voter=ACCOUNT):
     """Replies to a review comment with a message confirming that it has been
-    voted on.
+    voted on. Runs as a task of the work queue, so errors are raised to have
+    it retried.
     """
+    comment = Comment(authorperm, steem_instance=STEEM)
     repliers = [reply.author for reply in comment.get_replies()]
 
-    if ACCOUNT not in repliers:
+    if not any(replier in VOTING_ACCOUNTS for replier in repliers):
         try:
             if not TESTING:
-                comment.reply(COMMENT_REVIEW.format(comment.author),
-                              author=ACCOUNT)
+                with rc_budget.reserved(voter, {"comment": 1}, STEEM):
+                    comment.reply(COMMENT_REVIEW.format(comment.author),
+                                  author=voter)
+                    metrics.record_broadcast("comment")
+                    rc_budget.spend(voter, "comment")
                 LOGGER.info(f"Replied to comment: {comment.permlink}")
         except Exception as error:
             LOGGER.error("Something went wrong while replying to the comment: "
                          f"{comment.permlink} - {error}")
+            raise
     else:
         LOGGER.error(f"Already replied to the comment: {comment.permlink}")
 
 
-def vote_on_comment(comment, voting_weight):
+def vote_on_comment(comment, voting_weight, voting_power=100.0,
+                    voter=ACCOUNT):
     """Votes on the given comment if it hasn't already been voted on."""
     voters = [v.voter for v in comment.get_votes() if v.weight > 0]
-    if ACCOUNT not in voters:
+    if not voted_by_us(voters):
         try:
-            comment.vote(voting_weight, account=account)
+            comment.vote(voting_weight, account=get_account(voter))
+            metrics.record_vote("comment", voting_weight, voting_power)
+            chain_cache.invalidate(voter)
+            rc_budget.spend(voter, "vote")
             LOGGER.info(f"Upvoted comment ({voting_weight:.2f}%): "
                         f"{comment.permlink}")
             return True
@@ -536,303 +247,566 @@ def vote_on_comment(comment, voting_weight):
     return False
 
 
-def handle_comments(comments, comment_weights, voting_power):
-    """Uses the pre-calculated weights to upvote and reply to all pending
-    review comments.
+def handle_comment(comment, voting_power):
+    """Uses the pre-calculated weight to upvote the given review comment and
+    enqueues the reply to it and the update of its row.
     """
-    for comment in sorted(comments, key=lambda x: x["review_date"]):
-        category = comment["category"]
-        if "task" in category:
-            category = "task-request"
+    voter = comment.get("account", ACCOUNT)
+    beem_comment = Comment(comment["authorperm"])
 
-        contribution_url = comment["url"]
-        moderator = comment["moderator"]
-        comment_url = comment["comment_url"]
-        url = f"{moderator}/{comment_url}"
+    # Sanity check
+    if beem_comment.author != comment["moderator"]:
+        return False
 
-        beem_comment = Comment(url)
+    voted_on = vote_on_comment(beem_comment, comment["voting_weight"],
+                               voting_power, voter)
 
-        # Sanity check
-        if beem_comment.author != moderator:
-            continue
+    if voted_on:
+        authorperm = comment["authorperm"]
+        work_queue.enqueue("reply_comment",
+                           {"authorperm": authorperm, "voter": voter},
+                           key=f"reply_comment:{authorperm}",
+                           throttle=f"{voter}:comment")
+        work_queue.enqueue("update_sheet",
+                           {"url": comment["url"], "is_contribution": False},
+                           key=f"update_sheet:comment:{comment['url']}")
 
-        voted_on = vote_on_comment(beem_comment, comment_weights[category])
+    return voted_on
 
-        if voted_on:
-            usage = comment_weights[category] / 100.0 * 0.02 * voting_power
-            voting_power -= usage
-            reply_to_comment(beem_comment)
-            update_sheet(contribution_url, voted_on, is_contribution=False)
 
-        time.sleep(3)
+def valid_trail_contribution(contribution):
+    """Returns True if the contribution fits our labels, False otherwise."""
+    return classify([contribution])[contribution["authorperm"]]
 
-    LOGGER.info(f"Voting power after comments: {voting_power:.2f}%")
-    return voting_power
 
+def trail_vote(vote):
+    """Returns the vote as a trail candidate if it was made by one of the
+    trails and meets that trail's weight trigger and self-vote rules,
+    otherwise None.
+    """
+    weight = vote["weight"]
+    author = vote["author"]
+    voter = vote["voter"]
+
+    if voter not in TRAIL_ACCOUNTS:
+        return None
 
-def init_comments(comments):
-    """Initialises everything needed for upvoting the comments."""
-    comment_weights = get_comment_weights()
-    comment_usage = comment_voting_power(comments, comment_weights)
+    weight_trigger = TRAIL_ACCOUNTS[voter]["weight_trigger"]
+    self_vote_allowed = TRAIL_ACCOUNTS[voter]["self_vote_allowed"]
 
-    if comment_usage > VP_COMMENTS:
-        comment_weights = update_weights(comment_weights, comment_usage)
-        comment_usage = comment_voting_power(comments, comment_weights)
+    if weight < weight_trigger or (voter == author and not self_vote_allowed):
+        return None
 
-    LOGGER.info(f"Estimated voting power usage (comments): {comment_usage:.2f}%")
-    return comment_weights, comment_usage
+    return {
+        "trail_name": voter,
+        "author": author,
+        "authorperm": f"@{author}/{vote['permlink']}",
+        "weight": weight,
+    }
 
 
-def get_batch(contributions, category_share, voting_power):
-    """Returns the batch of contributions that will be voted on in the next
-    voting round.
+def trail_votes(trail_name):
+    """Returns the trail's votes from the last two days that meet its weight
+    trigger and self-vote rules, newest first.
     """
-    used_share = []
-    batch = []
+    votes = []
+    seen = set()
+    two_days_ago = datetime.utcnow() - timedelta(days=2)
+
+    # The trail's history also contains the votes on its own posts, and a
+    # trail may have voted on a post more than once, so the raw operations are
+    # filtered before any post is fetched
+    for vote in account_history.history_reverse(trail_name, two_days_ago):
+        if vote["voter"] != trail_name:
+            continue
+        candidate = trail_vote(vote)
+        if candidate and candidate["authorperm"] not in seen:
+            seen.add(candidate["authorperm"])
+            votes.append(candidate)
 
-    for contribution in sort_batch_contributions(contributions):
-        voting_weight = contribution["voting_weight"]
-        category = contribution["category"]
+    return votes
 
-        if "task" in category:
-            category = "task-request"
 
-        if category in used_share:
-            continue
-
-        usage = voting_weight / 100.0 * 0.02 * voting_power
+def trail_post(authorperm):
+    """Returns the post with the given authorperm if it can be upvoted from a
+    trail, otherwise None.
+    """
+    try:
+        post = post_metadata(authorperm)
 
-        if category_share[category] - usage < 0:
-            used_share.append(category)
-            continue
+        if post["is_comment"]:
+            return None
 
-        category_share[category] -= usage
-        voting_power -= usage
-        batch.append(contribution)
+        voters = active_voters(authorperm)
+    except Exception as error:
+        LOGGER.error("Something went wrong while fetching the trail "
+                     f"contribution: {authorperm} - {error}")
+        return None
 
-    LOGGER.info(f"Voting power after contributions: {voting_power:.2f}%")
-    return voting_power, batch
+    if voted_by_us(voters):
+        return None
 
+    return post
 
-def init_contributions(contributions, comment_usage):
-    """Initialises everything needed for upvoting the contributions."""
-    voting_power = 100.0 - comment_usage
-    contribution_usage = contribution_voting_power(contributions, voting_power)
 
-    if contribution_usage + comment_usage > VP_TOTAL:
-        contribution_usage = VP_TOTAL - comment_usage
+def trail_voting_weight(trail_name, weight):
+    """Returns the weight used to follow a vote of the given weight made by
+    the trail.
+    """
+    weight_multiplier = TRAIL_ACCOUNTS[trail_name]["weight_multiplier"]
+    max_weight = TRAIL_ACCOUNTS[trail_name]["max_weight"] / 100.0
+    return min(weight * weight_multiplier / 100.0, max_weight)
 
-    category_share = get_category_share(contribution_usage)
-    category_usage = get_category_usage(contributions, voting_power)
 
-    if contribution_usage + comment_usage == VP_TOTAL:
-        new_share = calculate_new_share(category_share, category_usage)
-    else:
-        new_share = category_usage
+def trail_contributions(votes, posts, number_upvoted, relevant=None):
+    """Returns all valid contributions that will be upvoted from the trails.
+    A post voted on by several trails is only upvoted once, by the first
+    priority trail (or otherwise the first trail) that voted on it. Posts
+    that were already classified are looked up in `relevant`.
+    """
+    relevant = relevant or {}
+    contributions = []
+    claimed = set()
+    trails = sorted(TRAIL_ACCOUNTS,
+                    key=lambda x: TRAIL_ACCOUNTS[x]["is_priority"],
+                    reverse=True)
+
+    for trail_name in trails:
+        check_context = TRAIL_ACCOUNTS[trail_name]["check_context"]
+        upvote_limit = TRAIL_ACCOUNTS[trail_name]["upvote_limit"]
+        is_priority = TRAIL_ACCOUNTS[trail_name]["is_priority"]
+        upvoted = number_upvoted[trail_name]
+
+        for vote in votes.get(trail_name, []):
+            if upvoted > upvote_limit:
+                break
+
+            authorperm = vote["authorperm"]
+            contribution = posts.get(authorperm)
+
+            if contribution is None or authorperm in claimed:
+                continue
+
+            if check_context:
+                if authorperm not in relevant:
+                    relevant[authorperm] = valid_trail_contribution(
+                        contribution)
+                if not relevant[authorperm]:
+                    continue
+
+            claimed.add(authorperm)
+            contributions.append({
+                "trail_name": trail_name,
+                "author": vote["author"],
+                "authorperm": contribution["authorperm"],
+                "id": contribution["id"],
+                "created": contribution["created"],
+                "weight": vote["weight"],
+                "voting_weight": trail_voting_weight(trail_name,
+                                                     vote["weight"]),
+                "is_priority": is_priority,
+            })
+            upvoted += 1
 
-    return new_share
+    return contributions
 
 
-def valid_trail_contribution(contribution):
-    """Returns True if Watson's analysis determines it fits our labels, False
-    otherwise.
+def reply_to_trail_contribution(authorperm, author, trail_name,
+                                voter=ACCOUNT):
+    """Replies to the contribution from the trail with the trail's message.
+    Runs as a task of the work queue, so errors are raised to have it retried.
     """
-    response = WATSON_SERVICE.analyze(
-        text=contribution.body,
-        features=Features(categories=CategoriesResult())).get_result()
-
-    for category in response["categories"]:
-        label = category["label"]
-        score = category["score"]
-        if label in WATSON_LABELS and score >= WATSON_SCORE:
-            return True
+    try:
+        comment = TRAIL_ACCOUNTS[trail_name]["comment"].format(author,
+                                                               trail_name)
+    except Exception:
+        comment = TRAIL_ACCOUNTS[trail_name]["comment"]
 
-    return False
+    if TESTING:
+        return
 
+    if replied_by_us(authorperm):
+        LOGGER.error(f"Already replied to the trail contribution: {authorperm}")
+        return
 
-def trail_contributions(trail_name):
-    """Returns all valid contributions that will be upvoted from the trail."""
-    contributions = []
+    try:
+        with rc_budget.reserved(voter, {"comment": 1}, STEEM):
+            lazy_post(authorperm, STEEM).reply(comment, author=voter)
+            metrics.record_broadcast("comment")
+            rc_budget.spend(voter, "comment")
+        LOGGER.info(f"Replied to trail contribution: {authorperm}")
+    except Exception:
+        LOGGER.error("Something went wrong while replying to the trail "
+                     f"contribution: {authorperm}")
+        raise
+
+
+def handle_trail_contribution(contribution, voting_power):
+    """Upvotes the given contribution from the trail and enqueues the reply to
+    it.
+    """
     database = DatabaseHandler.get_instance()
-    trail_account = Account(trail_name)
-    two_days_ago = datetime.now() - timedelta(days=2)
-    week_ago = datetime.now() - timedelta(days=7)
-    number_upvoted = database.number_upvoted(trail_name, week_ago)
+    authorperm = contribution["authorperm"]
+    post = lazy_post(authorperm)
+    voter = contribution.get("account", ACCOUNT)
+    trail_name = contribution["trail_name"]
+    voting_weight = contribution["voting_weight"]
 
-    weight_trigger = TRAIL_ACCOUNTS[trail_name]["weight_trigger"]
-    weight_multiplier = TRAIL_ACCOUNTS[trail_name]["weight_multiplier"]
-    max_weight = TRAIL_ACCOUNTS[trail_name]["max_weight"] / 100.0
-    self_vote_allowed = TRAIL_ACCOUNTS[trail_name]["self_vote_allowed"]
-    check_context = TRAIL_ACCOUNTS[trail_name]["check_context"]
-    upvote_limit = TRAIL_ACCOUNTS[trail_name]["upvote_limit"]
-    is_priority = TRAIL_ACCOUNTS[trail_name]["is_priority"]
-
-    for vote in trail_account.history_reverse(stop=two_days_ago,
-                                              only_ops=["vote"]):
-        if number_upvoted > upvote_limit:
-            break
+    try:
+        post.vote(voting_weight, account=get_account(voter))
+        metrics.record_vote("trail", voting_weight, voting_power)
+        chain_cache.invalidate(voter)
+        rc_budget.spend(voter, "vote")
+        LOGGER.info(f"Voted on trail contribution: {post.permlink}")
+    except Exception:
+        LOGGER.error("Something went wrong while voting on the trail "
+                     f"contribution: {post.permlink}")
+        return False
 
-        weight = vote["weight"]
-        author = vote["author"]
-        voter = vote["voter"]
+    work_queue.enqueue("reply_trail", {
+        "authorperm": authorperm,
+        "author": contribution["author"],
+        "trail_name": trail_name,
+        "voter": voter,
+    }, key=f"reply_trail:{authorperm}", throttle=f"{voter}:comment")
 
-        if (weight < weight_trigger or voter != trail_name or
-                (voter == author and not self_vote_allowed)):
-            continue
+    if not database.contribution_exists(authorperm):
+        database.add_contribution(contribution["id"], trail_name, authorperm,
+                                  datetime.now())
 
-        contribution = Comment(f"@{vote['author']}/{vote['permlink']}")
+    return True
+
+
+ACTION_HANDLERS = {
+    "comment": handle_comment,
+    "contribution": handle_contribution,
+    "trail": handle_trail_contribution,
+}
 
-        if contribution.is_comment():
-            continue
 
-        voters = [v.voter for v in contribution.get_votes() if v.weight > 0]
+@metrics.timed("execute_plan")
+def execute_plan(plan, voting_power, name=None, done=(), capacity=None):
+    """Executes the actions in the plan, except the ones in `done`, and
+    returns the outcome of each action. Votes from a single account must be
+    at least three seconds apart, so the actions are executed one after
+    another, most valuable first unless another action would miss its
+    deadline (see `scheduler.py`). If `capacity` is given only that many of
+    the most valuable actions are executed. The outcomes of the given
+    account's actions are recorded in the journal as they happen.
+    """
+    actions = plan["actions"]
+    scheduler = ActionScheduler(
+        actions, [index for index in range(len(actions)) if index not in done],
+        capacity)
+    outcomes = []
+
+    def record(outcome):
+        outcomes.append(outcome)
+        if name:
+            journal.record(name, outcome)
+
+    while True:
+        index = scheduler.pop()
+        for expired in scheduler.take_expired():
+            action = actions[expired]
+            LOGGER.warning(f"Skipped {action['type']} that can no longer be "
+                           "voted on before its cutoff: "
+                           f"{action.get('url', action.get('authorperm'))}")
+            metrics.inc("utopian_expired_actions_total", type=action["type"])
+            record({"action": expired, "status": "expired", "usage": 0.0})
+
+        if index is None:
+            break
 
-        if ACCOUNT in voters:
+        action = actions[index]
+        action_type = action["type"]
+        usage = action["voting_weight"] / 100.0 * 0.02 * voting_power
+        if action_type == "trail" and voting_power - usage < TRAIL_VP_FLOOR:
+            LOGGER.error(f"Voting power would reach {TRAIL_VP_FLOOR}% while "
+                         "voting on the trail.")
             continue
 
-        voting_weight = weight * weight_multiplier / 100.0
+        start = time.perf_counter()
+        voted_on = ACTION_HANDLERS[action_type](action, voting_power)
+        metrics.observe("utopian_action_duration_seconds",
+                        time.perf_counter() - start, type=action_type)
 
-        if voting_weight > max_weight:
-            voting_weight = max_weight
+        if voted_on:
+            voting_power -= usage
+        record({
+            "action": index,
+            "status": "voted" if voted_on else "skipped",
+            "usage": usage if voted_on else 0.0,
+        })
 
-        if not check_context or valid_trail_contribution(contribution):
-            contributions.append({
-                "trail_name": trail_name,
-                "author": author,
-                "voting_weight": voting_weight,
-                "contribution": contribution,
-                "is_priority": is_priority,
-            })
-            number_upvoted += 1
+        time.sleep(VOTE_INTERVAL)
+        scheduler.finished(time.perf_counter() - start)
 
-    return contributions
+    LOGGER.info(f"Voting power after plan: {voting_power:.2f}%")
+    return outcomes
 
 
-def trail_multiplier(contributions, voting_power):
-    """Returns a multiplier that will be used if the trail uses more than its
-    allocated voting power.
+def execute_account_plan(name, plan):
+    """Executes the plan of the voting account with the given name, leaving
+    out the actions the journal shows were already executed. Resource credits
+    are reserved for a vote and a reply per remaining action first, and only
+    the most valuable actions the account can afford are executed.
     """
-    priority_contributions = [contribution for contribution in contributions
-                              if contribution["is_priority"]]
-
-    # Calculate voting power share used by priority contributions
-    for contribution in priority_contributions:
-        voting_weight = contribution["voting_weight"]
-        usage = voting_weight / 100.0 * 0.02 * voting_power
-        voting_power -= usage
+    executed = journal.outcomes(name)
+    done = {outcome["action"] for outcome in executed}
+    remaining = len(plan["actions"]) - len(done)
+
+    voting_power = get_account(name).get_voting_power()
+    budget = rc_budget.budget(name, STEEM)
+    affordable = budget.reserve({"vote": 1, "comment": 1}, remaining)
+    if affordable < remaining:
+        LOGGER.warning(f"{name} only has enough resource credits for "
+                       f"{affordable} of {remaining} actions")
+
+    if done:
+        LOGGER.info(f"Resuming plan of {name} after {len(done)} actions")
+    LOGGER.info(f"Executing plan of {name} ({remaining} actions)")
+    try:
+        return executed + execute_plan(plan, voting_power, name, done,
+                                       affordable)
+    finally:
+        budget.release()
 
-    max_usage = voting_power - 80.0
 
-    if max_usage < 0:
-        LOGGER.error("Not enough voting power left to upvote trail.")
-        return 0.0
+def account_worker(item):
+    """Executes an account's plan inside a worker process, which keeps and
+    exports its own metrics and profile. Pool workers exit without running
+    the exit handlers, so both are written before returning.
+    """
+    name, plan = item
+    DatabaseHandler.instance = None
+    chain_cache.clear()
+    metrics.reset()
+    metrics.set_bot(f"upvote_{name}")
+    try:
+        return execute_account_plan(name, plan)
+    finally:
+        metrics.export()
+        profiling.write()
 
-    total_usage = 0
 
-    # Calculate voting power share used by the rest
-    for contribution in contributions:
-        voting_weight = contribution["voting_weight"]
-        usage = voting_weight / 100.0 * 0.02 * voting_power
+def execute_plans(plans):
+    """Executes the plan of every voting account, each in its own worker
+    process so their votes are broadcast in parallel, and returns the outcomes
+    per account.
+    """
+    if "accounts" not in plans:
+        plans = {"accounts": {ACCOUNT: plans}}
+    accounts = plans["accounts"]
 
-        total_usage += usage
-        voting_power -= usage
+    if len(accounts) == 1:
+        name, plan = next(iter(accounts.items()))
+        return {name: execute_account_plan(name, plan)}
 
-    LOGGER.info(f"Estimated voting power usage (trail): {total_usage:.2f}%")
+    context = multiprocessing.get_context("fork")
+    with context.Pool(len(accounts)) as pool:
+        outcomes = pool.map(account_worker, accounts.items())
 
-    if total_usage < max_usage:
-        return 1.0
+    return dict(zip(accounts, outcomes))
 
-    # If non-priority contributions use too much voting power, scale weight
-    desired_usage = 1.0 - max_usage / 100.0
-    actual_usage = 1.0 - total_usage / 100.0
-    multiplier = np.log(desired_usage) / np.log(actual_usage)
 
-    LOGGER.info("Scaling non-priority trail contributions with multiplier: "
-                f"{multiplier:.1f}%")
+@metrics.timed("init_trail")
+def init_trail():
+    """Initialises everything needed for upvoting the trail's contributions.
+    The trails are scanned concurrently and every post voted on by one or
+    more trails is only fetched once.
+    """
+    database = DatabaseHandler.get_instance()
+    week_ago = datetime.now() - timedelta(days=7)
+    number_upvoted = {trail_name: database.number_upvoted(trail_name, week_ago)
+                      for trail_name in TRAIL_ACCOUNTS.keys()}
+    trails = [trail_name for trail_name in TRAIL_ACCOUNTS.keys()
+              if number_upvoted[trail_name] <=
+              TRAIL_ACCOUNTS[trail_name]["upvote_limit"]]
+
+    with ThreadPoolExecutor(max_workers=TRAIL_WORKERS) as executor:
+        votes = dict(zip(trails, executor.map(trail_votes, trails)))
+        authorperms = list(dict.fromkeys(
+            vote["authorperm"] for trail in votes.values() for vote in trail))
+        posts = dict(zip(authorperms, executor.map(trail_post, authorperms)))
+
+    # Classify the posts of trails that check the context all at once, so
+    # the ones that need Watson are sent to it concurrently
+    checked = list(dict.fromkeys(
+        vote["authorperm"] for trail_name, trail in votes.items()
+        if TRAIL_ACCOUNTS[trail_name]["check_context"] for vote in trail
+        if posts.get(vote["authorperm"]) is not None))
+    with metrics.stage("classify_trail"):
+        relevant = classify([posts[authorperm] for authorperm in checked])
+
+    contributions = trail_contributions(votes, posts, number_upvoted,
+                                        relevant)
+    contributions = sorted(contributions, key=lambda x: x["voting_weight"])
 
-    return multiplier
+    return contributions
 
 
-def handle_trail(contributions, voting_power):
-    """Upvotes and replies to all contributions in the trail."""
-    database = DatabaseHandler.get_instance()
+def account_voting_power(name):
+    """Returns the current voting power of the voting account."""
+    voting_power = chain_cache.voting_power(name)
+    metrics.set_gauge("utopian_voting_power_percent", voting_power,
+                      account=name)
+    return voting_power
 
-    contributions = sorted(
-        contributions,
-        key=lambda x: (x["is_priority"], x["voting_weight"]),
-        reverse=True
-    )
 
-    for contribution in contributions:
-        post = contribution["contribution"]
-        trail_name = contribution["trail_name"]
-        voting_weight = contribution["voting_weight"]
-        usage = voting_weight / 100.0 * 0.02 * voting_power
+def account_inputs(name, settings, voting_power):
+    """Returns the voting power and the value of a full vote of the voting
+    account.
+    """
+    with metrics.stage("fetch_voting_value"):
+        value_account = settings.get("value_account", name)
+        voting_value = chain_cache.voting_value(value_account)
 
-        if voting_power - usage < 80.0:
-            LOGGER.error("Voting power reached 80% while voting on the trail.")
-            break
+    return {
+        "voting_power": voting_power,
+        "voting_value": voting_value,
+    }
 
-        try:
-            comment = TRAIL_ACCOUNTS[trail_name]["comment"].format(
-                contribution["author"],
-                trail_name)
-        except Exception:
-            comment = TRAIL_ACCOUNTS[trail_name]["comment"]
 
-        try:
-            voting_power -= usage
-            post.vote(voting_weight, account=account)
-            if not TESTING:
-                post.reply(comment, author=ACCOUNT)
-                LOGGER.info("Voted and replied to trail contribution: "
-                            f"{post.permlink}")
-        except Exception as error:
-            LOGGER.error("Something went wrong while voting and replying to "
-                         f"the trail contribution: {post.permlink}")
-            continue
+def fetch_batch(stage, url):
+    """Returns the batch of comments or contributions at the given URL."""
+    with metrics.stage(stage):
+        return requests.get(url).json()
 
-        if not database.contribution_exists(post.authorperm):
-            database.add_contribution(post.id, trail_name, post.authorperm,
-                                      datetime.now())
 
-        time.sleep(3)
+def eligible_contributions():
+    """Returns the contributions of the batch that can be voted on, and the
+    URLs of the ones that can't.
+    """
+    contributions = fetch_batch("fetch_contributions", CONTRIBUTION_BATCH)
+    with metrics.stage("validate_contributions"):
+        accepted, rejected = validate_contributions(contributions)
+
+    for contribution, reason in rejected:
+        LOGGER.info(f"Not voting on {contribution['url']}: {reason}")
+    return accepted, [contribution["url"] for contribution, _ in rejected]
+
+
+@metrics.timed("preflight")
+def gather_inputs():
+    """Fetches everything needed to plan the batch vote. Only accounts with
+    full voting power take part, and None is returned if there are none. As
+    most runs can't vote, the voting power is checked before anything else is
+    fetched. The voting value of the accounts, the chain globals, both
+    batches, the sheets' URL index and the trails are independent of each
+    other, so they are then all fetched at the same time.
+    """
+    with ThreadPoolExecutor(max_workers=len(VOTING_ACCOUNTS)) as executor:
+        voting_power = dict(zip(VOTING_ACCOUNTS, executor.map(
+            account_voting_power, VOTING_ACCOUNTS)))
+    voting_power = {name: value for name, value in voting_power.items()
+                    if value >= 100.0}
+    if not voting_power:
+        return None
+
+    with ThreadPoolExecutor(max_workers=len(voting_power) + 5) as executor:
+        chain_globals = executor.submit(chain_cache.chain_globals)
+        accounts = {name: executor.submit(account_inputs, name,
+                                          VOTING_ACCOUNTS[name], value)
+                    for name, value in voting_power.items()}
+        comments = executor.submit(fetch_batch, "fetch_comments",
+                                   COMMENT_BATCH)
+        contributions = executor.submit(eligible_contributions)
+        index = executor.submit(sheet_index)
+        trail = executor.submit(init_trail)
+
+    chain_globals.result()
+    accounts = {name: future.result() for name, future in accounts.items()}
+    SHEET_INDEX.update(index.result())
+    contributions, rejected = contributions.result()
+    return {
+        "accounts": accounts,
+        "comments": comments.result(),
+        "contributions": contributions,
+        "rejected": rejected,
+        "trail": trail.result(),
+    }
 
-    LOGGER.info(f"Voting power after trail: {voting_power:.2f}%")
 
+def vote(plan_path=None):
+    """Plans the batch vote and executes it, or only writes the plan to the
+    given path.
+    """
+    inputs = gather_inputs()
 
-def init_trail():
-    """Initialises everything needed for upvoting the trail's contributions."""
-    contributions = []
+    if not inputs:
+        # Replies and sheet updates left by earlier runs (or the trail
+        # follower) are still sent while the accounts regenerate
+        if not plan_path:
+            work_queue.drain(QUEUE_TASKS)
+        return
 
-    for trail_name in TRAIL_ACCOUNTS.keys():
-        contributions.extend(trail_contributions(trail_name))
-    contributions = sorted(contributions, key=lambda x: x["voting_weight"])
+    LOGGER.info("STARTED BATCH VOTE")
+    save_inputs(inputs, ARCHIVE_DIR)
+    plans = build_plans(inputs, VOTING_ACCOUNTS)
 
-    return contributions
+    if plan_path:
+        write_plan(plans, plan_path)
+        LOGGER.info(f"Wrote plans of {', '.join(plans['accounts'])} to "
+                    f"{plan_path}")
+        return
 
+    update_sheet_rows(inputs["rejected"], vote_successful=False)
+    started = datetime.now()
+    journal.start(inputs, plans, started)
+    outcomes = execute_plans(plans)
+    record_run(inputs, plans, outcomes, started)
+    journal.finish()
+    work_queue.drain(QUEUE_TASKS)
+    LOGGER.info("FINISHED BATCH VOTE")
 
-def main():
-    voting_power = account.get_voting_power()
 
-    if voting_power < 100.0:
-        return
+def resume():
+    """Resumes the batch vote that was interrupted, using the plans stored in
+    the journal.
+    """
+    run = journal.load()
+    LOGGER.info(f"RESUMED BATCH VOTE STARTED AT {run['started']}")
+    outcomes = execute_plans(run["plans"])
+    record_run(run["inputs"], run["plans"], outcomes, run["started"])
+    journal.finish()
+    work_queue.drain(QUEUE_TASKS)
+    LOGGER.info("FINISHED BATCH VOTE")
 
-    LOGGER.info("STARTED BATCH VOTE")
-    comments = requests.get(COMMENT_BATCH).json()
-    comment_weights, comment_usage = init_comments(comments)
 
-    contributions = requests.get(CONTRIBUTION_BATCH).json()
-    category_share = init_contributions(contributions, comment_usage)
+def execute(plan_path):
+    """Executes the plans stored at the given path."""
+    LOGGER.info(f"STARTED EXECUTING PLAN {plan_path}")
+    plans = read_plan(plan_path)
+    started = datetime.now()
+    journal.start(None, plans, started)
+    outcomes = execute_plans(plans)
+    record_run(None, plans, outcomes, started)
+    journal.finish()
+    work_queue.drain(QUEUE_TASKS)
+    LOGGER.info(f"FINISHED EXECUTING PLAN {plan_path}")
 
-    voting_power = handle_comments(comments, comment_weights, voting_power)
-    voting_power, contributions = get_batch(contributions, category_share,
-                                            voting_power)
-    handle_contributions(contributions)
 
-    trail_contributions = init_trail()
-    handle_trail(trail_contributions, voting_power)
-    LOGGER.info("FINISHED BATCH VOTE")
+def main(plan_path=None, execute_path=None):
+    """Upvotes all pending review comments, contributions and trail posts."""
+    metrics.start("upvote")
+    try:
+        if execute_path:
+            execute(execute_path)
+        elif journal.exists() and not plan_path:
+            resume()
+        else:
+            vote(plan_path)
+    finally:
+        metrics.export()
 
 if __name__ == '__main__':
-    main()
+    parser = profiling.argument_parser(main.__doc__)
+    parser.add_argument("--plan", metavar="PATH",
+                        help="only write the vote plan to the given path")
+    parser.add_argument("--execute", metavar="PATH",
+                        help="execute the vote plan stored at the given path")
+    args = parser.parse_args()
+    if args.profile:
+        profiling.enable(args.profile_dir)
+    main(args.plan, args.execute)
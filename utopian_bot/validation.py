@@ -0,0 +1,148 @@
+"""
+Decides which contributions of the batch can be voted on. The checks are
+declared in `VALIDATORS` in order of cost: the ones that only need the
+batch's own fields run first, vectorised over the whole batch, then the ones
+that need the post's (cached) metadata, and only the contributions that
+passed all of those get their live votes fetched. Rejected contributions are
+returned with the reason, so their rows can be updated all at once.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from constants import CATEGORY_WEIGHTING, LOGGER, VOTE_CUTOFF, VOTING_ACCOUNTS
+from post_cache import active_voters, post_metadata
+import metrics
+
+# Number of threads fetching the posts and votes of the batch
+FETCH_WORKERS = 8
+
+
+def voted_by_us(voters):
+    """Returns True if any of the voting accounts is among the voters."""
+    return any(voter in VOTING_ACCOUNTS for voter in voters)
+
+
+def valid_translation(post):
+    """Returns True if the translation contribution has the correct
+    beneficiaries set, otherwise False.
+    """
+    beneficiaries = []
+    for beneficiary in post["beneficiaries"]:
+        if beneficiary["account"] == "utopian.pay":
+            weight = beneficiary["weight"]
+            if weight >= 500:
+                beneficiaries.append(True)
+
+        if beneficiary["account"] == "davinci.pay":
+            weight = beneficiary["weight"]
+            if weight == 1000:
+                beneficiaries.append(True)
+
+    return all(beneficiaries)
+
+
+def known_category(contributions):
+    """Returns whether each contribution's category has a share."""
+    categories = np.array([
+        "task-request" if "task" in contribution["category"] else
+        contribution["category"] for contribution in contributions])
+    return np.isin(categories, list(CATEGORY_WEIGHTING))
+
+
+def recent(contributions, now=None):
+    """Returns whether each contribution can still be voted on before its
+    cutoff.
+    """
+    now = np.datetime64(now or datetime.utcnow(), "s")
+    created = np.array([contribution["created"][:19]
+                        for contribution in contributions],
+                       dtype="datetime64[s]")
+    return now - created <= np.timedelta64(int(VOTE_CUTOFF.total_seconds()),
+                                           "s")
+
+
+# Data fetched for a contribution before the checks that need it
+FETCHERS = {
+    "post": lambda contribution: post_metadata(contribution["url"]),
+    "voters": lambda contribution: active_voters(contribution["url"]),
+}
+
+# Checks in order of cost. Batch checks get all contributions and return an
+# array of booleans, the others get a contribution and the data they need.
+VALIDATORS = [
+    {"reason": "unknown_category", "needs": "batch", "check": known_category},
+    {"reason": "too_old", "needs": "batch", "check": recent},
+    {"reason": "no_curation_rewards", "needs": "post",
+     "check": lambda contribution, post: post["allow_curation_rewards"]},
+    {"reason": "invalid_beneficiaries", "needs": "post",
+     "check": lambda contribution, post: (
+         contribution["category"] != "translations" or
+         valid_translation(post))},
+    {"reason": "already_voted", "needs": "voters",
+     "check": lambda contribution, voters: not voted_by_us(voters)},
+]
+
+
+def safe_fetch(item):
+    needs, contribution = item
+    try:
+        return FETCHERS[needs](contribution)
+    except Exception as error:
+        LOGGER.error(f"Couldn't fetch the {needs} of {contribution['url']}: "
+                     f"{error}")
+        return None
+
+
+def validate_contributions(contributions, validators=VALIDATORS):
+    """Returns the contributions that passed every check, and the rejected
+    contributions with the reason they were rejected. Contributions whose
+    data couldn't be fetched are in neither, so they are checked again by the
+    next run.
+    """
+    accepted = list(contributions)
+    rejected = []
+
+    def reject(contribution, reason):
+        rejected.append((contribution, reason))
+        metrics.inc("utopian_validation_rejections_total", reason=reason)
+
+    data = {}
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        for validator in validators:
+            if not accepted:
+                break
+            needs = validator["needs"]
+            reason = validator["reason"]
+
+            if needs == "batch":
+                passed = validator["check"](accepted)
+                for contribution, valid in zip(accepted, passed):
+                    if not valid:
+                        reject(contribution, reason)
+                accepted = [contribution for contribution, valid
+                            in zip(accepted, passed) if valid]
+                continue
+
+            if needs not in data:
+                items = [(needs, contribution) for contribution in accepted]
+                data[needs] = dict(zip(
+                    (contribution["url"] for contribution in accepted),
+                    executor.map(safe_fetch, items)))
+
+            survivors = []
+            for contribution in accepted:
+                value = data[needs][contribution["url"]]
+                if value is None:
+                    # Couldn't be fetched this time, so it's left for the
+                    # next run instead of being rejected
+                    continue
+                elif not validator["check"](contribution, value):
+                    reject(contribution, reason)
+                else:
+                    survivors.append(contribution)
+            accepted = survivors
+
+    return accepted, rejected
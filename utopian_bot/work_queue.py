@@ -0,0 +1,442 @@
+"""
+Durable work queue of the broadcasts and sheet updates the bots don't need to
+wait for: the replies and sheet updates that follow a vote, unvotes and the
+edits of their comments, and resteems. Tasks are stored in their own SQLite
+database, so they survive restarts, and are drained by several worker
+processes, each connected to its own node. A worker leases a task for
+`LEASE_TIME` seconds, so the task of a worker that died is picked up by
+another one, and a task that failed is retried with exponential backoff until
+it has been attempted `MAX_ATTEMPTS` times, after which it's dead-lettered.
+
+Broadcasts of the same operation from the same account must be a few seconds
+apart, so tasks can name a throttle (e.g. `utopian-io:comment`) and only one
+task per throttle is leased every `VOTE_INTERVAL` seconds.
+"""
+
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import time
+import traceback
+from contextlib import contextmanager
+
+from logger import attach, get_logger, process_queue
+import metrics
+
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+QUEUE_PATH = os.environ.get("QUEUE_PATH", f"{DIR_PATH}/queue.db")
+# Number of worker processes a bot drains its tasks with, 0 drains them in the
+# bot's own process
+QUEUE_WORKERS = int(os.environ.get("QUEUE_WORKERS", 4))
+# Nodes the workers connect to, handed out to the workers in turn
+QUEUE_NODES = [node for node in os.environ.get("QUEUE_NODES", "").split(",")
+               if node]
+# Seconds between two throttled tasks, as in constants.py
+VOTE_INTERVAL = float(os.environ.get("VOTE_INTERVAL", 3))
+# Seconds a worker has to finish a task before it's handed to another one
+LEASE_TIME = 300
+MAX_ATTEMPTS = 5
+# Seconds before the first retry, doubled for every further attempt
+RETRY_DELAY = 15
+# Seconds an idle worker waits before looking for tasks again
+POLL_INTERVAL = 0.5
+# Finished tasks are kept this long, so they aren't enqueued again
+RETENTION = 14 * 86400
+# Seconds to wait for a write lock held by another worker
+BUSY_TIMEOUT = 30
+
+# Function executing each kind of task, called with the task's payload as
+# keyword arguments. Raising an exception makes the task be retried.
+HANDLERS = {
+    "reply_contribution": "upvote_bot:reply_to_contribution",
+    "reply_comment": "upvote_bot:reply_to_comment",
+    "reply_trail": "upvote_bot:reply_to_trail_contribution",
+    "update_sheet": "upvote_bot:update_sheet",
+    "unvote": "unvote_bot:unvote_post",
+    "edit_comment": "unvote_bot:update_comment",
+    "mark_unvoted": "unvote_bot:mark_unvoted",
+    "resteem": "resteem_bot:resteem_post",
+}
+
+logger = get_logger("utopian-io")
+
+
+class WorkQueue():
+    """Queue of tasks stored in the SQLite database at the given path. Every
+    process needs its own instance.
+    """
+    def __init__(self, path=QUEUE_PATH, clock=time.time):
+        self.clock = clock
+        self.connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT,
+                                          isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            "key TEXT UNIQUE,"
+            "kind TEXT NOT NULL,"
+            "payload TEXT NOT NULL,"
+            "throttle TEXT,"
+            "status TEXT NOT NULL DEFAULT 'pending',"
+            "attempts INTEGER NOT NULL DEFAULT 0,"
+            "available_at REAL NOT NULL,"
+            "lease_until REAL,"
+            "worker TEXT,"
+            "last_error TEXT,"
+            "created REAL NOT NULL,"
+            "finished REAL)")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS tasks_available "
+            "ON tasks (status, available_at)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS throttles ("
+            "name TEXT PRIMARY KEY,"
+            "until REAL NOT NULL)")
+
+    @contextmanager
+    def transaction(self):
+        """Runs the block in a write transaction, which takes the database's
+        write lock right away so two workers never lease the same task.
+        """
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.connection
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def enqueue(self, kind, payload, key=None, throttle=None, delay=0.0):
+        """Adds a task and returns True, or False if a task with the same key
+        was already enqueued.
+        """
+        now = self.clock()
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "INSERT OR IGNORE INTO tasks (key, kind, payload, throttle, "
+                "available_at, created) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, kind, json.dumps(payload, separators=(",", ":")),
+                 throttle, now + delay, now))
+        if cursor.rowcount:
+            metrics.inc("utopian_queue_tasks_total", kind=kind,
+                        status="enqueued")
+        return bool(cursor.rowcount)
+
+    def known(self, key):
+        """Returns True if a task with the given key was enqueued."""
+        row = self.connection.execute(
+            "SELECT 1 FROM tasks WHERE key = ?", (key,)).fetchone()
+        return row is not None
+
+    def lease(self, worker, kinds=None):
+        """Leases the oldest task that is available (or whose lease expired)
+        and whose throttle allows it, and returns it, or None if there is
+        none.
+        """
+        now = self.clock()
+        kinds = list(kinds or HANDLERS)
+        with self.transaction() as connection:
+            row = connection.execute(
+                "SELECT * FROM tasks "
+                "WHERE ((status = 'pending' AND available_at <= ?) "
+                "OR (status = 'leased' AND lease_until <= ?)) "
+                f"AND kind IN ({', '.join('?' * len(kinds))}) "
+                "AND (throttle IS NULL OR throttle NOT IN "
+                "(SELECT name FROM throttles WHERE until > ?)) "
+                "ORDER BY available_at, id LIMIT 1",
+                (now, now, *kinds, now)).fetchone()
+            if row is None:
+                return None
+
+            connection.execute(
+                "UPDATE tasks SET status = 'leased', lease_until = ?, "
+                "worker = ?, attempts = attempts + 1 WHERE id = ?",
+                (now + LEASE_TIME, worker, row["id"]))
+            if row["throttle"]:
+                connection.execute(
+                    "INSERT OR REPLACE INTO throttles (name, until) "
+                    "VALUES (?, ?)", (row["throttle"], now + VOTE_INTERVAL))
+
+        task = dict(row)
+        task["payload"] = json.loads(task["payload"])
+        task["attempts"] += 1
+        return task
+
+    def complete(self, task):
+        """Marks the leased task as done."""
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE tasks SET status = 'done', finished = ?, "
+                "lease_until = NULL WHERE id = ?", (self.clock(), task["id"]))
+
+    def fail(self, task, error):
+        """Schedules the leased task to be retried after an exponentially
+        growing delay, or dead-letters it if it has been attempted too often,
+        and returns its new status.
+        """
+        now = self.clock()
+        if task["attempts"] >= MAX_ATTEMPTS:
+            status, available_at = "dead", now
+        else:
+            status = "pending"
+            available_at = now + RETRY_DELAY * 2 ** (task["attempts"] - 1)
+
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE tasks SET status = ?, available_at = ?, "
+                "lease_until = NULL, last_error = ?, finished = ? "
+                "WHERE id = ?",
+                (status, available_at, str(error)[:1000],
+                 now if status == "dead" else None, task["id"]))
+        return status
+
+    def unfinished(self, kinds=None):
+        """Returns the number of tasks that are pending or leased."""
+        kinds = list(kinds or HANDLERS)
+        row = self.connection.execute(
+            "SELECT COUNT(*) FROM tasks WHERE status IN ('pending', 'leased') "
+            f"AND kind IN ({', '.join('?' * len(kinds))})", kinds).fetchone()
+        return row[0]
+
+    def counts(self):
+        """Returns the number of tasks of each kind by status."""
+        counts = {}
+        for row in self.connection.execute(
+                "SELECT kind, status, COUNT(*) FROM tasks "
+                "GROUP BY kind, status"):
+            counts.setdefault(row[0], {})[row[1]] = row[2]
+        return counts
+
+    def dead_letters(self):
+        """Returns the dead-lettered tasks."""
+        return [dict(row) for row in self.connection.execute(
+            "SELECT id, kind, payload, attempts, last_error FROM tasks "
+            "WHERE status = 'dead' ORDER BY id")]
+
+    def retry_dead(self):
+        """Makes the dead-lettered tasks available again and returns their
+        number.
+        """
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE tasks SET status = 'pending', attempts = 0, "
+                "available_at = ?, finished = NULL WHERE status = 'dead'",
+                (self.clock(),))
+        return cursor.rowcount
+
+    def purge(self, retention=RETENTION):
+        """Deletes the tasks that finished longer than `retention` seconds
+        ago.
+        """
+        now = self.clock()
+        with self.transaction() as connection:
+            connection.execute(
+                "DELETE FROM tasks WHERE status = 'done' AND finished < ?",
+                (now - retention,))
+            connection.execute("DELETE FROM throttles WHERE until < ?",
+                               (now,))
+
+
+_QUEUES = {}
+
+
+def queue(path=QUEUE_PATH):
+    """Returns this process's queue stored at the given path."""
+    key = (path, os.getpid())
+    if key not in _QUEUES:
+        _QUEUES[key] = WorkQueue(path)
+    return _QUEUES[key]
+
+
+def enqueue(kind, payload, key=None, throttle=None):
+    """Adds a task to this process's queue, see `WorkQueue.enqueue`."""
+    return queue().enqueue(kind, payload, key, throttle)
+
+
+def handler(kind):
+    """Returns the function executing the given kind of task."""
+    module, function = HANDLERS[kind].split(":")
+    return getattr(importlib.import_module(module), function)
+
+
+def run_task(work_queue, task):
+    """Executes the leased task and records its outcome."""
+    kind = task["kind"]
+    start = time.perf_counter()
+    try:
+        handler(kind)(**task["payload"])
+    except Exception as error:
+        status = work_queue.fail(task, error)
+        logger.error(f"Task {task['id']} ({kind}) failed on attempt "
+                     f"{task['attempts']}: {error}")
+        if status == "dead":
+            logger.error(f"Gave up on task {task['id']} ({kind}):\n"
+                         f"{traceback.format_exc()}")
+    else:
+        work_queue.complete(task)
+        status = "done"
+    metrics.observe("utopian_queue_task_duration_seconds",
+                    time.perf_counter() - start, kind=kind)
+    metrics.inc("utopian_queue_tasks_total", kind=kind,
+                status="retried" if status == "pending" else status)
+    return status
+
+
+def run_available(name, kinds=None, path=QUEUE_PATH):
+    """Executes the tasks of the given kinds that can be leased right now,
+    without waiting for the others, and returns their number.
+    """
+    work_queue = queue(path)
+    worker = f"{name}:{os.getpid()}"
+    executed = 0
+    while True:
+        task = work_queue.lease(worker, kinds)
+        if task is None:
+            return executed
+        run_task(work_queue, task)
+        executed += 1
+
+
+def work(name, kinds=None, drain=True, path=QUEUE_PATH):
+    """Executes the tasks of the given kinds until there are none left, or
+    forever if `drain` is False.
+    """
+    work_queue = queue(path)
+    executed = 0
+    while True:
+        executed += run_available(name, kinds, path)
+        if drain and not work_queue.unfinished(kinds):
+            break
+        time.sleep(POLL_INTERVAL)
+    return executed
+
+
+def use_node(node, keys=()):
+    """Makes this worker process connect to the given node, with the given
+    keys. The bots connect as soon as they are imported, so the node is set in
+    this process's environment for them, and if they were imported already
+    (e.g. with the main module of the bot that started the worker) their
+    connection is moved to it.
+    """
+    os.environ["STEEM_NODE"] = node
+    if keys:
+        os.environ["STEEM_KEYS"] = ",".join(keys)
+    connections = sys.modules.get("connections")
+    if connections:
+        connections.reconnect(node, keys)
+
+
+def worker(name, kinds, records, node=None, keys=(), path=QUEUE_PATH):
+    """Executes the tasks of the given kinds in a worker process started by
+    `drain`, connected to the given node (or the bot's), sending its log
+    records through the given queue to the bot's process.
+    """
+    attach(records)
+    if node:
+        use_node(node, keys)
+    metrics.start(f"queue_{name}")
+    try:
+        work(name, kinds, path=path)
+    finally:
+        metrics.export()
+
+
+def worker_node(index):
+    """Returns the node the worker with the given index connects to, the
+    next one in `QUEUE_NODES`, or None to use the bot's node.
+    """
+    if QUEUE_NODES:
+        return QUEUE_NODES[index % len(QUEUE_NODES)]
+    return None
+
+
+def start_worker(index, kinds):
+    """Starts the worker with the given index in a fresh interpreter, handing
+    it its node and the keys the bot was started with.
+    """
+    keys = [key for key in os.environ.get("STEEM_KEYS", "").split(",")
+            if key]
+    process = multiprocessing.get_context("spawn").Process(
+        target=worker, args=(f"worker-{index}", kinds, process_queue(),
+                             worker_node(index), keys, QUEUE_PATH),
+        name=f"worker-{index}")
+    process.start()
+    return process
+
+
+def drain(kinds=None, workers=QUEUE_WORKERS):
+    """Executes the tasks of the given kinds with the given number of worker
+    processes, or in this process if it's 0, and waits until none are left.
+    """
+    work_queue = queue()
+    work_queue.purge()
+    unfinished = work_queue.unfinished(kinds)
+    if not unfinished:
+        return
+    logger.info(f"Draining {unfinished} tasks with {workers} workers")
+
+    if not workers:
+        work("main", kinds)
+        return
+
+    processes = [start_worker(index, kinds)
+                 for index in range(min(workers, unfinished))]
+    for process in processes:
+        process.join()
+        if process.exitcode:
+            logger.error(f"Queue worker {process.pid} exited with "
+                         f"{process.exitcode}")
+
+
+def status():
+    """Prints the number of tasks of each kind by status, and the
+    dead-lettered tasks.
+    """
+    work_queue = queue()
+    for kind, counts in sorted(work_queue.counts().items()):
+        print(f"{kind}: " + ", ".join(f"{count} {status}" for status, count
+                                     in sorted(counts.items())))
+    for task in work_queue.dead_letters():
+        print(f"dead {task['id']} {task['kind']} {task['payload']}: "
+              f"{task['last_error']}")
+
+
+def main():
+    """Drains the durable work queue or shows its status."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    work_parser = subparsers.add_parser(
+        "work", help="execute tasks in this process")
+    work_parser.add_argument("--name", default="worker")
+    work_parser.add_argument("--kinds", help="comma separated kinds of tasks")
+    work_parser.add_argument("--forever", action="store_true",
+                             help="keep waiting for new tasks")
+    drain_parser = subparsers.add_parser(
+        "drain", help="execute all tasks with several worker processes")
+    drain_parser.add_argument("--workers", type=int, default=QUEUE_WORKERS)
+    drain_parser.add_argument("--kinds", help="comma separated kinds of tasks")
+    subparsers.add_parser("status", help="show the number of tasks")
+    subparsers.add_parser("retry", help="retry the dead-lettered tasks")
+    args = parser.parse_args()
+
+    kinds = args.kinds.split(",") if getattr(args, "kinds", None) else None
+    if args.command == "work":
+        metrics.start(f"queue_{args.name}")
+        try:
+            work(args.name, kinds, drain=not args.forever)
+        finally:
+            metrics.export()
+    elif args.command == "drain":
+        drain(kinds, args.workers)
+    elif args.command == "status":
+        status()
+    else:
+        print(f"Retrying {queue().retry_dead()} dead-lettered tasks")
+
+if __name__ == '__main__':
+    main()